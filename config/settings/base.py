@@ -237,18 +237,29 @@ LOGGING = {
     "disable_existing_loggers": False,
     "formatters": {
         "verbose": {
+            # Appends structured fields passed with extra={...} as key=value pairs
+            "()": "fort_worth_crawler.shared.log.KeyValueFormatter",
             "format": "%(levelname)s %(asctime)s %(module)s "
-            "%(process)d %(thread)d %(message)s"
+            "%(process)d %(thread)d %(message)s",
         }
     },
+    "filters": {
+        # Thins out per-row events logged with extra=sampled(...) (see fort_worth_crawler/shared/log.py)
+        "sampling": {"()": "fort_worth_crawler.shared.log.SamplingFilter"},
+    },
     "handlers": {
         "console": {
             "level": "DEBUG",
             "class": "logging.StreamHandler",
             "formatter": "verbose",
+            "filters": ["sampling"],
         }
     },
     "root": {"level": "INFO", "handlers": ["console"]},
+    "loggers": {
+        # Crawler / export tracing is at DEBUG, so it costs (next to) nothing unless this is turned down
+        "fort_worth_crawler": {"level": env("CRAWLER_LOG_LEVEL", default="INFO")},
+    },
 }
 
 # Celery
@@ -297,3 +308,79 @@ SOCIALACCOUNT_FORMS = {"signup": "fort_worth_crawler.users.forms.UserSocialSignu
 
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Fort Worth PaperFiche crawler
+# ------------------------------------------------------------------------------
+# Crawl the folder tree with the asyncio engine (api/async_client.py) instead of the serial, recursive crawler
+CRAWLER_USE_ASYNC_ENGINE = env.bool("CRAWLER_USE_ASYNC_ENGINE", True)
+# Max number of folder listing requests the async engine keeps in flight. The HTTP connection pool is sized to match.
+CRAWLER_MAX_CONCURRENT_REQUESTS = env.int("CRAWLER_MAX_CONCURRENT_REQUESTS", 8)
+# Throttle PaperFiche requests with the adaptive, per-endpoint token buckets in api/rate_limit.py. The buckets live in
+# the redis instance behind CELERY_BROKER_URL so the limit is shared by every worker.
+CRAWLER_RATE_LIMIT_ENABLED = env.bool("CRAWLER_RATE_LIMIT_ENABLED", True)
+# Also save every listing row a crawl finds as NDJSON (Crawl.ndjson_results), e.g. for debugging or loading elsewhere
+CRAWLER_WRITE_NDJSON_OUTPUT = env.bool("CRAWLER_WRITE_NDJSON_OUTPUT", False)
+# Learn the biggest folder listing window the server handles reliably, per repo, instead of always asking for 40 rows
+# (see api/page_size.py). Learned sizes are kept in the default cache.
+CRAWLER_ADAPTIVE_PAGE_SIZE_ENABLED = env.bool("CRAWLER_ADAPTIVE_PAGE_SIZE_ENABLED", True)
+# How often an in-progress crawl checkpoints its frontier and listed folders to the database
+CRAWLER_CHECKPOINT_INTERVAL_SECONDS = env.int("CRAWLER_CHECKPOINT_INTERVAL_SECONDS", 30)
+# Unfinished crawls that started less than this long ago are resumed rather than started over
+CRAWLER_RESUME_MAX_AGE_HOURS = env.int("CRAWLER_RESUME_MAX_AGE_HOURS", 24)
+# Only list folders whose modified date or listing row changed since the previous crawl...
+CRAWLER_INCREMENTAL_ENABLED = env.bool("CRAWLER_INCREMENTAL_ENABLED", True)
+# ...but still do a full crawl if the last one finished more than this many days ago, as a safety net
+CRAWLER_FULL_CRAWL_INTERVAL_DAYS = env.int("CRAWLER_FULL_CRAWL_INTERVAL_DAYS", 7)
+# Rows per query when diffing a crawl against the documents we already have (see
+# filter_document_jsons_to_new_and_newly_modified)
+CRAWLER_DIFF_CHUNK_SIZE = env.int("CRAWLER_DIFF_CHUNK_SIZE", 1000)
+# Writing a big crawl's results out to storage can take longer than CELERY_TASK_SOFT_TIME_LIMIT, so
+# store_crawl_results_task gets its own
+CRAWLER_STORE_RESULTS_SOFT_TIME_LIMIT = env.int("CRAWLER_STORE_RESULTS_SOFT_TIME_LIMIT", 15 * 60)
+CRAWLER_STORE_RESULTS_TIME_LIMIT = env.int("CRAWLER_STORE_RESULTS_TIME_LIMIT", 20 * 60)
+# Response cache for repeat PaperFiche requests (see api/cache.py): "disk", "redis" (the CELERY_BROKER_URL instance),
+# or "" to turn it off. Off by default - a crawl rarely asks for the same page twice, so it mostly costs writes.
+CRAWLER_HTTP_CACHE_BACKEND = env("CRAWLER_HTTP_CACHE_BACKEND", default="")
+CRAWLER_HTTP_CACHE_DIR = env("CRAWLER_HTTP_CACHE_DIR", default=str(ROOT_DIR / ".http_cache"))
+CRAWLER_HTTP_CACHE_MAX_BYTES = env.int("CRAWLER_HTTP_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+CRAWLER_HTTP_CACHE_MAX_ENTRIES = env.int("CRAWLER_HTTP_CACHE_MAX_ENTRIES", 50000)
+# Documents are exported from PaperFiche in batches of up to this many documents / pages (page count stands in for
+# export size, which we can't know up front)
+CRAWLER_EXPORT_BATCH_MAX_DOCUMENTS = env.int("CRAWLER_EXPORT_BATCH_MAX_DOCUMENTS", 50)
+CRAWLER_EXPORT_BATCH_MAX_PAGES = env.int("CRAWLER_EXPORT_BATCH_MAX_PAGES", 2000)
+# How documents that aren't chunked are exported: "bulk" - ZIP exports (StartExport -> GetExportJob), batched by
+# queue_pending_document_exports - or "single" - one single document export (GeneratePDF10 -> PDF10) per document,
+# skipping the ZIP packaging
+CRAWLER_EXPORT_METHOD = env("CRAWLER_EXPORT_METHOD", default="bulk")
+# Documents with at least CRAWLER_EXPORT_CHUNK_MIN_PAGES pages are exported as page range chunks of
+# CRAWLER_EXPORT_CHUNK_PAGES pages, in parallel, and merged back together locally
+CRAWLER_EXPORT_CHUNK_MIN_PAGES = env.int("CRAWLER_EXPORT_CHUNK_MIN_PAGES", 200)
+CRAWLER_EXPORT_CHUNK_PAGES = env.int("CRAWLER_EXPORT_CHUNK_PAGES", 50)
+# Outstanding exports are checked by the poll_export_jobs periodic task every CRAWLER_EXPORT_POLL_INTERVAL_SECONDS.
+# Each export is checked no more often than every CRAWLER_EXPORT_POLL_MIN_SECONDS and no less often than every
+# CRAWLER_EXPORT_POLL_MAX_SECONDS, and given up on after CRAWLER_EXPORT_TIMEOUT_HOURS.
+CRAWLER_EXPORT_POLL_INTERVAL_SECONDS = env.int("CRAWLER_EXPORT_POLL_INTERVAL_SECONDS", 10)
+CRAWLER_EXPORT_POLL_MIN_SECONDS = env.int("CRAWLER_EXPORT_POLL_MIN_SECONDS", 5)
+CRAWLER_EXPORT_POLL_MAX_SECONDS = env.int("CRAWLER_EXPORT_POLL_MAX_SECONDS", 120)
+CRAWLER_EXPORT_TIMEOUT_HOURS = env.int("CRAWLER_EXPORT_TIMEOUT_HOURS", 6)
+# How often queue_pending_document_exports sweeps up documents whose export fell through, and how old a document has to
+# be before the sweep touches it (newer ones are still in the hands of the sync pipeline)
+CRAWLER_EXPORT_SWEEP_INTERVAL_SECONDS = env.int("CRAWLER_EXPORT_SWEEP_INTERVAL_SECONDS", 60 * 60)
+CRAWLER_EXPORT_SWEEP_GRACE_MINUTES = env.int("CRAWLER_EXPORT_SWEEP_GRACE_MINUTES", 60)
+# "poller" - outstanding exports are checked by poll_export_jobs. "countdown" - each export gets its own
+# check_export_job_status task that reschedules itself (with backoff) until the export is done, and poll_export_jobs
+# only picks up exports whose task went missing.
+CRAWLER_EXPORT_POLLING = env("CRAWLER_EXPORT_POLLING", default="poller")
+# Downloading a big export can take much longer than CELERY_TASK_SOFT_TIME_LIMIT, so download_export_job gets its own
+CRAWLER_EXPORT_DOWNLOAD_SOFT_TIME_LIMIT = env.int("CRAWLER_EXPORT_DOWNLOAD_SOFT_TIME_LIMIT", 15 * 60)
+CRAWLER_EXPORT_DOWNLOAD_TIME_LIMIT = env.int("CRAWLER_EXPORT_DOWNLOAD_TIME_LIMIT", 20 * 60)
+# Synced into django_celery_beat's schedule when beat starts
+CELERY_BEAT_SCHEDULE = {
+    "poll-export-jobs": {
+        "task": "fort_worth_crawler.documents.tasks.poll_export_jobs",
+        "schedule": CRAWLER_EXPORT_POLL_INTERVAL_SECONDS,
+    },
+    "queue-pending-document-exports": {
+        "task": "fort_worth_crawler.documents.tasks.queue_pending_document_exports",
+        "schedule": CRAWLER_EXPORT_SWEEP_INTERVAL_SECONDS,
+    },
+}
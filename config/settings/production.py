@@ -142,11 +142,17 @@ INSTALLED_APPS = ["collectfast"] + INSTALLED_APPS  # noqa F405
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
-    "filters": {"require_debug_false": {"()": "django.utils.log.RequireDebugFalse"}},
+    "filters": {
+        "require_debug_false": {"()": "django.utils.log.RequireDebugFalse"},
+        # Thins out per-row events logged with extra=sampled(...) (see fort_worth_crawler/shared/log.py)
+        "sampling": {"()": "fort_worth_crawler.shared.log.SamplingFilter"},
+    },
     "formatters": {
         "verbose": {
+            # Appends structured fields passed with extra={...} as key=value pairs
+            "()": "fort_worth_crawler.shared.log.KeyValueFormatter",
             "format": "%(levelname)s %(asctime)s %(module)s "
-            "%(process)d %(thread)d %(message)s"
+            "%(process)d %(thread)d %(message)s",
         }
     },
     "handlers": {
@@ -159,6 +165,7 @@ LOGGING = {
             "level": "DEBUG",
             "class": "logging.StreamHandler",
             "formatter": "verbose",
+            "filters": ["sampling"],
         },
     },
     "root": {"level": "INFO", "handlers": ["console"]},
@@ -173,6 +180,7 @@ LOGGING = {
             "handlers": ["console", "mail_admins"],
             "propagate": True,
         },
+        "fort_worth_crawler": {"level": env("CRAWLER_LOG_LEVEL", default="INFO")},
     },
 }
 
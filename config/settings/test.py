@@ -31,3 +31,8 @@ TEMPLATES[0]["OPTIONS"]["debug"] = True  # type: ignore # noqa F405
 
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Tests never talk to PaperFiche, so don't go looking for redis to throttle them
+CRAWLER_RATE_LIMIT_ENABLED = False
+CRAWLER_HTTP_CACHE_BACKEND = ""
+# Listing tests count on fixed size windows. The page sizer is tested on its own.
+CRAWLER_ADAPTIVE_PAGE_SIZE_ENABLED = False
@@ -0,0 +1,238 @@
+#  Copyright (C) 2022  John Scrudato / Gordium Knot Inc. d/b/a OpenSource.Legal
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import typing
+
+from fort_worth_crawler.api.client import (
+    FolderCompleteCallback,
+    FolderContentsDict,
+    ListFolderCallback,
+    ShouldDescendCallback,
+    get_listing_page_size,
+    get_remaining_page_windows,
+    is_document_entry,
+    is_folder_entry,
+    max_concurrent_requests,
+    request_folder_page,
+)
+
+
+# ASYNC API CALLS ######################################################################################################
+
+# The blocking calls in client.py are run on worker threads rather than re-implemented on an async http library. That
+# way every request still goes through the module-level session (and its adapter retries), and the only thing the
+# event loop adds is scheduling: the semaphore caps how many folder listing requests are in flight at once.
+
+async def async_request_folder_results(
+    repo: str,
+    folder_id: int,
+    start: int,
+    end: int,
+    semaphore: asyncio.Semaphore
+) -> dict:
+    async with semaphore:
+        return await asyncio.to_thread(
+            request_folder_page,
+            repo=repo,
+            folder_id=folder_id,
+            start=start,
+            end=end
+        )
+
+
+async def async_get_folder_contents(
+    repo: str,
+    folder_id: int,
+    semaphore: asyncio.Semaphore
+) -> FolderContentsDict:
+    """
+    Async version of client.get_folder_contents. The first page tells us totalEntries, after which the remaining
+    pages are all requested at once (subject to the semaphore) and stitched back together in order.
+
+    :param repo: Repository the folder lives in (e.g. "City-Secretary")
+    :param folder_id: Folder ID we want to fetch.
+    :param semaphore: Shared semaphore bounding in-flight listing requests for the whole crawl.
+    :return: Folders and documents directly inside the folder.
+    """
+
+    page_size = get_listing_page_size(repo)
+    initial_results = await async_request_folder_results(
+        repo=repo,
+        folder_id=folder_id,
+        start=0,
+        end=page_size,
+        semaphore=semaphore
+    )
+
+    total_entries = initial_results['totalEntries']
+    entries = list(initial_results['results'] or [])
+
+    subsequent_results = await asyncio.gather(*[
+        async_request_folder_results(
+            repo=repo,
+            folder_id=folder_id,
+            start=page_start,
+            end=page_end,
+            semaphore=semaphore
+        ) for page_start, page_end in get_remaining_page_windows(total_entries=total_entries, page_size=page_size)
+    ])
+
+    for page in subsequent_results:
+        entries.extend(page['results'] or [])
+
+    return {
+        "folders": list(filter(is_folder_entry, entries)),
+        "documents": list(filter(is_document_entry, entries)),
+    }
+
+
+async def async_list_folder(
+    list_folder: ListFolderCallback,
+    folder_id: int,
+    semaphore: asyncio.Semaphore
+) -> FolderContentsDict:
+    """
+    Runs a synchronous list_folder callback (e.g. IncrementalCrawlPlan.list_folder) in a thread. It holds a single
+    semaphore slot for the whole listing, so the callback shouldn't request more than one listing page at a time.
+    """
+    async with semaphore:
+        entries = await asyncio.to_thread(lambda: list(list_folder(folder_id)))
+
+    return {
+        "folders": list(filter(is_folder_entry, entries)),
+        "documents": list(filter(is_document_entry, entries)),
+    }
+
+
+# ASYNC CRAWLER ########################################################################################################
+
+async def async_crawl_directory(
+    repo: str,
+    folder_id: int,
+    max_concurrency: int = max_concurrent_requests,
+    frontier: typing.Optional[typing.Iterable[int]] = None,
+    on_folder_complete: typing.Optional[FolderCompleteCallback] = None,
+    should_descend: typing.Optional[ShouldDescendCallback] = None,
+    list_folder: typing.Optional[ListFolderCallback] = None
+) -> FolderContentsDict:
+    """
+    Crawls the folder tree under folder_id with up to max_concurrency listing requests in flight at any one time.
+    Folders are handed out to a fixed pool of workers through a queue, so sibling (and cousin) folders are listed in
+    parallel rather than one after another.
+
+    :param repo: Repository the folder lives in (e.g. "City-Secretary")
+    :param folder_id: Root folder to crawl
+    :param max_concurrency: Max number of simultaneous folder listing requests
+    :param frontier: Folders still to be listed when resuming an interrupted crawl. Defaults to just folder_id.
+    :param on_folder_complete: Optional hook called each time a folder has been fully listed. It's run on a worker
+    thread (so it's free to use the Django ORM), one call at a time. When given, it's the only place the rows go - the
+    crawl doesn't also collect them in memory.
+    :param should_descend: Optional filter deciding which subfolders get listed. All of them by default.
+    :param list_folder: Optional replacement for async_get_folder_contents. It's blocking, so it's run on a worker
+    thread, and takes a single concurrency slot for the whole folder.
+    :return: Every folder and document listed by this run, same shape as client.crawl_directory (empty if
+    on_folder_complete is given)
+    """
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    results: FolderContentsDict = {
+        "folders": [],
+        "documents": [],
+    }
+
+    # Folders queued or currently being listed by a worker, i.e. everything a resumed crawl would still need to list
+    pending: dict[int, None] = {}
+    callback_lock = asyncio.Lock()
+
+    async def worker():
+        while True:
+            current_folder_id = await queue.get()
+            try:
+                if list_folder is None:
+                    contents = await async_get_folder_contents(
+                        repo=repo,
+                        folder_id=current_folder_id,
+                        semaphore=semaphore
+                    )
+                else:
+                    contents = await async_list_folder(list_folder, current_folder_id, semaphore)
+                if on_folder_complete is None:
+                    results['folders'].extend(contents['folders'])
+                    results['documents'].extend(contents['documents'])
+                for subfolder in contents['folders']:
+                    if should_descend is not None and not should_descend(subfolder):
+                        continue
+                    pending[subfolder['entryId']] = None
+                    queue.put_nowait(subfolder['entryId'])
+
+                if on_folder_complete is None:
+                    pending.pop(current_folder_id, None)
+                else:
+                    async with callback_lock:
+                        # Only drop the folder from the frontier once it's handed over with its own checkpoint. Until
+                        # then, checkpoints taken for other folders must still count it as left to list.
+                        pending.pop(current_folder_id, None)
+                        await asyncio.to_thread(
+                            on_folder_complete,
+                            current_folder_id,
+                            [*contents['folders'], *contents['documents']],
+                            list(pending)
+                        )
+            finally:
+                queue.task_done()
+
+    for pending_folder_id in ([folder_id] if frontier is None else frontier):
+        pending[pending_folder_id] = None
+        queue.put_nowait(pending_folder_id)
+    workers = [asyncio.create_task(worker()) for _ in range(max_concurrency)]
+    queue_drained = asyncio.create_task(queue.join())
+
+    try:
+        # Workers only ever finish by raising, so if one finishes before the queue drains, the crawl has failed.
+        await asyncio.wait([queue_drained, *workers], return_when=asyncio.FIRST_COMPLETED)
+        for task in workers:
+            if task.done() and not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+    finally:
+        queue_drained.cancel()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(queue_drained, *workers, return_exceptions=True)
+
+    return results
+
+
+def crawl_directory_concurrently(
+    repo: str,
+    folder_id: int,
+    max_concurrency: int = max_concurrent_requests,
+    frontier: typing.Optional[typing.Iterable[int]] = None,
+    on_folder_complete: typing.Optional[FolderCompleteCallback] = None,
+    should_descend: typing.Optional[ShouldDescendCallback] = None,
+    list_folder: typing.Optional[ListFolderCallback] = None
+) -> FolderContentsDict:
+    """
+    Synchronous entrypoint (for Celery tasks) to async_crawl_directory.
+    """
+    return asyncio.run(async_crawl_directory(
+        repo=repo,
+        folder_id=folder_id,
+        max_concurrency=max_concurrency,
+        frontier=frontier,
+        on_folder_complete=on_folder_complete,
+        should_descend=should_descend,
+        list_folder=list_folder
+    ))
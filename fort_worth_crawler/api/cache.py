@@ -0,0 +1,327 @@
+#  Copyright (C) 2022  John Scrudato / Gordium Knot Inc. d/b/a OpenSource.Legal
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import abc
+import base64
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import typing
+from pathlib import Path
+
+import redis
+from requests import PreparedRequest, Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from fort_worth_crawler.api.rate_limit import endpoint_for_url
+
+# Logging setup
+logger = logging.getLogger(__name__)
+
+# Seconds a cached response for each endpoint is served without asking the server again. Endpoints that aren't listed
+# (export kick-offs, status polls, downloads) are never cached. Once an entry is stale, it's still kept around so we
+# can revalidate it with If-None-Match / If-Modified-Since if the server gave us an ETag / Last-Modified.
+#
+# GetBasicDocumentInfo is left out on purpose: its request only carries the entryId, so a cached response would hide a
+# change to the document. Document metadata is cached per (entryId, remote modified date) instead, see
+# documents/metadata.py.
+endpoint_ttls: dict[str, int] = {
+    "GetFolderListing2": 15 * 60,
+}
+
+
+class CachedResponse(typing.NamedTuple):
+    status_code: int
+    reason: str
+    headers: dict[str, str]
+    content: bytes
+    stored_at: float
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "status_code": self.status_code,
+            "reason": self.reason,
+            "headers": self.headers,
+            "content": base64.b64encode(self.content).decode('ascii'),
+            "stored_at": self.stored_at,
+        })
+
+    @classmethod
+    def from_json(cls, value: typing.Union[str, bytes]) -> "CachedResponse":
+        data = json.loads(value)
+        return cls(
+            status_code=data['status_code'],
+            reason=data['reason'],
+            headers=data['headers'],
+            content=base64.b64decode(data['content']),
+            stored_at=data['stored_at'],
+        )
+
+    def to_response(self, request: PreparedRequest) -> Response:
+        response = Response()
+        response.status_code = self.status_code
+        response.reason = self.reason
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = self.content
+        response.url = request.url
+        response.request = request
+        return response
+
+
+class CacheBackend(abc.ABC):
+    """
+    Storage for cached responses. Backends are responsible for keeping themselves bounded.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str) -> typing.Optional[CachedResponse]:
+        ...
+
+    @abc.abstractmethod
+    def set(self, key: str, cached_response: CachedResponse):
+        ...
+
+
+class DiskCacheBackend(CacheBackend):
+    """
+    One file per response in directory. Reads bump the file's mtime, and once the directory grows past max_bytes the
+    least recently used files are deleted, down to evict_to_fraction of max_bytes.
+
+    The directory's size is tracked as a running total rather than rescanned on every write, so writes stay cheap no
+    matter how big the cache gets. The total only sees this process' writes, so it's re-synced with a full scan every
+    rescan_every_writes writes (and whenever we evict), which keeps it honest when several workers share the directory.
+    """
+
+    def __init__(self, directory: typing.Union[str, Path], max_bytes: int = 512 * 1024 * 1024,
+                 evict_to_fraction: float = 0.9, rescan_every_writes: int = 1000):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.evict_to_fraction = evict_to_fraction
+        self.rescan_every_writes = rescan_every_writes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._total_bytes: typing.Optional[int] = None
+        self._writes_since_scan = 0
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def get(self, key: str) -> typing.Optional[CachedResponse]:
+        path = self._path(key)
+        try:
+            cached_response = CachedResponse.from_json(path.read_bytes())
+            os.utime(path)
+            return cached_response
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def set(self, key: str, cached_response: CachedResponse):
+        path = self._path(key)
+        try:
+            replaced_bytes = path.stat().st_size
+        except FileNotFoundError:
+            replaced_bytes = 0
+
+        # Write then rename, so concurrent readers never see a half-written file
+        with tempfile.NamedTemporaryFile("w", dir=self.directory, suffix=".tmp", delete=False) as temp_file:
+            temp_file.write(cached_response.to_json())
+        written_bytes = os.path.getsize(temp_file.name)
+        os.replace(temp_file.name, path)
+
+        with self._lock:
+            self._writes_since_scan += 1
+            if self._total_bytes is None or self._writes_since_scan >= self.rescan_every_writes:
+                self._total_bytes = self._scan_total_bytes()
+            else:
+                self._total_bytes += written_bytes - replaced_bytes
+
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _scan(self) -> list[tuple[float, int, str]]:
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        self._writes_since_scan = 0
+        return files
+
+    def _scan_total_bytes(self) -> int:
+        return sum(size for _, size, _ in self._scan())
+
+    def _evict(self):
+        files = self._scan()
+        total_bytes = sum(size for _, size, _ in files)
+        target_bytes = self.max_bytes * self.evict_to_fraction
+
+        for _, size, path in sorted(files):
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+        self._total_bytes = total_bytes
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Responses are stored under their own keys, with a sorted set of keys by last access used to evict the least
+    recently used ones past max_entries. We do our own eviction rather than lean on redis' maxmemory policy because the
+    same redis instance is the Celery broker.
+    """
+
+    def __init__(self, redis_client: redis.Redis, max_entries: int = 50000, key_prefix: str = "paperfiche:http_cache",
+                 expire_seconds: int = 7 * 24 * 60 * 60):
+        self.redis_client = redis_client
+        self.max_entries = max_entries
+        self.key_prefix = key_prefix
+        self.expire_seconds = expire_seconds
+
+    def _key(self, key: str) -> str:
+        return f"{self.key_prefix}:{key}"
+
+    def get(self, key: str) -> typing.Optional[CachedResponse]:
+        value = self.redis_client.get(self._key(key))
+        if value is None:
+            return None
+        self.redis_client.zadd(f"{self.key_prefix}:lru", {key: time.time()})
+        return CachedResponse.from_json(value)
+
+    def set(self, key: str, cached_response: CachedResponse):
+        lru_key = f"{self.key_prefix}:lru"
+        pipeline = self.redis_client.pipeline()
+        pipeline.set(self._key(key), cached_response.to_json(), ex=self.expire_seconds)
+        pipeline.zadd(lru_key, {key: time.time()})
+        pipeline.zcard(lru_key)
+        entry_count = pipeline.execute()[-1]
+
+        if entry_count > self.max_entries:
+            evicted_keys = self.redis_client.zrange(lru_key, 0, entry_count - self.max_entries - 1)
+            if evicted_keys:
+                pipeline = self.redis_client.pipeline()
+                pipeline.delete(*[self._key(evicted_key.decode('utf-8')) for evicted_key in evicted_keys])
+                pipeline.zrem(lru_key, *evicted_keys)
+                pipeline.execute()
+
+
+def get_cache_key(request: PreparedRequest) -> str:
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha256(f"{request.method} {request.url}\n".encode('utf-8') + body).hexdigest()
+
+
+class ResponseCache:
+    """
+    Sits in front of the transport (see TimeoutHTTPAdapter.send). Fresh entries are served without touching the
+    network. Stale entries with an ETag / Last-Modified are revalidated with a conditional request, and a 304 is
+    turned back into the cached response.
+    """
+
+    def __init__(self, backend: CacheBackend, ttls: typing.Optional[dict[str, int]] = None):
+        self.backend = backend
+        self.ttls = endpoint_ttls if ttls is None else ttls
+
+    def send(self, request: PreparedRequest, send: typing.Callable[[PreparedRequest], Response]) -> Response:
+        ttl = self.ttls.get(endpoint_for_url(request.url), 0)
+        if ttl <= 0:
+            return send(request)
+
+        key = get_cache_key(request)
+        try:
+            cached_response = self.backend.get(key)
+        except (redis.RedisError, OSError) as e:
+            logger.warning("Response cache unavailable: %s", e)
+            return send(request)
+
+        if cached_response is not None:
+            if time.time() - cached_response.stored_at < ttl:
+                return cached_response.to_response(request)
+
+            cached_headers = CaseInsensitiveDict(cached_response.headers)
+            if "ETag" in cached_headers:
+                request.headers["If-None-Match"] = cached_headers["ETag"]
+            if "Last-Modified" in cached_headers:
+                request.headers["If-Modified-Since"] = cached_headers["Last-Modified"]
+
+        response = send(request)
+
+        if response.status_code == 304 and cached_response is not None:
+            cached_response = cached_response._replace(stored_at=time.time())
+            self._store(key, cached_response)
+            return cached_response.to_response(request)
+
+        if response.status_code == 200:
+            self._store(key, CachedResponse(
+                status_code=response.status_code,
+                reason=response.reason or "",
+                headers=dict(response.headers),
+                content=response.content,
+                stored_at=time.time(),
+            ))
+
+        return response
+
+    def _store(self, key: str, cached_response: CachedResponse):
+        try:
+            self.backend.set(key, cached_response)
+        except (redis.RedisError, OSError) as e:
+            logger.warning("Could not store response in cache: %s", e)
+
+
+_response_cache: typing.Optional[ResponseCache] = None
+
+
+def get_response_cache() -> typing.Optional[ResponseCache]:
+    """
+    Lazily builds the response cache from the CRAWLER_HTTP_CACHE_* settings. Returns None if caching is switched off
+    (CRAWLER_HTTP_CACHE_BACKEND is empty) or there are no Django settings to configure it from.
+    """
+    global _response_cache
+
+    if _response_cache is None:
+        from django.conf import settings
+
+        backend_name = getattr(settings, "CRAWLER_HTTP_CACHE_BACKEND", None) if settings.configured else None
+        if backend_name == "disk":
+            backend: CacheBackend = DiskCacheBackend(
+                settings.CRAWLER_HTTP_CACHE_DIR,
+                max_bytes=settings.CRAWLER_HTTP_CACHE_MAX_BYTES
+            )
+        elif backend_name == "redis":
+            backend = RedisCacheBackend(
+                redis.Redis.from_url(settings.CELERY_BROKER_URL, socket_timeout=2, socket_connect_timeout=2),
+                max_entries=settings.CRAWLER_HTTP_CACHE_MAX_ENTRIES
+            )
+        else:
+            return None
+
+        _response_cache = ResponseCache(backend)
+
+    return _response_cache
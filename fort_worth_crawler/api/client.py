@@ -4,8 +4,13 @@
 #  it under the terms of the GNU Affero General Public License as
 #  published by the Free Software Foundation, either version 3 of the
 #  License, or (at your option) any later version.
+import tempfile
+import logging
 import time
 import typing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from typing import TypedDict
 
 #  This program is distributed in the hope that it will be useful,
@@ -18,7 +23,14 @@ from typing import TypedDict
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3 import Retry
-from rich import json
+
+from fort_worth_crawler.api.cache import get_response_cache
+from fort_worth_crawler.api.page_size import default_page_size, get_page_sizer
+from fort_worth_crawler.api.rate_limit import endpoint_for_url, get_rate_limiter, response_was_throttled, \
+    throttled_statuses
+
+# Logging setup
+logger = logging.getLogger(__name__)
 
 
 class TimeoutHTTPAdapter(HTTPAdapter):
@@ -33,13 +45,91 @@ class TimeoutHTTPAdapter(HTTPAdapter):
 
     def send(self, request, **kwargs):
         kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
+
+        # Every PaperFiche call goes through here, so this is where repeat requests get answered from the response
+        # cache (see api/cache.py). Streamed responses (downloads) are never cached.
+        response_cache = get_response_cache()
+        if response_cache is None or kwargs.get("stream"):
+            return self._send_throttled(request, **kwargs)
+
+        return response_cache.send(request, lambda cache_request: self._send_throttled(cache_request, **kwargs))
+
+    def _send_throttled(self, request, **kwargs):
+        # ...and where we wait our turn on the shared (cross-worker) rate limiter and report back how the server took
+        # the request. Throttled responses are retried here rather than by urllib3, so every attempt waits its turn.
+        rate_limiter = get_rate_limiter()
+        endpoint = endpoint_for_url(request.url)
+
+        for attempt in range(throttled_retry_attempts + 1):
+            if rate_limiter is not None:
+                rate_limiter.acquire(endpoint)
+            request_started = time.monotonic()
+
+            try:
+                response = super().send(request, **kwargs)
+            except requests.exceptions.RequestException:
+                if rate_limiter is not None:
+                    rate_limiter.record(endpoint, latency=time.monotonic() - request_started, throttled=True)
+                raise
+
+            if rate_limiter is not None:
+                rate_limiter.record(endpoint, latency=time.monotonic() - request_started,
+                                    throttled=response_was_throttled(response))
+
+            if response.status_code not in throttled_statuses:
+                return response
+
+            response.close()
+            if attempt == throttled_retry_attempts:
+                # Same as urllib3's Retry running out
+                raise requests.exceptions.RetryError(
+                    f"{endpoint} still responding {response.status_code} after {attempt + 1} attempts",
+                    request=request,
+                    response=response
+                )
+
+            logger.info("%s responded %s, retrying", endpoint, response.status_code)
+            time.sleep(get_throttled_retry_delay(response, attempt))
+
+
+def get_throttled_retry_delay(response: requests.Response, attempt: int) -> float:
+    """
+    Seconds to back off before retrying a throttled response - its Retry-After, if it gave one in seconds, otherwise
+    exponential backoff.
+    """
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return float(retry_after)
+    return throttled_retry_backoff_factor * (2 ** attempt)
+
+
+def get_max_concurrent_requests(default: int = 8) -> int:
+    """
+    CRAWLER_MAX_CONCURRENT_REQUESTS, or default if there are no Django settings to read it from.
+    """
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+
+    try:
+        return settings.CRAWLER_MAX_CONCURRENT_REQUESTS
+    except (ImproperlyConfigured, AttributeError):
+        return default
 
 
+# Upper bound on simultaneous requests we'll make against the PaperFiche server. The connection pool is sized to match
+# so concurrent crawls (see api/async_client.py) don't get stuck waiting on (or discarding) pooled connections.
+max_concurrent_requests = get_max_concurrent_requests()
+
+# Times a throttled (429 / 5xx) response is retried, and the backoff between attempts. urllib3's Retry only handles
+# connection errors - it would retry throttled responses inside a single send, skipping the rate limiter.
+throttled_retry_attempts = 5
+throttled_retry_backoff_factor = 1.5
+
 # Some
 session = requests.Session()
 adapter = TimeoutHTTPAdapter(timeout=(3, 60), max_retries=Retry(total=5, backoff_factor=1.5, allowed_methods=False,
-                                                                status_forcelist=[429, 500, 502, 503, 504]))
+                                                                respect_retry_after_header=False),
+                             pool_maxsize=max_concurrent_requests)
 session.mount("http://", adapter)
 session.mount("https://", adapter)
 
@@ -55,10 +145,22 @@ headers = {
 root_contract_folder_id = 80306
 repository = "City-Secretary"
 
-increment = 40
+# Default listing window. The window actually used is picked per repo at runtime (see get_listing_page_size).
+increment = default_page_size
 start = 0
 end = start + increment
 
+# Downloads are streamed to disk in chunks this big, and spooled in memory only until they pass spool_max_size, so a
+# worker's memory use doesn't grow with the size of the PDF / ZIP it's downloading
+download_chunk_size = 1024 * 1024
+spool_max_size = 8 * 1024 * 1024
+# Times a dropped download is resumed (with an HTTP Range request) before we give up on it
+download_resume_attempts = 5
+
+# Listing column holding an entry's last modified date, for sorting the listing by it
+modified_sort_column = "Modified"
+remote_datetime_format = '%m/%d/%Y %I:%M:%S %p'
+
 
 # BASIC API CALLS ######################################################################################################
 
@@ -236,7 +338,6 @@ class SingleExportStatusDict(TypedDict):
 def get_single_pdf_download_progress(download_token: str) -> SingleExportStatusDict:
     # POST to
     url = r"https://publicdocuments.fortworthtexas.gov/CSODOCS/DocumentService.aspx/PDFTransition"
-    print(f"get_single_pdf_download_progress - url: {url}")
     request_body = {
         "Key": download_token
     }
@@ -298,8 +399,8 @@ def request_single_pdf_export(
     end_page: int
 ) -> str:
     # POST to
-    url = f"https://publicdocuments.fortworthtexas.gov/CSODOCS/GeneratePDF10.aspx?key={entry_id}&PageRange={start_page}-\
-                                                                                                  {end_page}&Watermark=0&repo=City-Secretary"
+    url = f"https://publicdocuments.fortworthtexas.gov/CSODOCS/GeneratePDF10.aspx?key={entry_id}" \
+          f"&PageRange={start_page}-{end_page}&Watermark=0&repo=City-Secretary"
     # expected response is stupid, basically empty html page that says "ThePDFInitiator10". Some kind of joke for a
     # bored programmer?
 
@@ -318,7 +419,7 @@ def request_single_pdf_export(
     headers = {
         "Host": "publicdocuments.fortworthtexas.gov",
         "Origin": "https://publicdocuments.fortworthtexas.gov",
-        "Refered": f"https://publicdocuments.fortworthtexas.gov/CSODOCS/DocView.aspx?id="
+        "Referer": f"https://publicdocuments.fortworthtexas.gov/CSODOCS/DocView.aspx?id="
                    f"{entry_id}&dbid=0&repo=City-Secretary",
         "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:106.0) Gecko/20100101 Firefox/106.0"
     }
@@ -327,8 +428,8 @@ def request_single_pdf_export(
         headers=headers
     )
 
-    print(f"Response: {response.content}")
-    token = response.content.decode('utf-8').split("\n")[0]
+    logger.debug("GeneratePDF10 response for %s: %r", entry_id, response.content)
+    token = response.content.decode('utf-8').split("\n")[0].strip()
     return token
 
 
@@ -363,98 +464,318 @@ def request_bulk_pdf_export(entry_ids: list[int]) -> str:
     return response.json()['data']['token']
 
 
+def new_spooled_file() -> typing.BinaryIO:
+    """
+    Temp file for downloads - kept in memory while small, rolled over to disk once it passes spool_max_size.
+    """
+    return tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+
+
+def get_download_size(response: requests.Response, offset: int) -> typing.Optional[int]:
+    """
+    Full size of the file being downloaded, from Content-Range on a 206 or Content-Length on a 200 (when the body isn't
+    content-encoded, since iter_content hands us decoded bytes). None if the server didn't say.
+    """
+    if response.status_code == 206:
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get("Content-Length", "")
+    if content_length.isdigit() and not response.headers.get("Content-Encoding"):
+        return offset + int(content_length)
+    return None
+
+
+def download_with_resume(url: str, destination: typing.BinaryIO, headers: typing.Optional[dict] = None) -> int:
+    """
+    Streams url into destination chunk by chunk. If the connection drops partway through (or the body comes up short),
+    the download picks back up where it left off with an HTTP Range request, up to download_resume_attempts times,
+    instead of starting over. If the server ignores the Range header, the download restarts from scratch.
+
+    :return: Number of bytes written
+    """
+    start_offset = destination.tell()
+    bytes_written = 0
+
+    for attempt in range(download_resume_attempts + 1):
+        # Ask for the raw bytes, so Range offsets line up with what we've written
+        request_headers = {**(headers or {}), "Accept-Encoding": "identity"}
+        if bytes_written:
+            request_headers["Range"] = f"bytes={bytes_written}-"
+
+        download_size = None
+        try:
+            with session.get(url, headers=request_headers, stream=True) as response:
+                response.raise_for_status()
+                if bytes_written and response.status_code != 206:
+                    logger.info("Server ignored Range for %s, restarting download", url)
+                    destination.seek(start_offset)
+                    destination.truncate()
+                    bytes_written = 0
+                download_size = get_download_size(response, bytes_written)
+
+                for chunk in response.iter_content(chunk_size=download_chunk_size):
+                    destination.write(chunk)
+                    bytes_written += len(chunk)
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            if attempt == download_resume_attempts:
+                raise
+            logger.warning("Download of %s dropped after %s bytes, resuming: %s", url, bytes_written, e)
+            continue
+
+        if download_size is None or bytes_written >= download_size:
+            return bytes_written
+        logger.warning("Download of %s came up short (%s of %s bytes), resuming", url, bytes_written, download_size)
+
+    raise requests.exceptions.ConnectionError(
+        f"Download of {url} still incomplete after {download_resume_attempts} resumes"
+    )
+
+
 def download_bulk_pdfs(
-    bulk_download_token: str
-):
+    bulk_download_token: str,
+    destination: typing.BinaryIO
+) -> int:
+    """
+    Streams a finished export into destination (see new_spooled_file), which is left positioned at the start of the
+    download so it can be handed straight to storage.
+
+    :return: Number of bytes downloaded
+    """
     # GET to:
     url = f"https://publicdocuments.fortworthtexas.gov/CSODOCS/ExportJobHandler.aspx/GetExportJob/" \
           f"?token={bulk_download_token}"
 
-    response = session.get(url)
-    return response.content
-
     # May need to add "Referer" property to header in form:
     # https://publicdocuments.fortworthtexas.gov/CSODOCS/Browse.aspx?id=265902&dbid=0&repo=City-Secretary
 
-    # Should return ZIP of PDFs in bytes
+    # Returns a ZIP of PDFs (or a bare PDF for single document exports)
+    bytes_written = download_with_resume(url, destination)
+    destination.seek(0)
+    return bytes_written
+
 
+def download_single_pdf(
+    single_download_key: str,
+    entry_id: str,
+    destination: typing.BinaryIO
+) -> int:
+    """
+    Streams a finished single document export (see request_single_pdf_export) into destination, which is left
+    positioned at the start of the download.
 
-def download_single_pdf(single_download_key: str, entry_id: str):
+    :return: Number of bytes downloaded
+    """
     # GET to
     url = f"https://publicdocuments.fortworthtexas.gov/CSODOCS/PDF10/{single_download_key}/{entry_id}"
 
-    # Possibly will need "Referer" header - in this form:
-    # https://publicdocuments.fortworthtexas.gov/CSODOCS/DocView.aspx?id=188176&dbid=0&repo=City-Secretary
+    # Send the same Referer the document viewer would
+    headers = {
+        "Referer": f"https://publicdocuments.fortworthtexas.gov/CSODOCS/DocView.aspx?id="
+                   f"{entry_id}&dbid=0&repo=City-Secretary",
+    }
 
-    # Should return PDF bytes
+    # Returns PDF bytes
+    bytes_written = download_with_resume(url, destination, headers=headers)
+    destination.seek(0)
+    return bytes_written
 
 
 def request_folder_results(
     repo: str,
     folder_id: int,
     start: int,
-    end: int
+    end: int,
+    sort_column: str = "",
+    sort_ascending: bool = True
 ) -> dict:
     infinite_doc_scroll_payload = {
         "end": end,
         "folderId": folder_id,
         "getNewListing": True,
         "repoName": repo,
-        "sortAscending": True,
-        "sortColumn": "",
+        "sortAscending": sort_ascending,
+        "sortColumn": sort_column,
         "start": start
     }
 
     response = session.post(url, headers=headers, json=infinite_doc_scroll_payload)
     response_obj = response.json()
     response_data = response_obj['data']
-    print(f"{repo}/{folder_id} folder content:\n" + json.dumps(response_data, indent=4))
+    logger.debug("Listed %s/%s rows %s-%s of %s", repo, folder_id, start, end, response_data.get('totalEntries'))
     return response_data
 
 
+def get_listing_page_size(repo: str) -> int:
+    """
+    Rows to ask for per listing page in repo - learned by the page sizer (api/page_size.py) if it's switched on.
+    """
+    page_sizer = get_page_sizer()
+    return page_sizer.get_page_size(repo) if page_sizer is not None else increment
+
+
+def request_folder_page(
+    repo: str,
+    folder_id: int,
+    start: int,
+    end: int,
+    sort_column: str = "",
+    sort_ascending: bool = True
+) -> dict:
+    """
+    request_folder_results for one listing window, feeding how it went back to the page sizer. If the server sends back
+    fewer rows than the window should hold (i.e. it caps windows below the size we asked for), the rest of the window
+    is requested too, so callers always get complete pages no matter what page size they picked.
+    """
+    page_sizer = get_page_sizer()
+    request_started = time.monotonic()
+
+    try:
+        page = request_folder_results(repo=repo, folder_id=folder_id, start=start, end=end, sort_column=sort_column,
+                                      sort_ascending=sort_ascending)
+    except requests.exceptions.RequestException:
+        if page_sizer is not None:
+            page_sizer.record(repo, page_size=end - start, latency=time.monotonic() - request_started,
+                              rows_requested=end - start, rows_returned=0, failed=True)
+        raise
+
+    results = list(page['results'] or [])
+    rows_requested = max(0, min(end, page['totalEntries']) - start)
+    short = 0 < len(results) < rows_requested
+
+    if page_sizer is not None:
+        page_sizer.record(repo, page_size=end - start, latency=time.monotonic() - request_started,
+                          rows_requested=rows_requested, rows_returned=len(results), short=short)
+
+    while 0 < len(results) < rows_requested:
+        rest = request_folder_results(repo=repo, folder_id=folder_id, start=start + len(results), end=end,
+                                      sort_column=sort_column, sort_ascending=sort_ascending)
+        if not rest['results']:
+            break
+        results.extend(rest['results'])
+
+    return {**page, "results": results}
+
+
 class FolderContentsDict(TypedDict):
     folders: list[dict]
     documents: list[dict]
 
 
-def get_folder_contents(
+class ListingContentsDict(TypedDict):
+    folders: list["ListingEntry"]
+    documents: list["ListingEntry"]
+
+
+def is_document_entry(result: typing.Optional[dict]) -> bool:
+    return result is not None and result['targetType'] == 0 and result['type'] == -1
+
+
+def is_folder_entry(result: typing.Optional[dict]) -> bool:
+    return result is not None and result['targetType'] == 0 and result['type'] == 0
+
+
+def get_entry_last_modified(result: dict) -> typing.Optional[str]:
+    """
+    The "data" field of a listing row is a positional list of (mostly duplicative) column values. Indexes 10 and 11
+    both appear to be the entry's last modified date, e.g. "1/6/2020 3:45:52 PM".
+    """
+    data = result.get('data') or []
+    return data[10] if len(data) > 10 else None
+
+
+def parse_remote_datetime(value: str) -> datetime:
+    """
+    Parses PaperFiche's date format (e.g. "1/6/2020 3:45:52 PM"). The result is naive - it's in the server's local time.
+    """
+    return datetime.strptime(value, remote_datetime_format)
+
+
+def get_entry_page_count(result: dict) -> int:
+    """
+    Index 1 of a listing row's "data" is the entry's page count (0 for folders).
+    """
+    data = result.get('data') or []
+    try:
+        return int(data[1])
+    except (IndexError, TypeError, ValueError):
+        return 0
+
+
+class ListingEntry(typing.NamedTuple):
+    """
+    Compact, typed form of a folder listing row. Raw rows are dicts holding a positional "data" list of (mostly
+    duplicative) column values, which adds up to a lot of small objects per row. A ListingEntry keeps just the columns
+    we use, with the modified date already parsed. Anything that needs the raw row (e.g. for Document.source_json)
+    should work from the listing rows themselves (see iter_folder_listing).
+    """
+    entry_id: int
+    name: str
+    type: int
+    target_type: int
+    page_count: int
+    modified: typing.Optional[datetime]  # Naive, in the server's local time (see parse_remote_datetime)
+    parent_id: typing.Optional[int]
+
+    @classmethod
+    def from_row(cls, result: dict, parent_id: typing.Optional[int] = None) -> "ListingEntry":
+        """
+        :param result: Listing row, as returned by GetFolderListing2
+        :param parent_id: Folder the row was listed in. Defaults to the row's own parentId, if it has one.
+        """
+        modified_string = get_entry_last_modified(result)
+        return cls(
+            entry_id=result['entryId'],
+            name=result.get('name'),
+            type=result['type'],
+            target_type=result['targetType'],
+            page_count=get_entry_page_count(result),
+            modified=parse_remote_datetime(modified_string) if modified_string else None,
+            parent_id=parent_id if parent_id is not None else result.get('parentId')
+        )
+
+    @property
+    def is_folder(self) -> bool:
+        return self.target_type == 0 and self.type == 0
+
+    @property
+    def is_document(self) -> bool:
+        return self.target_type == 0 and self.type == -1
+
+
+def get_remaining_page_windows(total_entries: int, page_size: int = increment) -> list[tuple[int, int]]:
+    """
+    Given the totalEntries reported by the first listing page (start=0, end=page_size), returns the (start, end)
+    windows still needed to page through the rest of the folder.
+    """
+    return [(page_start, page_start + page_size) for page_start in range(page_size, total_entries + 1, page_size)]
+
+
+def iter_folder_listing(
     repo: str,
-    folder_id: int
-) -> FolderContentsDict:
+    folder_id: int,
+    max_concurrency: int = max_concurrent_requests
+) -> typing.Iterator[dict]:
     """
-    Uses PaperFiche's undocumented "API" to retrieve the contents of a folder from the Fort
-    Worth system.
+    Yields the folder and document rows directly inside folder_id, in listing order, as each listing page arrives.
 
     :param repo: The folders we're querying exist inside of a parent repo. Not sure what the others other.
-    :param folder_id: Folder ID we want to fetch. These are available as part
-    :return:
+    :param folder_id: Folder ID we want to fetch.
+    :param max_concurrency: Max number of listing pages to request at the same time.
     """
 
-    print(f"\n\nGet folder contents for {repo}/{folder_id}")
+    logger.debug("Get folder contents for %s/%s", repo, folder_id)
 
-    increment = 40
-    start = 0
-    end = start + increment
-
-    initial_results = request_folder_results(
+    page_size = get_listing_page_size(repo)
+    initial_results = request_folder_page(
         repo=repo,
         folder_id=folder_id,
-        start=start,
-        end=end
+        start=0,
+        end=page_size
     )
 
-    print(f"Raw api response: {initial_results}")
-
     total_entries = initial_results['totalEntries']
-    entries = initial_results['results']
 
-    print(f"Initial results: {entries}")
-
-    doc_results = list(filter(lambda result: result is not None and result['targetType'] == 0 and
-                                             result['type'] == -1, entries))
-    folder_results = list(filter(lambda result: result is not None and result['targetType'] == 0 and
-                                                result['type'] == 0,
-                                 entries))
     # I don't fully understand what a "shortcut" is, but I noticed that there is one entryId (188177) that fails when
     # processed as a folder or doc... you get this response when trying to crawl it:
     #
@@ -465,39 +786,129 @@ def get_folder_contents(
     # Based on hundreds of examples, it's the only entry (so far) that is has property "type": -1.
     # I think the best way to investigate the right API call is to find this entry in the GUI (title: "Contract 36651
     # Volume 1")
+    for entry in initial_results['results'] or []:
+        if is_folder_entry(entry) or is_document_entry(entry):
+            yield entry
+
+    # Once we know totalEntries, the rest of the pages can be requested at once. The pool size caps how many are in
+    # flight, and map() hands results back in page order, so the listing order is the same as fetching serially.
+    remaining_windows = get_remaining_page_windows(total_entries=total_entries, page_size=page_size)
+    if not remaining_windows:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=min(max_concurrency, len(remaining_windows)))
+    try:
+        subsequent_pages = executor.map(
+            lambda window: request_folder_page(
+                repo=repo,
+                folder_id=folder_id,
+                start=window[0],
+                end=window[1]
+            ),
+            remaining_windows
+        )
+
+        for subsequent_results in subsequent_pages:
+            for entry in subsequent_results['results'] or []:
+                if is_folder_entry(entry) or is_document_entry(entry):
+                    yield entry
+    finally:
+        # If the consumer stops early, don't sit around waiting on pages nobody is going to read
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def get_folder_changes_since(
+    repo: str,
+    folder_id: int,
+    since: datetime,
+    page_size: typing.Optional[int] = None
+) -> typing.Optional[tuple[int, list[dict]]]:
+    """
+    Lists folder_id newest-first (sorted by modified date, descending) and stops paging as soon as rows are older
+    than since, so finding the handful of changes in a big folder takes a page or two instead of the whole listing.
+
+    :param repo: Repository the folder lives in (e.g. "City-Secretary")
+    :param folder_id: Folder to check for changes
+    :param since: High-water mark - the newest modified date we've already seen in this folder
+    :param page_size: Rows per listing page (defaults to get_listing_page_size)
+    :return: (totalEntries reported for the folder, less the rows we saw that are neither folders nor documents, and
+    the folder and document rows modified at or after since), or None if the server didn't honor the sort, in which
+    case callers need to fall back to a full listing.
+    """
+
+    if page_size is None:
+        page_size = get_listing_page_size(repo)
 
-    while end <= total_entries:
-        start = start + increment
-        end = end + increment
+    changed_entries = []
+    skipped_entries = 0
+    previous_modified = None
+    page_start = 0
 
-        subsequent_results = request_folder_results(
+    while True:
+        page = request_folder_page(
             repo=repo,
             folder_id=folder_id,
-            start=start,
-            end=end
+            start=page_start,
+            end=page_start + page_size,
+            sort_column=modified_sort_column,
+            sort_ascending=False
         )
 
-        # Looks like maybe this thing has a rate throttle. Slow it down a bit.
-        time.sleep(.5)
+        if page.get('sortColumn') != modified_sort_column or page.get('sortAscending'):
+            return None
+
+        for entry in page['results'] or []:
+            if entry is None:
+                skipped_entries += 1
+                continue
+
+            modified_string = get_entry_last_modified(entry)
+            if modified_string is None:
+                return None
+
+            # The server said it sorted, but make sure
+            modified = parse_remote_datetime(modified_string)
+            if previous_modified is not None and modified > previous_modified:
+                return None
+            previous_modified = modified
+
+            if modified < since:
+                return page['totalEntries'] - skipped_entries, changed_entries
+
+            if is_folder_entry(entry) or is_document_entry(entry):
+                changed_entries.append(entry)
+            else:
+                skipped_entries += 1
 
-        print(f"Subsequent results from {start} to {end}: {subsequent_results}")
+        page_start += page_size
+        if page_start > page['totalEntries']:
+            return page['totalEntries'] - skipped_entries, changed_entries
 
-        doc_results = doc_results + list(filter(lambda result: result is not None and result['targetType'] == 0 and
-                                                               result['type'] == -1, subsequent_results['results']))
-        folder_results = folder_results + list(
-            filter(lambda result: result is not None and result['targetType'] == 0 and
-                                  result['type'] == 0, subsequent_results['results']))
 
-        print(f"Doc results: {doc_results}")
-        print(f"Folder results: {folder_results}")
+def get_folder_contents(
+    repo: str,
+    folder_id: int,
+    max_concurrency: int = max_concurrent_requests
+) -> ListingContentsDict:
+    """
+    Uses PaperFiche's undocumented "API" to retrieve the contents of a folder from the Fort
+    Worth system.
 
-    with open("folders.json", "w+") as folders_file:
-        for folder in folder_results:
-            folders_file.writelines(json.dumps(folder))
+    :param repo: The folders we're querying exist inside of a parent repo. Not sure what the others other.
+    :param folder_id: Folder ID we want to fetch. These are available as part
+    :param max_concurrency: Max number of listing pages to request at the same time.
+    :return: Folders and documents directly inside the folder, as ListingEntry
+    """
 
-    with open("documents.json", "w+") as documents_file:
-        for document in doc_results:
-            documents_file.writelines(json.dumps(document))
+    doc_results = []
+    folder_results = []
+
+    for row in iter_folder_listing(repo=repo, folder_id=folder_id, max_concurrency=max_concurrency):
+        entry = ListingEntry.from_row(row, parent_id=folder_id)
+        if entry.is_folder:
+            folder_results.append(entry)
+        else:
+            doc_results.append(entry)
 
     return {
         "folders": folder_results,
@@ -506,42 +917,125 @@ def get_folder_contents(
 
 
 # CRAWLER ##############################################################################################################
-def crawl_directory_recursively(
+
+CrawlStrategy = typing.Literal["bfs", "dfs"]
+
+# Called once a folder's listing is complete with (folder_id, the folder's entries, ids of every folder still waiting
+# to be listed). That's everything needed to checkpoint a crawl and later pick it back up (see crawls/checkpoints.py).
+FolderCompleteCallback = typing.Callable[[int, list[dict], list[int]], None]
+
+# Called with each subfolder row as it's listed. Returning False leaves that subfolder (and everything under it) out of
+# the crawl, which is how incremental crawls skip unchanged subtrees (see crawls/incremental.py).
+ShouldDescendCallback = typing.Callable[[dict], bool]
+
+# Lists the folder and document rows in a folder. Defaults to iter_folder_listing, but incremental crawls swap in one
+# that only asks the server for what changed.
+ListFolderCallback = typing.Callable[[int], typing.Iterable[dict]]
+
+
+def iter_crawl(
     repo: str,
     folder_id: int,
-) -> FolderContentsDict:
+    strategy: CrawlStrategy = "dfs",
+    max_concurrency: int = max_concurrent_requests,
+    frontier: typing.Optional[typing.Iterable[int]] = None,
+    on_folder_complete: typing.Optional[FolderCompleteCallback] = None,
+    should_descend: typing.Optional[ShouldDescendCallback] = None,
+    list_folder: typing.Optional[ListFolderCallback] = None
+) -> typing.Iterator[dict]:
+    """
+    Streams the crawl of every folder under folder_id: each folder and document row is yielded as soon as the listing
+    page it's on arrives, so consumers can start work (and keep memory bounded) long before the crawl finishes. Use
+    is_folder_entry / is_document_entry to tell the rows apart.
+
+    Works from an explicit frontier of folders still to be listed rather than recursing, so tree depth is no concern.
+
+    :param repo: Repository the folder lives in (e.g. "City-Secretary")
+    :param folder_id: Root folder to crawl
+    :param strategy: "dfs" lists a folder's whole subtree before moving on to its next sibling (same result order as
+    the old recursive crawler). "bfs" lists the tree level by level.
+    :param max_concurrency: Max number of listing pages to request at the same time for a single folder.
+    :param frontier: Folders still to be listed when resuming an interrupted crawl. Defaults to just folder_id.
+    :param on_folder_complete: Optional hook called each time a folder has been fully listed.
+    :param should_descend: Optional filter deciding which subfolders get listed. All of them by default.
+    :param list_folder: Optional replacement for iter_folder_listing.
+    """
 
     # FYI.. the "data" field for a document json has a list of (mostly duplicative values). The 10th and 11th
     # index of that array appear to BOTH be the last modified date of the doc with given entryId, so you do NOT
     # need to request the metadata separately to check if doc has been modified.
 
-    results = get_folder_contents(
-        repo=repo,
-        folder_id=folder_id
-    )
+    pending: typing.Deque[int] = deque([folder_id] if frontier is None else frontier)
 
-    for subfolder in results['folders']:
-        sub_results = crawl_directory_recursively(
-            repo=repo,
-            folder_id=subfolder['entryId']
-        )
+    while pending:
+        current_folder_id = pending.popleft()
+        subfolder_ids = []
+        folder_entries = []
 
-        print(f"Subdirectory {folder_id} docs: {sub_results['documents']}")
-        print(f"Subdirectory {folder_id} folders: {sub_results['folders']}")
+        if list_folder is None:
+            listing = iter_folder_listing(repo=repo, folder_id=current_folder_id, max_concurrency=max_concurrency)
+        else:
+            listing = list_folder(current_folder_id)
+
+        for entry in listing:
+            if is_folder_entry(entry) and (should_descend is None or should_descend(entry)):
+                subfolder_ids.append(entry['entryId'])
+            if on_folder_complete is not None:
+                folder_entries.append(entry)
+            yield entry
+
+        if strategy == "dfs":
+            # Front of the queue, in listing order, so the first subfolder is the next one we list
+            pending.extendleft(reversed(subfolder_ids))
+        else:
+            pending.extend(subfolder_ids)
 
-        results['documents'] = [
-            *results['documents'],
-            *sub_results['documents']
-        ]
+        if on_folder_complete is not None:
+            on_folder_complete(current_folder_id, folder_entries, list(pending))
 
-        results['folders'] = [
-            *results['folders'],
-            *sub_results['folders']
-        ]
+
+def crawl_directory(
+    repo: str,
+    folder_id: int,
+    strategy: CrawlStrategy = "dfs"
+) -> FolderContentsDict:
+    """
+    Crawls every folder under folder_id (see iter_crawl) and collects the results.
+
+    :param repo: Repository the folder lives in (e.g. "City-Secretary")
+    :param folder_id: Root folder to crawl
+    :param strategy: "dfs" or "bfs", see iter_crawl
+    :return: Every folder and document under folder_id
+    """
+
+    results: FolderContentsDict = {
+        "folders": [],
+        "documents": [],
+    }
+
+    for entry in iter_crawl(repo=repo, folder_id=folder_id, strategy=strategy):
+        if is_folder_entry(entry):
+            results['folders'].append(entry)
+        else:
+            results['documents'].append(entry)
 
     return results
 
 
+def crawl_directory_recursively(
+    repo: str,
+    folder_id: int,
+) -> FolderContentsDict:
+    """
+    Kept for existing callers. Despite the name, this is now the iterative, depth-first crawl_directory.
+    """
+    return crawl_directory(
+        repo=repo,
+        folder_id=folder_id,
+        strategy="dfs"
+    )
+
+
 # folder_contents = get_folder_contents(
 #     repo="City-Secretary",
 #     folder_id=root_contract_folder_id
@@ -0,0 +1,195 @@
+#  Copyright (C) 2022  John Scrudato / Gordium Knot Inc. d/b/a OpenSource.Legal
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import threading
+import time
+import typing
+
+# Logging setup
+logger = logging.getLogger(__name__)
+
+# Listing window sizes we'll try, smallest first. The smallest is the window the PaperFiche UI itself asks for, so it's
+# known to work and is what we fall back to.
+page_size_ladder = (40, 80, 160, 320, 640, 1000)
+default_page_size = page_size_ladder[0]
+
+max_page_latency = 10.0  # seconds - a full page slower than this counts against its window size
+probe_after_pages = 20  # healthy full pages in a row at the current size before we try the next size up
+probe_tolerance = 1.1  # a bigger window is kept if its time per row is no worse than this times the current size's
+failed_size_cooldown = 60 * 60  # seconds before we try a window size that failed again
+latency_smoothing = 0.2  # weight of each new page in the running average page latency
+
+# Learned sizes are kept in Django's cache (so they're shared by workers and survive restarts)
+cache_key_prefix = "paperfiche:page_size"
+cache_timeout = 7 * 24 * 60 * 60
+
+
+class PageSizeState:
+    def __init__(self, page_size: int):
+        self.page_size = page_size
+        self.probe_size: typing.Optional[int] = None
+        self.healthy_pages = 0
+        self.average_latency: typing.Optional[float] = None  # of full pages at page_size
+        self.ceiling: typing.Optional[int] = None  # smallest window size that's failed recently
+        self.ceiling_until = 0.0
+
+
+class AdaptivePageSizer:
+    """
+    Picks the listing window size (rows per GetFolderListing2 request) for each repo. Starting from the last size
+    learned for the repo, it steps up the ladder one size at a time after a run of healthy pages, keeping the bigger
+    window only if it comes back without errors, within max_page_latency and without costing more time per row. Errors,
+    slow pages or the server returning fewer rows than asked for step the size back down and put a ceiling on it for a
+    while.
+
+    Only full pages count towards the good stats - the last page of a folder (or a small folder) doesn't say much about
+    how the server handles a given window size.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._states: dict[str, PageSizeState] = {}
+
+    def _cache_key(self, repo: str) -> str:
+        return f"{cache_key_prefix}:{repo}"
+
+    def _state(self, repo: str) -> PageSizeState:
+        state = self._states.get(repo)
+        if state is None:
+            page_size = default_page_size
+            if self.cache is not None:
+                try:
+                    page_size = int(self.cache.get(self._cache_key(repo)) or default_page_size)
+                except Exception as e:
+                    logger.warning("Could not load learned page size for %s: %s", repo, e)
+            state = self._states[repo] = PageSizeState(page_size)
+        return state
+
+    def _save(self, repo: str, state: PageSizeState):
+        if self.cache is not None:
+            try:
+                self.cache.set(self._cache_key(repo), state.page_size, cache_timeout)
+            except Exception as e:
+                logger.warning("Could not store learned page size for %s: %s", repo, e)
+
+    def _ceiling(self, state: PageSizeState) -> typing.Optional[int]:
+        if state.ceiling is not None and time.monotonic() >= state.ceiling_until:
+            state.ceiling = None
+        return state.ceiling
+
+    def get_page_size(self, repo: str) -> int:
+        with self._lock:
+            state = self._state(repo)
+            return state.probe_size or state.page_size
+
+    def record(self, repo: str, page_size: int, latency: float, rows_requested: int, rows_returned: int,
+               failed: bool = False, short: bool = False):
+        """
+        Feeds back how a listing page went.
+
+        :param page_size: Window size the page was requested with (get_page_size at the time)
+        :param latency: Seconds the request took
+        :param rows_requested: Rows the page should have held (less than page_size for a folder's last page)
+        :param rows_returned: Rows the server actually sent back
+        :param failed: The request raised
+        :param short: The server sent back fewer rows than it should have (it caps windows below page_size)
+        """
+        with self._lock:
+            state = self._state(repo)
+            full_page = rows_requested >= page_size
+
+            if failed or short or (full_page and latency > max_page_latency):
+                self._step_down(repo, state, page_size, rows_returned if short else None)
+                return
+
+            if not full_page:
+                return
+
+            if page_size == state.probe_size:
+                per_row_latency = latency / page_size
+                current_per_row_latency = (state.average_latency or latency) / state.page_size
+                if per_row_latency <= current_per_row_latency * probe_tolerance:
+                    logger.info("Listing page size for %s raised from %s to %s", repo, state.page_size, page_size)
+                    state.page_size = page_size
+                    state.average_latency = latency
+                    self._save(repo, state)
+                else:
+                    self._set_ceiling(state, page_size)
+                state.probe_size = None
+                state.healthy_pages = 0
+                return
+
+            if page_size != state.page_size:
+                return
+
+            state.average_latency = latency if state.average_latency is None else \
+                state.average_latency * (1 - latency_smoothing) + latency * latency_smoothing
+            state.healthy_pages += 1
+
+            if state.healthy_pages >= probe_after_pages and state.probe_size is None:
+                next_size = next((size for size in page_size_ladder if size > state.page_size), None)
+                ceiling = self._ceiling(state)
+                if next_size is not None and (ceiling is None or next_size < ceiling):
+                    state.probe_size = next_size
+                state.healthy_pages = 0
+
+    def _set_ceiling(self, state: PageSizeState, page_size: int):
+        ceiling = self._ceiling(state)
+        state.ceiling = page_size if ceiling is None else min(ceiling, page_size)
+        state.ceiling_until = time.monotonic() + failed_size_cooldown
+
+    def _step_down(self, repo: str, state: PageSizeState, page_size: int, rows_returned: typing.Optional[int]):
+        self._set_ceiling(state, page_size)
+        state.probe_size = None
+        state.healthy_pages = 0
+
+        if page_size < state.page_size:
+            return
+
+        smaller_sizes = [size for size in page_size_ladder if size < page_size]
+        if rows_returned:
+            # The server told us how many rows it's willing to send - no point asking for more
+            smaller_sizes = [size for size in smaller_sizes if size <= rows_returned]
+        new_page_size = smaller_sizes[-1] if smaller_sizes else default_page_size
+
+        if new_page_size != state.page_size:
+            logger.info("Listing page size for %s lowered from %s to %s", repo, state.page_size, new_page_size)
+            state.page_size = new_page_size
+            state.average_latency = None
+            self._save(repo, state)
+
+
+_page_sizer: typing.Optional[AdaptivePageSizer] = None
+
+
+def get_page_sizer() -> typing.Optional[AdaptivePageSizer]:
+    """
+    Lazily builds the shared page sizer, persisting learned sizes to Django's default cache. Returns None if adaptive
+    page sizes are switched off (CRAWLER_ADAPTIVE_PAGE_SIZE_ENABLED) or there are no Django settings to configure it
+    from, in which case listings use default_page_size.
+    """
+    global _page_sizer
+
+    if _page_sizer is None:
+        from django.conf import settings
+
+        if not settings.configured or not getattr(settings, "CRAWLER_ADAPTIVE_PAGE_SIZE_ENABLED", False):
+            return None
+
+        from django.core.cache import cache
+        _page_sizer = AdaptivePageSizer(cache)
+
+    return _page_sizer
@@ -0,0 +1,220 @@
+#  Copyright (C) 2022  John Scrudato / Gordium Knot Inc. d/b/a OpenSource.Legal
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import logging
+import time
+import typing
+from urllib.parse import urlparse
+
+import redis
+
+# Logging setup
+logger = logging.getLogger(__name__)
+
+
+class EndpointLimit(typing.NamedTuple):
+    initial_rate: float  # requests / second we start at (and reset to when the bucket expires)
+    min_rate: float  # floor we back off to
+    max_rate: float  # ceiling we speed up to
+    burst: float  # max tokens the bucket can hold
+
+
+# Limits are shared by every worker process (they live in redis), so these are fleet-wide numbers, not per-worker.
+endpoint_limits: dict[str, EndpointLimit] = {
+    "GetFolderListing2": EndpointLimit(initial_rate=4, min_rate=0.5, max_rate=25, burst=8),
+    "GetBasicDocumentInfo": EndpointLimit(initial_rate=4, min_rate=0.5, max_rate=25, burst=8),
+    "StartExport": EndpointLimit(initial_rate=1, min_rate=0.1, max_rate=5, burst=2),
+    "CheckExportStatus": EndpointLimit(initial_rate=4, min_rate=0.5, max_rate=20, burst=8),
+    "GetExportJob": EndpointLimit(initial_rate=1, min_rate=0.1, max_rate=5, burst=2),
+    # Single document (page range) exports
+    "GeneratePDF10": EndpointLimit(initial_rate=1, min_rate=0.1, max_rate=5, burst=2),
+    "PDFTransition": EndpointLimit(initial_rate=4, min_rate=0.5, max_rate=20, burst=8),
+    "PDF10": EndpointLimit(initial_rate=1, min_rate=0.1, max_rate=5, burst=2),
+}
+default_endpoint_limit = EndpointLimit(initial_rate=2, min_rate=0.25, max_rate=10, burst=4)
+
+# Additive increase / multiplicative decrease tuning
+rate_increase_step = 0.1  # requests / second added after each healthy response
+rate_decrease_factor = 0.5  # rate multiplier after a 429 / 5xx or a latency spike
+latency_spike_factor = 2.0  # a response this many times slower than the running average counts as a spike
+throttled_statuses = frozenset([429, 500, 502, 503, 504])
+redis_retry_interval = 30  # seconds to run unthrottled after redis errors before trying it again
+
+# Reserve a token. The bucket is allowed to go negative, which acts as a fleet-wide queue: each caller is told how
+# long to wait for its reservation to come due rather than spinning on redis until a token frees up.
+#
+# KEYS[1] - bucket hash
+# ARGV    - initial_rate, burst
+ACQUIRE_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate')
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local rate = tonumber(bucket[3]) or tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - 1
+
+local wait = 0
+if tokens < 0 then
+    wait = -tokens / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now), 'rate', tostring(rate))
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+# Adjust the bucket's refill rate based on how the server handled a request.
+#
+# KEYS[1] - bucket hash
+# ARGV    - throttled (0/1), latency, initial_rate, min_rate, max_rate, increase_step, decrease_factor, spike_factor
+RECORD_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'rate', 'latency')
+local throttled = tonumber(ARGV[1]) == 1
+local latency = tonumber(ARGV[2])
+local rate = tonumber(bucket[1]) or tonumber(ARGV[3])
+local average_latency = tonumber(bucket[2])
+
+if throttled or (average_latency and latency > average_latency * tonumber(ARGV[8])) then
+    rate = math.max(tonumber(ARGV[4]), rate * tonumber(ARGV[7]))
+else
+    rate = math.min(tonumber(ARGV[5]), rate + tonumber(ARGV[6]))
+end
+
+if average_latency then
+    average_latency = average_latency * 0.8 + latency * 0.2
+else
+    average_latency = latency
+end
+
+redis.call('HSET', KEYS[1], 'rate', tostring(rate), 'latency', tostring(average_latency))
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(rate)
+"""
+
+
+def endpoint_for_url(url: str) -> str:
+    """
+    Maps a PaperFiche url to the endpoint name we rate limit it under, e.g.
+
+    .../FolderListingService.aspx/GetFolderListing2        -> GetFolderListing2
+    .../ExportJobHandler.aspx/GetExportJob/?token=...      -> GetExportJob
+    .../PDF10/{key}/{entry_id}                             -> PDF10
+    """
+    path_parts = [part for part in urlparse(url).path.split("/") if part]
+    for part in path_parts:
+        if part in endpoint_limits:
+            return part
+    return path_parts[-1].removesuffix(".aspx") if path_parts else "default"
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket per endpoint, stored in redis so every Celery worker draws from the same buckets. Each bucket's refill
+    rate creeps up while responses are healthy and is cut back on 429s, 5xxs or latency spikes (AIMD).
+
+    Redis trouble never blocks a request - if the limiter can't talk to redis, requests go out unthrottled.
+    """
+
+    def __init__(self, redis_client: redis.Redis, key_prefix: str = "paperfiche:rate_limit"):
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._record = redis_client.register_script(RECORD_SCRIPT)
+        # After a redis error, skip the limiter for a bit instead of paying a connection timeout on every request
+        self._unavailable_until = 0.0
+
+    def _key(self, endpoint: str) -> str:
+        return f"{self.key_prefix}:{endpoint}"
+
+    def acquire(self, endpoint: str) -> float:
+        """
+        Blocks until the endpoint's bucket has a token for us. Returns the number of seconds we waited.
+        """
+        if time.monotonic() < self._unavailable_until:
+            return 0.0
+
+        limit = endpoint_limits.get(endpoint, default_endpoint_limit)
+        try:
+            wait = float(self._acquire(keys=[self._key(endpoint)], args=[limit.initial_rate, limit.burst]))
+        except redis.RedisError as e:
+            logger.warning("Rate limiter unavailable, not throttling %s: %s", endpoint, e)
+            self._unavailable_until = time.monotonic() + redis_retry_interval
+            return 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def record(self, endpoint: str, latency: float, throttled: bool) -> typing.Optional[float]:
+        """
+        Feeds the outcome of a request back into the endpoint's bucket. Returns the new rate (requests / second).
+        """
+        if time.monotonic() < self._unavailable_until:
+            return None
+
+        limit = endpoint_limits.get(endpoint, default_endpoint_limit)
+        try:
+            return float(self._record(
+                keys=[self._key(endpoint)],
+                args=[
+                    1 if throttled else 0,
+                    latency,
+                    limit.initial_rate,
+                    limit.min_rate,
+                    limit.max_rate,
+                    rate_increase_step,
+                    rate_decrease_factor,
+                    latency_spike_factor,
+                ]
+            ))
+        except redis.RedisError as e:
+            logger.warning("Rate limiter unavailable, could not record %s response: %s", endpoint, e)
+            self._unavailable_until = time.monotonic() + redis_retry_interval
+            return None
+
+
+def response_was_throttled(response) -> bool:
+    """
+    True if the server pushed back on this request, including on attempts urllib3's Retry already retried for us.
+    """
+    if response.status_code in throttled_statuses:
+        return True
+    retries = getattr(response.raw, "retries", None)
+    return any(attempt.status in throttled_statuses for attempt in getattr(retries, "history", ()))
+
+
+_rate_limiter: typing.Optional[AdaptiveRateLimiter] = None
+
+
+def get_rate_limiter() -> typing.Optional[AdaptiveRateLimiter]:
+    """
+    Lazily builds the shared limiter on the redis instance behind CELERY_BROKER_URL. Returns None if rate limiting is
+    switched off (CRAWLER_RATE_LIMIT_ENABLED) or there are no Django settings to configure it from.
+    """
+    global _rate_limiter
+
+    if _rate_limiter is None:
+        from django.conf import settings
+
+        if not settings.configured or not getattr(settings, "CRAWLER_RATE_LIMIT_ENABLED", False):
+            return None
+
+        _rate_limiter = AdaptiveRateLimiter(
+            redis.Redis.from_url(settings.CELERY_BROKER_URL, socket_timeout=2, socket_connect_timeout=2)
+        )
+
+    return _rate_limiter
@@ -0,0 +1,510 @@
+import io
+import itertools
+import os
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from urllib3.util.retry import RequestHistory
+
+import fakeredis
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+
+from fort_worth_crawler.api import async_client, cache, client, page_size, rate_limit
+
+
+def fake_listing_data(name: str, entry_id: int, modified: str = "1/6/2020 3:45:52 PM") -> list:
+    return [name, 1, None, None, None, None, entry_id, None, None, None, modified, modified]
+
+
+def build_fake_tree(depth: int, folders_per_folder: int, documents_per_folder: int) -> dict[int, list[dict]]:
+    """
+    Builds a fake PaperFiche folder tree as {folder_id: [listing rows]}, rooted at folder 1.
+    """
+    tree: dict[int, list[dict]] = {}
+    next_id = 2
+    level = [1]
+
+    for current_depth in range(depth + 1):
+        next_level = []
+        for folder_id in level:
+            rows = []
+            if current_depth < depth:
+                for _ in range(folders_per_folder):
+                    rows.append({"entryId": next_id, "name": f"Folder {next_id}", "type": 0, "targetType": 0,
+                                 "data": fake_listing_data(f"Folder {next_id}", next_id)})
+                    next_level.append(next_id)
+                    next_id += 1
+            for _ in range(documents_per_folder):
+                rows.append({"entryId": next_id, "name": f"Document {next_id}", "type": -1, "targetType": 0,
+                             "data": fake_listing_data(f"Document {next_id}", next_id)})
+                next_id += 1
+            tree[folder_id] = rows
+        level = next_level
+
+    return tree
+
+
+def fake_request_folder_results(tree: dict[int, list[dict]], honor_sort: bool = True):
+    def request_folder_results(repo: str, folder_id: int, start: int, end: int, sort_column: str = "",
+                               sort_ascending: bool = True) -> dict:
+        rows = tree[folder_id]
+        if not honor_sort:
+            sort_column, sort_ascending = "", True
+        if sort_column == client.modified_sort_column:
+            rows = sorted(rows, key=lambda row: client.parse_remote_datetime(client.get_entry_last_modified(row)),
+                          reverse=not sort_ascending)
+        return {"folderId": folder_id, "totalEntries": len(rows), "results": rows[start:end],
+                "sortColumn": sort_column, "sortAscending": sort_ascending}
+    return request_folder_results
+
+
+def test_async_crawl_matches_recursive_crawl(monkeypatch, tmp_path):
+    tree = build_fake_tree(depth=3, folders_per_folder=3, documents_per_folder=45)
+    monkeypatch.setattr(client, "request_folder_results", fake_request_folder_results(tree))
+    monkeypatch.chdir(tmp_path)
+
+    recursive_results = client.crawl_directory(repo="City-Secretary", folder_id=1)
+    concurrent_results = async_client.crawl_directory_concurrently(repo="City-Secretary", folder_id=1,
+                                                                   max_concurrency=4)
+
+    assert len(concurrent_results['folders']) == 3 + 9 + 27
+    assert sorted(row['entryId'] for row in concurrent_results['folders']) == \
+        sorted(row['entryId'] for row in recursive_results['folders'])
+    assert sorted(row['entryId'] for row in concurrent_results['documents']) == \
+        sorted(row['entryId'] for row in recursive_results['documents'])
+
+
+def test_async_crawl_checkpoints_never_drop_in_flight_folders(monkeypatch):
+    tree = build_fake_tree(depth=3, folders_per_folder=3, documents_per_folder=2)
+    list_folder = fake_request_folder_results(tree)
+    delays = itertools.cycle([0.002, 0.0, 0.005, 0.001, 0.003])
+
+    def slow_request_folder_results(*args, **kwargs) -> dict:
+        time.sleep(next(delays))
+        return list_folder(*args, **kwargs)
+
+    monkeypatch.setattr(client, "request_folder_results", slow_request_folder_results)
+    subfolder_ids = {
+        folder_id: [row['entryId'] for row in rows if row['type'] == 0] for folder_id, rows in tree.items()
+    }
+    completed = set()
+    lost_folders = []
+
+    def on_folder_complete(folder_id: int, entries: list[dict], frontier: list[int]):
+        # What a resume from this checkpoint would know about: listed folders plus the frontier
+        completed.add(folder_id)
+        known = completed | set(frontier)
+        lost_folders.extend(
+            subfolder_id for listed_folder_id in completed for subfolder_id in subfolder_ids[listed_folder_id]
+            if subfolder_id not in known
+        )
+
+    results = async_client.crawl_directory_concurrently(repo="City-Secretary", folder_id=1, max_concurrency=8,
+                                                        on_folder_complete=on_folder_complete)
+
+    assert completed == set(tree)
+    assert lost_folders == []
+    # The rows only went to on_folder_complete
+    assert results == {"folders": [], "documents": []}
+
+
+def test_remaining_page_windows_cover_folder():
+    assert client.get_remaining_page_windows(total_entries=39, page_size=40) == []
+    assert client.get_remaining_page_windows(total_entries=40, page_size=40) == [(40, 80)]
+    assert client.get_remaining_page_windows(total_entries=125, page_size=40) == [(40, 80), (80, 120), (120, 160)]
+
+
+def test_get_folder_contents_keeps_page_order(monkeypatch, tmp_path):
+    tree = build_fake_tree(depth=0, folders_per_folder=0, documents_per_folder=500)
+    monkeypatch.setattr(client, "request_folder_results", fake_request_folder_results(tree))
+    monkeypatch.chdir(tmp_path)
+
+    results = client.get_folder_contents(repo="City-Secretary", folder_id=1, max_concurrency=4)
+
+    assert [entry.entry_id for entry in results['documents']] == [row['entryId'] for row in tree[1]]
+    assert [entry.entry_id for entry in results['documents']] == [row['entryId'] for row in tree[1]]
+    # Listing a folder doesn't write anything to disk
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_listing_entry_from_row():
+    row = {"entryId": 7, "name": "Contract 7", "type": -1, "targetType": 0, "iconClass": "pdf",
+           "data": fake_listing_data("Contract 7", 7, modified="11/13/2022 1:05:09 PM")}
+    row['data'][1] = "12"
+
+    entry = client.ListingEntry.from_row(row, parent_id=3)
+
+    assert entry.is_document and not entry.is_folder
+    assert (entry.entry_id, entry.name, entry.page_count, entry.parent_id) == (7, "Contract 7", 12, 3)
+    assert entry.modified == datetime(2022, 11, 13, 13, 5, 9)
+
+    folder = client.ListingEntry.from_row({"entryId": 8, "name": "Folder 8", "type": 0, "targetType": 0, "data": []})
+    assert folder.is_folder
+    assert (folder.page_count, folder.modified, folder.parent_id) == (0, None, None)
+
+
+def test_endpoint_for_url():
+    assert rate_limit.endpoint_for_url(client.url) == "GetFolderListing2"
+    assert rate_limit.endpoint_for_url(
+        "https://publicdocuments.fortworthtexas.gov/CSODOCS/ExportJobHandler.aspx/GetExportJob/?token=abc"
+    ) == "GetExportJob"
+    assert rate_limit.endpoint_for_url(
+        "https://publicdocuments.fortworthtexas.gov/CSODOCS/PDF10/some-key/188176"
+    ) == "PDF10"
+    assert rate_limit.endpoint_for_url(
+        "https://publicdocuments.fortworthtexas.gov/CSODOCS/GeneratePDF10.aspx?key=1&PageRange=1-2"
+    ) == "GeneratePDF10"
+
+
+def test_response_was_throttled_sees_retried_attempts():
+    healthy = SimpleNamespace(status_code=200, raw=SimpleNamespace(retries=SimpleNamespace(history=())))
+    retried = SimpleNamespace(status_code=200, raw=SimpleNamespace(retries=SimpleNamespace(history=(
+        RequestHistory(method="POST", url=client.url, error=None, status=429, redirect_location=None),
+    ))))
+
+    assert not rate_limit.response_was_throttled(healthy)
+    assert rate_limit.response_was_throttled(retried)
+    assert rate_limit.response_was_throttled(SimpleNamespace(status_code=503, raw=None))
+
+
+def fake_response(status_code: int) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.raw = io.BytesIO(b"{}")
+    return response
+
+
+class RecordingRateLimiter:
+    def __init__(self):
+        self.calls = []
+
+    def acquire(self, endpoint: str) -> float:
+        self.calls.append(("acquire", endpoint))
+        return 0.0
+
+    def record(self, endpoint: str, latency: float, throttled: bool) -> float:
+        self.calls.append(("record", throttled))
+        return 1.0
+
+
+def test_throttled_responses_are_retried_through_the_rate_limiter(monkeypatch):
+    rate_limiter = RecordingRateLimiter()
+    responses = iter([fake_response(429), fake_response(503), fake_response(200)])
+    monkeypatch.setattr(client, "get_rate_limiter", lambda: rate_limiter)
+    monkeypatch.setattr(client, "get_response_cache", lambda: None)
+    monkeypatch.setattr(client, "throttled_retry_backoff_factor", 0)
+    monkeypatch.setattr(HTTPAdapter, "send", lambda adapter, request, **kwargs: next(responses))
+
+    response = client.adapter.send(requests.Request("POST", client.url, json={}).prepare())
+
+    assert response.status_code == 200
+    # Every attempt waits for its own token
+    assert rate_limiter.calls == [
+        ("acquire", "GetFolderListing2"), ("record", True),
+        ("acquire", "GetFolderListing2"), ("record", True),
+        ("acquire", "GetFolderListing2"), ("record", False),
+    ]
+
+    monkeypatch.setattr(client, "throttled_retry_attempts", 1)
+    responses = iter([fake_response(503), fake_response(503)])
+    with pytest.raises(requests.exceptions.RetryError):
+        client.adapter.send(requests.Request("POST", client.url, json={}).prepare())
+
+
+def test_rate_limiter_scripts_back_off_and_recover():
+    limiter = rate_limit.AdaptiveRateLimiter(fakeredis.FakeRedis(), key_prefix="test")
+    limit = rate_limit.endpoint_limits["StartExport"]
+
+    def reserve() -> float:
+        return float(limiter._acquire(keys=["test:StartExport"], args=[limit.initial_rate, limit.burst]))
+
+    # A full bucket covers a burst, after which callers are queued up behind each other at the bucket's rate
+    assert [reserve() for _ in range(limit.burst)] == [0.0] * limit.burst
+    assert 0.9 / limit.initial_rate < reserve() <= 1 / limit.initial_rate
+    assert 1.9 / limit.initial_rate < reserve() <= 2 / limit.initial_rate
+
+    # Additive increase on healthy responses, up to max_rate
+    assert limiter.record("StartExport", latency=1.0, throttled=False) == \
+        pytest.approx(limit.initial_rate + rate_limit.rate_increase_step)
+    for _ in range(100):
+        limiter.record("StartExport", latency=1.0, throttled=False)
+    assert limiter.record("StartExport", latency=1.0, throttled=False) == limit.max_rate
+
+    # Multiplicative decrease on a throttled response or a latency spike, down to min_rate
+    assert limiter.record("StartExport", latency=1.0, throttled=True) == \
+        pytest.approx(limit.max_rate * rate_limit.rate_decrease_factor)
+    assert limiter.record("StartExport", latency=10.0, throttled=False) == \
+        pytest.approx(limit.max_rate * rate_limit.rate_decrease_factor ** 2)
+    for _ in range(100):
+        limiter.record("StartExport", latency=1.0, throttled=True)
+    assert limiter.record("StartExport", latency=1.0, throttled=True) == limit.min_rate
+
+def test_crawl_directory_strategies(monkeypatch, tmp_path):
+    tree = build_fake_tree(depth=3, folders_per_folder=2, documents_per_folder=2)
+    monkeypatch.setattr(client, "request_folder_results", fake_request_folder_results(tree))
+    monkeypatch.chdir(tmp_path)
+
+    def expected_depth_first(folder_id: int) -> tuple[list[int], list[int]]:
+        folders = [row['entryId'] for row in tree[folder_id] if row['type'] == 0]
+        documents = [row['entryId'] for row in tree[folder_id] if row['type'] == -1]
+        for subfolder_id in list(folders):
+            sub_folders, sub_documents = expected_depth_first(subfolder_id)
+            folders += sub_folders
+            documents += sub_documents
+        return folders, documents
+
+    dfs_results = client.crawl_directory(repo="City-Secretary", folder_id=1, strategy="dfs")
+    bfs_results = client.crawl_directory(repo="City-Secretary", folder_id=1, strategy="bfs")
+
+    assert ([row['entryId'] for row in dfs_results['folders']],
+            [row['entryId'] for row in dfs_results['documents']]) == expected_depth_first(1)
+    # Level by level, which for this tree's sequential ids means ascending id order
+    bfs_folder_ids = [row['entryId'] for row in bfs_results['folders']]
+    assert bfs_folder_ids == sorted(bfs_folder_ids)
+    assert len(bfs_results['documents']) == len(dfs_results['documents'])
+
+
+def test_iter_crawl_streams_lazily(monkeypatch):
+    tree = build_fake_tree(depth=2, folders_per_folder=2, documents_per_folder=100)
+    listed_folders = []
+
+    def request_folder_results(repo: str, folder_id: int, start: int, end: int, **kwargs) -> dict:
+        listed_folders.append(folder_id)
+        return fake_request_folder_results(tree)(repo, folder_id, start, end, **kwargs)
+
+    monkeypatch.setattr(client, "request_folder_results", request_folder_results)
+
+    first_entries = list(itertools.islice(client.iter_crawl(repo="City-Secretary", folder_id=1), 10))
+
+    assert [row['entryId'] for row in first_entries] == [row['entryId'] for row in tree[1][:10]]
+    assert set(listed_folders) == {1}
+
+
+def test_get_folder_changes_since_stops_early(monkeypatch):
+    tree = build_fake_tree(depth=0, folders_per_folder=0, documents_per_folder=10000)
+    for row in tree[1][5000:5003]:
+        row['data'][10] = "11/13/2022 1:00:00 PM"
+    # A shortcut, which is neither a folder nor a document
+    tree[1][5001]['targetType'] = 1
+    listed_pages = []
+
+    def request_folder_results(*args, **kwargs) -> dict:
+        listed_pages.append(kwargs['start'])
+        return fake_request_folder_results(tree)(*args, **kwargs)
+
+    monkeypatch.setattr(client, "request_folder_results", request_folder_results)
+
+    total_entries, changed_entries = client.get_folder_changes_since(
+        repo="City-Secretary",
+        folder_id=1,
+        since=client.parse_remote_datetime("1/1/2021 12:00:00 AM")
+    )
+
+    # Counted the same way as changed_entries, without the shortcut
+    assert total_entries == 9999
+    assert [row['entryId'] for row in changed_entries] == [tree[1][5000]['entryId'], tree[1][5002]['entryId']]
+    assert listed_pages == [0]
+
+
+def test_get_folder_changes_since_detects_ignored_sort(monkeypatch):
+    tree = build_fake_tree(depth=0, folders_per_folder=0, documents_per_folder=100)
+    monkeypatch.setattr(client, "request_folder_results", fake_request_folder_results(tree, honor_sort=False))
+
+    assert client.get_folder_changes_since(
+        repo="City-Secretary",
+        folder_id=1,
+        since=client.parse_remote_datetime("1/1/2021 12:00:00 AM")
+    ) is None
+
+
+def test_response_cache_serves_fresh_and_revalidates_stale(tmp_path, monkeypatch):
+    response_cache = cache.ResponseCache(cache.DiskCacheBackend(tmp_path), ttls={"GetFolderListing2": 60})
+    sent_requests = []
+
+    def send(request: requests.PreparedRequest) -> requests.Response:
+        sent_requests.append(dict(request.headers))
+        response = requests.Response()
+        response.status_code = 304 if "If-None-Match" in request.headers else 200
+        response.headers["ETag"] = '"v1"'
+        response._content = b'{"data": {}}'
+        return response
+
+    def prepare() -> requests.PreparedRequest:
+        return requests.Request("POST", client.url, json={"folderId": 1}).prepare()
+
+    assert response_cache.send(prepare(), send).json() == {"data": {}}
+    assert response_cache.send(prepare(), send).json() == {"data": {}}
+    assert len(sent_requests) == 1
+
+    now = time.time()
+    monkeypatch.setattr(cache.time, "time", lambda: now + 120)
+    revalidated = response_cache.send(prepare(), send)
+    assert revalidated.status_code == 200
+    assert revalidated.json() == {"data": {}}
+    assert sent_requests[-1]["If-None-Match"] == '"v1"'
+
+
+def test_disk_cache_backend_evicts_least_recently_used(tmp_path):
+    backend = cache.DiskCacheBackend(tmp_path, max_bytes=1000)
+    entry = cache.CachedResponse(status_code=200, reason="OK", headers={}, content=b"x" * 200, stored_at=0)
+
+    for index in range(10):
+        backend.set(f"key-{index}", entry)
+        os.utime(backend._path(f"key-{index}"), (index, index))
+
+    backend.set("key-10", entry)
+
+    assert backend.get("key-10") is not None
+    assert backend.get("key-0") is None
+    assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 1000
+
+
+def test_disk_cache_backend_does_not_rescan_on_every_write(tmp_path, monkeypatch):
+    backend = cache.DiskCacheBackend(tmp_path, max_bytes=1024 * 1024, rescan_every_writes=100)
+    entry = cache.CachedResponse(status_code=200, reason="OK", headers={}, content=b"x" * 200, stored_at=0)
+    scans = []
+    scan = backend._scan
+    monkeypatch.setattr(backend, "_scan", lambda: scans.append(1) or scan())
+
+    for index in range(250):
+        backend.set(f"key-{index}", entry)
+    backend.set("key-0", entry)
+
+    # One scan to size up the directory, then one per rescan_every_writes writes
+    assert len(scans) == 3
+    assert backend._total_bytes == sum(path.stat().st_size for path in tmp_path.iterdir())
+
+
+class FakeStreamedResponse:
+    def __init__(self, chunks: list[bytes], status_code: int = 200, headers: dict = None, drop_after: int = None):
+        self.chunks = chunks
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.drop_after = drop_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for index, chunk in enumerate(self.chunks):
+            if index == self.drop_after:
+                raise requests.exceptions.ChunkedEncodingError("Connection broken")
+            yield chunk
+
+    @property
+    def content(self):
+        raise AssertionError("download read the whole body into memory")
+
+
+def test_download_bulk_pdfs_streams_to_file(monkeypatch):
+    chunks = [b"x" * client.download_chunk_size for _ in range(3)] + [b"tail"]
+    requested = []
+
+    def get(url, **kwargs):
+        requested.append(kwargs)
+        return FakeStreamedResponse(chunks)
+
+    monkeypatch.setattr(client.session, "get", get)
+
+    with client.new_spooled_file() as export_file:
+        assert client.download_bulk_pdfs("token", destination=export_file) == sum(len(chunk) for chunk in chunks)
+        assert export_file.tell() == 0
+        assert export_file.read() == b"".join(chunks)
+    assert [kwargs['stream'] for kwargs in requested] == [True]
+
+
+def test_download_single_pdf_resumes_dropped_download(monkeypatch):
+    pdf = bytes(range(256)) * 100
+    range_headers = []
+
+    def get(url, headers, stream):
+        range_headers.append(headers.get("Range"))
+        if len(range_headers) == 1:
+            # Drops the connection after the first 1000 bytes
+            return FakeStreamedResponse([pdf[:1000], pdf[1000:]], headers={"Content-Length": str(len(pdf))},
+                                        drop_after=1)
+        if len(range_headers) == 2:
+            # Comes up short without an error
+            return FakeStreamedResponse([pdf[1000:5000]], status_code=206,
+                                        headers={"Content-Range": f"bytes 1000-{len(pdf) - 1}/{len(pdf)}"})
+        return FakeStreamedResponse([pdf[5000:]], status_code=206,
+                                    headers={"Content-Range": f"bytes 5000-{len(pdf) - 1}/{len(pdf)}"})
+
+    monkeypatch.setattr(client.session, "get", get)
+
+    with client.new_spooled_file() as pdf_file:
+        assert client.download_single_pdf("key", "188176", destination=pdf_file) == len(pdf)
+        assert pdf_file.read() == pdf
+    assert range_headers == [None, "bytes=1000-", "bytes=5000-"]
+
+
+def test_download_restarts_when_server_ignores_range(monkeypatch):
+    pdf = b"%PDF-" + b"x" * 5000
+    responses = iter([
+        FakeStreamedResponse([pdf[:1000], pdf[1000:]], headers={"Content-Length": str(len(pdf))}, drop_after=1),
+        FakeStreamedResponse([pdf], headers={"Content-Length": str(len(pdf))}),
+    ])
+    monkeypatch.setattr(client.session, "get", lambda url, headers, stream: next(responses))
+
+    with client.new_spooled_file() as pdf_file:
+        pdf_file.write(b"prefix")
+        assert client.download_with_resume("https://example.com/PDF10/key/1", pdf_file) == len(pdf)
+        pdf_file.seek(0)
+        assert pdf_file.read() == b"prefix" + pdf
+
+
+def test_page_sizer_probes_up_and_backs_off():
+    sizer = page_size.AdaptivePageSizer()
+
+    def healthy_pages(count: int, latency: float = 1.0):
+        for _ in range(count):
+            size = sizer.get_page_size("City-Secretary")
+            sizer.record("City-Secretary", page_size=size, latency=latency, rows_requested=size, rows_returned=size)
+
+    healthy_pages(page_size.probe_after_pages)
+    assert sizer.get_page_size("City-Secretary") == 80  # probing
+    healthy_pages(1)
+    assert sizer.get_page_size("City-Secretary") == 80  # kept - same latency for twice the rows
+
+    # A partial (last) page doesn't count either way
+    sizer.record("City-Secretary", page_size=80, latency=30.0, rows_requested=12, rows_returned=12)
+    healthy_pages(page_size.probe_after_pages)
+    assert sizer.get_page_size("City-Secretary") == 160
+    sizer.record("City-Secretary", page_size=160, latency=1.0, rows_requested=160, rows_returned=160, failed=True)
+    assert sizer.get_page_size("City-Secretary") == 80
+
+    # 160 failed recently, so we don't try it again
+    healthy_pages(page_size.probe_after_pages * 2)
+    assert sizer.get_page_size("City-Secretary") == 80
+
+    # Server caps windows below what we're asking for
+    sizer.record("City-Secretary", page_size=80, latency=1.0, rows_requested=80, rows_returned=50, short=True)
+    assert sizer.get_page_size("City-Secretary") == 40
+
+
+def test_listing_fills_in_pages_the_server_cut_short(monkeypatch):
+    tree = build_fake_tree(depth=0, folders_per_folder=0, documents_per_folder=1000)
+    fake = fake_request_folder_results(tree)
+    sizer = page_size.AdaptivePageSizer()
+    sizer._state("City-Secretary").page_size = 320
+
+    def request_folder_results(repo: str, folder_id: int, start: int, end: int, **kwargs) -> dict:
+        # Never more than 100 rows, whatever we ask for
+        return fake(repo, folder_id, start, min(end, start + 100), **kwargs)
+
+    monkeypatch.setattr(client, "request_folder_results", request_folder_results)
+    monkeypatch.setattr(client, "get_page_sizer", lambda: sizer)
+
+    entries = list(client.iter_folder_listing(repo="City-Secretary", folder_id=1))
+
+    assert [row['entryId'] for row in entries] == [row['entryId'] for row in tree[1]]
+    assert sizer.get_page_size("City-Secretary") == 80
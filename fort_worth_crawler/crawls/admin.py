@@ -1,7 +1,18 @@
 from django.contrib import admin
 
-from .models import Crawl
+from .models import Crawl, CrawledFolder, CrawlEntry
 
 @admin.register(Crawl)
 class CrawlAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(CrawledFolder)
+class CrawledFolderAdmin(admin.ModelAdmin):
+    list_display = ['crawl', 'folder_id']
+
+
+@admin.register(CrawlEntry)
+class CrawlEntryAdmin(admin.ModelAdmin):
+    list_display = ['crawl', 'entry_id', 'entry_type', 'parent_folder_id', 'name', 'remote_modified']
+    list_filter = ['entry_type']
@@ -0,0 +1,117 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from fort_worth_crawler.api.client import FolderContentsDict, is_folder_entry
+from fort_worth_crawler.crawls.entries import ingest_crawl_entries, iter_crawl_entries
+from fort_worth_crawler.crawls.models import Crawl, CrawledFolder
+
+
+class CrawlCheckpointer:
+    """
+    Passed to the crawlers as their on_folder_complete hook. Buffers each completed folder's entries and, every
+    interval_seconds (or max_buffered_folders), writes them to CrawledFolder along with the crawl's current frontier in
+    a single transaction, so the stored checkpoint is always consistent: every folder is either in CrawledFolder or
+    in the frontier.
+    """
+
+    def __init__(self, crawl: Crawl, interval_seconds: float = 30, max_buffered_folders: int = 250):
+        self.crawl = crawl
+        self.interval_seconds = interval_seconds
+        self.max_buffered_folders = max_buffered_folders
+
+        self._lock = threading.Lock()
+        self._buffer: list[CrawledFolder] = []
+        self._reused_folder_ids: list[int] = []
+        self._frontier: list[int] = list(crawl.frontier or [])
+        self._last_flush = time.monotonic()
+
+    def folder_completed(self, folder_id: int, entries: list[dict], frontier: list[int]):
+        with self._lock:
+            self._buffer.append(CrawledFolder(crawl=self.crawl, folder_id=folder_id, entries=entries))
+            self._frontier = frontier
+
+            if len(self._buffer) >= self.max_buffered_folders or \
+                    time.monotonic() - self._last_flush >= self.interval_seconds:
+                self._flush()
+
+    def reuse_folders(self, folder_ids: list[int]):
+        """
+        Marks folders as done without listing them - their entries are copied over from crawl.previous_crawl on the
+        next flush.
+        """
+        with self._lock:
+            self._reused_folder_ids.extend(folder_ids)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _save_folders(self, crawled_folders: list[CrawledFolder]):
+        """
+        Saves crawled folders along with their CrawlEntry rows. A folder can be listed twice if we died after listing
+        it but before checkpointing - folders this crawl already has are skipped.
+        """
+        already_saved = set(CrawledFolder.objects.filter(
+            crawl=self.crawl,
+            folder_id__in=[crawled_folder.folder_id for crawled_folder in crawled_folders]
+        ).values_list('folder_id', flat=True))
+        crawled_folders = list({
+            crawled_folder.folder_id: crawled_folder for crawled_folder in crawled_folders
+            if crawled_folder.folder_id not in already_saved
+        }.values())
+
+        CrawledFolder.objects.bulk_create(crawled_folders, ignore_conflicts=True)
+        ingest_crawl_entries(iter_crawl_entries(crawled_folders))
+
+    def _flush(self):
+        with transaction.atomic():
+            self._save_folders(self._buffer)
+            for chunk_start in range(0, len(self._reused_folder_ids), 1000):
+                self._save_folders([
+                    CrawledFolder(crawl=self.crawl, folder_id=folder_id, entries=entries)
+                    for folder_id, entries in CrawledFolder.objects.filter(
+                        crawl_id=self.crawl.previous_crawl_id,
+                        folder_id__in=self._reused_folder_ids[chunk_start:chunk_start + 1000]
+                    ).values_list('folder_id', 'entries').iterator()
+                ])
+            self.crawl.frontier = self._frontier
+            self.crawl.last_checkpoint = timezone.now()
+            self.crawl.save(update_fields=['frontier', 'last_checkpoint'])
+
+        self._buffer = []
+        self._reused_folder_ids = []
+        self._last_flush = time.monotonic()
+
+
+def get_resumable_crawl(max_age_hours: float) -> Crawl | None:
+    """
+    Most recent crawl that checkpointed at least once but never finished, if it started within max_age_hours.
+    """
+    return Crawl.objects.filter(
+        end__isnull=True,
+        last_checkpoint__isnull=False,
+        start__gte=timezone.now() - timedelta(hours=max_age_hours)
+    ).order_by('-start').first()
+
+
+def load_crawl_results(crawl: Crawl) -> FolderContentsDict:
+    """
+    Reassembles the full crawl results from the checkpointed folders.
+    """
+    results: FolderContentsDict = {
+        "folders": [],
+        "documents": [],
+    }
+
+    for entries in crawl.crawled_folders.order_by('id').values_list('entries', flat=True).iterator():
+        for entry in entries:
+            if is_folder_entry(entry):
+                results['folders'].append(entry)
+            else:
+                results['documents'].append(entry)
+
+    return results
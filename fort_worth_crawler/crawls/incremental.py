@@ -0,0 +1,141 @@
+import hashlib
+import json
+import typing
+from collections import deque
+from datetime import timedelta
+
+from django.utils import timezone
+
+from fort_worth_crawler.api.client import (
+    get_entry_last_modified,
+    get_folder_changes_since,
+    is_folder_entry,
+    iter_folder_listing,
+    max_concurrent_requests,
+    parse_remote_datetime,
+)
+from fort_worth_crawler.crawls.checkpoints import CrawlCheckpointer
+from fort_worth_crawler.crawls.models import Crawl, CrawledFolder
+
+
+def get_listing_fingerprint(result: dict) -> str:
+    """
+    Hash of a folder's listing row (name plus all its column values), so renames, moves or page count changes are
+    caught even when the modified date isn't bumped.
+    """
+    return hashlib.sha1(
+        json.dumps([result.get('name'), result.get('data')], default=str).encode('utf-8')
+    ).hexdigest()
+
+
+def get_incremental_base_crawl(full_crawl_interval_days: float) -> typing.Optional[Crawl]:
+    """
+    The crawl an incremental crawl should diff against - the most recent finished, checkpointed crawl - or None if
+    it's time for a full crawl (no full crawl has finished in the last full_crawl_interval_days).
+    """
+    finished_crawls = Crawl.objects.filter(end__isnull=False, last_checkpoint__isnull=False)
+
+    last_full_crawl = finished_crawls.filter(incremental=False).order_by('-end').first()
+    if last_full_crawl is None or last_full_crawl.end < timezone.now() - timedelta(days=full_crawl_interval_days):
+        return None
+
+    return finished_crawls.order_by('-end').first()
+
+
+class IncrementalCrawlPlan:
+    """
+    Remembers each folder's modified date and listing fingerprint as of the previous crawl. Its should_descend is
+    handed to the crawlers: folders that changed (or are new) get listed as usual, while unchanged folders are skipped
+    and their whole subtree is copied over from the previous crawl by the checkpointer.
+
+    This leans on PaperFiche bumping a folder's modified date when something inside it changes. Anything that slips
+    past that is picked up by the periodic full crawl.
+
+    Its list_folder lists the folders that did change newest-first, only reading as far back as the newest entry the
+    previous crawl saw there, and merges those rows into the previous crawl's entries for the folder. When it has to
+    fall back to a full listing, that requests up to max_concurrency pages at a time - the async crawler, which already
+    bounds the requests in flight for the whole crawl, needs this to be 1.
+    """
+
+    def __init__(
+        self,
+        repo: str,
+        previous_crawl: Crawl,
+        checkpointer: CrawlCheckpointer,
+        max_concurrency: int = max_concurrent_requests
+    ):
+        self.repo = repo
+        self.previous_crawl = previous_crawl
+        self.checkpointer = checkpointer
+        self.max_concurrency = max_concurrency
+
+        # folder id -> (modified date, fingerprint) from the row for that folder in its parent's listing
+        self.previous_folder_stamps: dict[int, tuple[typing.Optional[str], str]] = {}
+        # folder id -> ids of the subfolders it contained
+        self.previous_subfolder_ids: dict[int, list[int]] = {}
+
+        for folder_id, entries in previous_crawl.crawled_folders.values_list('folder_id', 'entries').iterator():
+            subfolder_ids = []
+            for entry in entries:
+                if is_folder_entry(entry):
+                    subfolder_ids.append(entry['entryId'])
+                    self.previous_folder_stamps[entry['entryId']] = (
+                        get_entry_last_modified(entry),
+                        get_listing_fingerprint(entry)
+                    )
+            self.previous_subfolder_ids[folder_id] = subfolder_ids
+
+    def get_previous_subtree(self, folder_id: int) -> list[int]:
+        subtree = []
+        frontier = deque([folder_id])
+        while frontier:
+            current_folder_id = frontier.popleft()
+            subtree.append(current_folder_id)
+            frontier.extend(self.previous_subfolder_ids.get(current_folder_id, []))
+        return subtree
+
+    def should_descend(self, result: dict) -> bool:
+        folder_id = result['entryId']
+
+        if folder_id not in self.previous_subfolder_ids:
+            return True
+
+        previous_stamp = self.previous_folder_stamps.get(folder_id)
+        current_stamp = (get_entry_last_modified(result), get_listing_fingerprint(result))
+        if previous_stamp is None or previous_stamp[0] is None or previous_stamp != current_stamp:
+            return True
+
+        self.checkpointer.reuse_folders(self.get_previous_subtree(folder_id))
+        return False
+
+    def list_whole_folder(self, folder_id: int) -> typing.Iterable[dict]:
+        return iter_folder_listing(repo=self.repo, folder_id=folder_id, max_concurrency=self.max_concurrency)
+
+    def list_folder(self, folder_id: int) -> typing.Iterable[dict]:
+        previous_folder = CrawledFolder.objects.filter(crawl=self.previous_crawl, folder_id=folder_id).first()
+        previous_modified = [
+            get_entry_last_modified(entry) for entry in (previous_folder.entries if previous_folder else [])
+        ]
+        if not previous_modified or None in previous_modified:
+            return self.list_whole_folder(folder_id)
+
+        changes = get_folder_changes_since(
+            repo=self.repo,
+            folder_id=folder_id,
+            since=max(parse_remote_datetime(modified) for modified in previous_modified)
+        )
+        if changes is None:
+            return self.list_whole_folder(folder_id)
+
+        total_entries, changed_entries = changes
+        entries = {entry['entryId']: entry for entry in previous_folder.entries}
+        entries.update((entry['entryId'], entry) for entry in changed_entries)
+
+        # The sorted listing can't show us deletions (or older entries moved in from elsewhere). If the count doesn't
+        # add up, something like that happened, so fall back to listing the whole folder. Both sides only count folders
+        # and documents, except for any other rows (e.g. shortcuts) older than since, which also send us down the
+        # fallback.
+        if len(entries) != total_entries:
+            return self.list_whole_folder(folder_id)
+
+        return entries.values()
@@ -0,0 +1,39 @@
+# Generated by Django 4.0.8 on 2026-10-18 09:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+import fort_worth_crawler.shared.defaults
+import fort_worth_crawler.shared.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crawls', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawl',
+            name='frontier',
+            field=fort_worth_crawler.shared.defaults.NullableJSONField(default=fort_worth_crawler.shared.fields.jsonfield_default_list_value, null=True),
+        ),
+        migrations.AddField(
+            model_name='crawl',
+            name='last_checkpoint',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='CrawledFolder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('folder_id', models.IntegerField()),
+                ('entries', fort_worth_crawler.shared.defaults.NullableJSONField(default=fort_worth_crawler.shared.fields.jsonfield_default_list_value, null=True)),
+                ('crawl', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='crawled_folders', to='crawls.crawl')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='crawledfolder',
+            constraint=models.UniqueConstraint(fields=('crawl', 'folder_id'), name='unique_crawled_folder'),
+        ),
+    ]
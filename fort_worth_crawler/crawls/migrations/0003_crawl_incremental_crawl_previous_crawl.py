@@ -0,0 +1,24 @@
+# Generated by Django 4.0.8 on 2026-10-18 09:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crawls', '0002_crawl_frontier_crawl_last_checkpoint_crawledfolder_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawl',
+            name='incremental',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='crawl',
+            name='previous_crawl',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='next_crawls', to='crawls.crawl'),
+        ),
+    ]
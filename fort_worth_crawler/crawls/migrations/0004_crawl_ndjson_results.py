@@ -0,0 +1,18 @@
+# Generated by Django 4.0.8 on 2026-10-18 09:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crawls', '0003_crawl_incremental_crawl_previous_crawl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawl',
+            name='ndjson_results',
+            field=models.FileField(blank=True, max_length=1024, upload_to='crawls'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.8 on 2026-10-18 09:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crawls', '0004_crawl_ndjson_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawl',
+            name='new_documents',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='crawl',
+            name='synced',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.0.8 on 2026-10-18 09:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crawls', '0005_crawl_synced'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrawlEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_id', models.IntegerField()),
+                ('entry_type', models.IntegerField(choices=[(0, 'Folder'), (-1, 'Document')])),
+                ('parent_folder_id', models.IntegerField()),
+                ('name', models.CharField(blank=True, max_length=1024, null=True)),
+                ('remote_modified', models.DateTimeField(blank=True, null=True)),
+                ('crawl', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='crawls.crawl')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='crawlentry',
+            index=models.Index(fields=['crawl', 'entry_id'], name='crawl_entry'),
+        ),
+    ]
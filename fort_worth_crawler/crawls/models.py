@@ -3,6 +3,9 @@ import functools
 from django.db import models
 from django.utils import timezone
 
+from fort_worth_crawler.shared.defaults import NullableJSONField
+from fort_worth_crawler.shared.fields import jsonfield_default_list_value
+
 
 class Crawl(models.Model):
 
@@ -16,3 +19,83 @@ class Crawl(models.Model):
         null=False,
         upload_to="crawls",
     )
+
+    # Optional NDJSON dump of every listing row the crawl found, one per line (see crawls/sinks.py)
+    ndjson_results = models.FileField(
+        max_length=1024,
+        blank=True,
+        null=False,
+        upload_to="crawls",
+    )
+
+    # Checkpoint of an in-progress crawl: ids of the folders still waiting to be listed as of last_checkpoint. Folders
+    # that have already been listed (and their entries) are in CrawledFolder. Together, that's enough to resume a crawl
+    # that died partway through.
+    frontier = NullableJSONField(
+        default=jsonfield_default_list_value,
+        null=True
+    )
+    last_checkpoint = models.DateTimeField(blank=True, null=True)
+
+    # Set once every document the crawl found has been diffed against the database (see finalize_crawl_task), along
+    # with how many new documents / versions that turned up
+    synced = models.DateTimeField(blank=True, null=True)
+    new_documents = models.IntegerField(default=0, blank=False, null=False)
+
+    # Incremental crawls only list folders that changed since previous_crawl, and copy everything else over from it
+    incremental = models.BooleanField(default=False, blank=False, null=False)
+    previous_crawl = models.ForeignKey(
+        "self",
+        related_name="next_crawls",
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL
+    )
+
+
+class CrawledFolder(models.Model):
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['crawl', 'folder_id'],
+                name='unique_crawled_folder'
+            )
+        ]
+
+    crawl = models.ForeignKey(Crawl, related_name="crawled_folders", on_delete=models.CASCADE)
+    folder_id = models.IntegerField(null=False, blank=False)
+
+    # Raw folder and document rows listed directly inside this folder
+    entries = NullableJSONField(
+        default=jsonfield_default_list_value,
+        null=True
+    )
+
+
+class CrawlEntry(models.Model):
+    """
+    One folder or document row found by a crawl, broken out of CrawledFolder.entries so crawls can be queried and
+    compared in SQL (e.g. entries in one crawl but not the one before it). Written as the crawl goes, whenever it
+    checkpoints (see crawls/entries.py).
+    """
+
+    FOLDER = 0
+    DOCUMENT = -1
+    TYPE_CHOICES = [
+        (FOLDER, "Folder"),
+        (DOCUMENT, "Document"),
+    ]
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['crawl', 'entry_id'], name='crawl_entry'),
+        ]
+
+    crawl = models.ForeignKey(Crawl, related_name="entries", on_delete=models.CASCADE)
+    entry_id = models.IntegerField(null=False, blank=False)
+    # Listing row "type" - the same entry can be listed in more than one folder, so (crawl, entry_id) isn't unique
+    entry_type = models.IntegerField(choices=TYPE_CHOICES, null=False, blank=False)
+    parent_folder_id = models.IntegerField(null=False, blank=False)
+    name = models.CharField(max_length=1024, null=True, blank=True)
+    remote_modified = models.DateTimeField(blank=True, null=True)
@@ -0,0 +1,148 @@
+import json
+import math
+import shutil
+import tempfile
+import typing
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+from fort_worth_crawler.api.client import download_chunk_size, is_folder_entry, new_spooled_file
+from fort_worth_crawler.crawls.models import Crawl, CrawlEntry
+
+
+class NdjsonCrawlSink:
+    """
+    Append-only NDJSON (one listing row per line) writer. Rows are buffered and written to destination in batches of
+    batch_size, rather than one write per row.
+    """
+
+    def __init__(self, destination: typing.BinaryIO, batch_size: int = 1000):
+        self.destination = destination
+        self.batch_size = batch_size
+        self.rows_written = 0
+        self._buffer: list[str] = []
+
+    def write(self, entry: dict):
+        self._buffer.append(json.dumps(entry, separators=(",", ":")))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, entries: typing.Iterable[dict]):
+        for entry in entries:
+            self.write(entry)
+
+    def flush(self):
+        if self._buffer:
+            self.destination.write(("\n".join(self._buffer) + "\n").encode('utf-8'))
+            self.rows_written += len(self._buffer)
+            self._buffer = []
+
+
+def write_crawl_ndjson(crawl: Crawl, batch_size: int = 1000) -> int:
+    """
+    Streams every row the crawl found (folder by folder, out of CrawledFolder) through an NdjsonCrawlSink into
+    crawl.ndjson_results. Only done if CRAWLER_WRITE_NDJSON_OUTPUT is on - the crawl itself never touches the disk.
+
+    :return: Number of rows written
+    """
+    with new_spooled_file() as ndjson_file:
+        sink = NdjsonCrawlSink(ndjson_file, batch_size=batch_size)
+        sink.write_many(iter_crawl_rows(crawl))
+        sink.flush()
+
+        ndjson_file.seek(0)
+        crawl.ndjson_results.save(f"crawl_{crawl.pk}.ndjson", File(ndjson_file), save=False)
+
+    return sink.rows_written
+
+
+class DocumentShardDict(typing.TypedDict):
+    crawl: int
+    path: str  # In default_storage
+    rows: int
+
+
+def iter_crawl_rows(crawl: Crawl) -> typing.Iterator[dict]:
+    """
+    Every row the crawl found, read folder by folder out of CrawledFolder rather than loaded all at once.
+    """
+    for entries in crawl.crawled_folders.order_by('id').values_list('entries', flat=True).iterator():
+        yield from entries
+
+
+def write_crawl_json(crawl: Crawl):
+    """
+    Streams the crawl's results into crawl.json_results, in the same {"folders": [...], "documents": [...]} shape as
+    load_crawl_results, without ever holding the whole crawl in memory. Documents are spooled to their own temp file
+    while the folders are written, then copied in after them.
+    """
+    with new_spooled_file() as json_file, new_spooled_file() as documents_file:
+        json_file.write(b'{"folders": [')
+        folder_count = 0
+        document_count = 0
+
+        for entry in iter_crawl_rows(crawl):
+            row = json.dumps(entry).encode('utf-8')
+            if is_folder_entry(entry):
+                json_file.write(b", " + row if folder_count else row)
+                folder_count += 1
+            else:
+                documents_file.write(b", " + row if document_count else row)
+                document_count += 1
+
+        json_file.write(b'], "documents": [')
+        documents_file.seek(0)
+        shutil.copyfileobj(documents_file, json_file, download_chunk_size)
+        json_file.write(b"]}")
+
+        json_file.seek(0)
+        crawl.json_results.save(f"crawl_{crawl.pk}.json", File(json_file), save=False)
+
+
+def write_document_shards(crawl: Crawl, chunk_size: int) -> list[DocumentShardDict]:
+    """
+    Streams the crawl's document rows into NDJSON shards of about chunk_size rows each in storage, so the pipeline can
+    hand downstream tasks a small descriptor instead of the rows themselves. Rows are sharded on entryId, so every row
+    for an entry lands in the same shard (in crawl order), and shards diffed in parallel never race to version the same
+    document.
+
+    :return: One descriptor per (non-empty) shard
+    """
+    document_count = CrawlEntry.objects.filter(crawl=crawl).exclude(entry_type=CrawlEntry.FOLDER).count()
+    shard_count = max(1, math.ceil(document_count / chunk_size))
+    # Real temp files rather than spooled ones - a shard never gets anywhere near the spool size, so spooling would keep
+    # every document row of the crawl in memory until the end
+    shard_files = [tempfile.TemporaryFile() for _ in range(shard_count)]
+    # Small batches - there's a buffer per shard
+    sinks = [NdjsonCrawlSink(shard_file, batch_size=100) for shard_file in shard_files]
+    shards = []
+
+    try:
+        for entry in iter_crawl_rows(crawl):
+            if not is_folder_entry(entry):
+                sinks[entry['entryId'] % shard_count].write(entry)
+
+        for shard_number, (shard_file, sink) in enumerate(zip(shard_files, sinks)):
+            sink.flush()
+            if not sink.rows_written:
+                continue
+            shard_file.seek(0)
+            path = default_storage.save(f"crawls/crawl_{crawl.pk}/documents_{shard_number:05d}.ndjson",
+                                        File(shard_file))
+            shards.append({"crawl": crawl.pk, "path": path, "rows": sink.rows_written})
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+
+    return shards
+
+
+def read_document_shard(shard: DocumentShardDict) -> list[dict]:
+    with default_storage.open(shard['path'], 'rb') as shard_file:
+        return [json.loads(line) for line in shard_file if line.strip()]
+
+
+def delete_document_shards(shards: list[DocumentShardDict]):
+    for shard in shards:
+        default_storage.delete(shard['path'])
@@ -1,38 +1,173 @@
-import json
-
+from celery import chord
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
 from django.utils import timezone
 from django.contrib.auth import get_user_model
-from django.core.files.base import ContentFile
 
 from config import celery_app
 
+from fort_worth_crawler.crawls.checkpoints import CrawlCheckpointer, get_resumable_crawl
+from fort_worth_crawler.crawls.incremental import IncrementalCrawlPlan, get_incremental_base_crawl
 from fort_worth_crawler.crawls.models import Crawl
+from fort_worth_crawler.crawls.sinks import DocumentShardDict, delete_document_shards, read_document_shard, \
+    write_crawl_json, write_crawl_ndjson, write_document_shards
 
-from fort_worth_crawler.api.client import crawl_directory_recursively, root_contract_folder_id
+from fort_worth_crawler.api.async_client import crawl_directory_concurrently
+from fort_worth_crawler.api.client import iter_crawl, root_contract_folder_id
+from fort_worth_crawler.documents.tasks import diff_and_fetch_documents
 
 User = get_user_model()
 
 
+# Document sync pipeline, as a Celery canvas so diffing and fetching are spread over the workers:
+#
+#   get_document_list_task -> store_crawl_results_task -> diff_crawl_documents_task
+#       -> chord(diff_crawl_shard_task per shard) -> finalize_crawl_task
+#                 +-> fetch_document_pdf_and_metadata per new document
+#
+# The crawl's rows never go through the broker / result backend: the crawl is checkpointed to the database as it goes,
+# its documents are streamed from there to storage as NDJSON shards (see write_document_shards), and every later step
+# is handed the crawl's pk and shard descriptors.
+
 @celery_app.task()
-def get_document_list_task() -> list[str]:
+def sync_documents_task():
+    """
+    Entrypoint (e.g. for a periodic task) to crawl the repo and pull down every new or changed document.
+    """
+    (get_document_list_task.s() | store_crawl_results_task.s() | diff_crawl_documents_task.s()).delay()
+
+
+@celery_app.task(bind=True, max_retries=None)
+def get_document_list_task(self) -> int:
     """
     Task to crawl the Fort Worth repo API and produce a list of documents... these will then be stored as a daily
     crawl and analyzed to see if any of them have a date modified AFTER what we have for the same doc in our database (
     or are missing from our database entirely). Those will be synced and downloaded. Others will be discarded.
 
-    :return: List of "entryIds" to request document metadata and pdfs for
+    Progress is checkpointed as we go. If an unfinished crawl is found, we pick it up from its last checkpoint instead
+    of starting over, and if we hit the soft time limit, we checkpoint and retry ourselves to keep going.
+
+    Unless a full crawl is due (see CRAWLER_FULL_CRAWL_INTERVAL_DAYS), only folders that changed since the previous
+    crawl are listed. Everything else is carried over from the previous crawl.
+
+    :return: The crawl's pk. Its results are stored by store_crawl_results_task.
     """
-    crawl = Crawl.objects.create()
+    crawl = get_resumable_crawl(max_age_hours=settings.CRAWLER_RESUME_MAX_AGE_HOURS)
+    if crawl is None:
+        previous_crawl = get_incremental_base_crawl(
+            full_crawl_interval_days=settings.CRAWLER_FULL_CRAWL_INTERVAL_DAYS
+        ) if settings.CRAWLER_INCREMENTAL_ENABLED else None
+
+        crawl = Crawl.objects.create(
+            frontier=[root_contract_folder_id],
+            last_checkpoint=timezone.now(),
+            incremental=previous_crawl is not None,
+            previous_crawl=previous_crawl
+        )
+
+    checkpointer = CrawlCheckpointer(crawl, interval_seconds=settings.CRAWLER_CHECKPOINT_INTERVAL_SECONDS)
+    should_descend = None
+    list_folder = None
+    if crawl.incremental and crawl.previous_crawl is not None:
+        # The async engine lists each folder in one slot of its own concurrency limit, so a folder the plan has to list
+        # in full mustn't fan its pages out on top of that
+        plan = IncrementalCrawlPlan(
+            "City-Secretary",
+            crawl.previous_crawl,
+            checkpointer,
+            max_concurrency=1 if settings.CRAWLER_USE_ASYNC_ENGINE else settings.CRAWLER_MAX_CONCURRENT_REQUESTS
+        )
+        should_descend = plan.should_descend
+        list_folder = plan.list_folder
 
-    full_recursive_results = crawl_directory_recursively(
-        repo="City-Secretary",
-        folder_id=root_contract_folder_id
-    )
+    try:
+        if settings.CRAWLER_USE_ASYNC_ENGINE:
+            crawl_directory_concurrently(
+                repo="City-Secretary",
+                folder_id=root_contract_folder_id,
+                max_concurrency=settings.CRAWLER_MAX_CONCURRENT_REQUESTS,
+                frontier=crawl.frontier,
+                on_folder_complete=checkpointer.folder_completed,
+                should_descend=should_descend,
+                list_folder=list_folder
+            )
+        else:
+            for _ in iter_crawl(
+                repo="City-Secretary",
+                folder_id=root_contract_folder_id,
+                frontier=crawl.frontier,
+                on_folder_complete=checkpointer.folder_completed,
+                should_descend=should_descend,
+                list_folder=list_folder
+            ):
+                pass
+    except SoftTimeLimitExceeded:
+        checkpointer.flush()
+        raise self.retry(countdown=0)
 
-    end_time = timezone.now()
-    crawl.end = end_time
-    json_file = ContentFile(json.dumps(full_recursive_results, indent=4).encode('utf-8'))
-    crawl.json_results.save(f"crawl_{end_time.timestamp()}.json", json_file)
+    checkpointer.flush()
+
+    return crawl.pk
+
+
+@celery_app.task(
+    soft_time_limit=settings.CRAWLER_STORE_RESULTS_SOFT_TIME_LIMIT,
+    time_limit=settings.CRAWLER_STORE_RESULTS_TIME_LIMIT
+)
+def store_crawl_results_task(crawl_pk: int) -> dict:
+    """
+    Once the crawl is fully listed, streams its results out of CrawledFolder into json_results (and ndjson_results, if
+    CRAWLER_WRITE_NDJSON_OUTPUT is on) and into document shards for the diff, then marks the crawl finished. Done in
+    its own task, with its own time limits, so a big crawl can't run out of get_document_list_task's time limit here -
+    if it does die, the crawl is left unfinished, so the next run resumes it (with nothing left to list) and gets
+    straight back to this.
+
+    :return: The crawl's pk ("crawl") plus descriptors of the shards its documents were written to ("shards")
+    """
+    crawl = Crawl.objects.get(pk=crawl_pk)
+
+    write_crawl_json(crawl)
+    if settings.CRAWLER_WRITE_NDJSON_OUTPUT:
+        write_crawl_ndjson(crawl)
+    shards = write_document_shards(crawl, chunk_size=settings.CRAWLER_DIFF_CHUNK_SIZE)
+
+    crawl.end = timezone.now()
     crawl.save()
 
-    return full_recursive_results
+    return {"crawl": crawl.pk, "shards": shards}
+
+
+@celery_app.task()
+def diff_crawl_documents_task(crawl_ref: dict):
+    """
+    Diffs the crawl's document shards in parallel, with a chord to finalize the Crawl once they're all done.
+
+    :param crawl_ref: store_crawl_results_task's result
+    """
+    finalize = finalize_crawl_task.s(crawl_ref['crawl'], crawl_ref['shards'])
+
+    if not crawl_ref['shards']:
+        finalize.delay([])
+        return
+
+    chord(diff_crawl_shard_task.s(shard) for shard in crawl_ref['shards'])(finalize)
+
+
+@celery_app.task()
+def diff_crawl_shard_task(shard: DocumentShardDict) -> int:
+    """
+    Reads one shard of the crawl's documents back out of storage and diffs it (see diff_and_fetch_documents).
+
+    :return: Number of new or changed documents in the shard
+    """
+    return diff_and_fetch_documents(read_document_shard(shard))
+
+
+@celery_app.task()
+def finalize_crawl_task(new_document_counts: list[int], crawl_pk: int, shards: list[DocumentShardDict]):
+    """
+    Chord callback for diff_crawl_documents_task: marks the crawl as synced once every shard has been diffed, and
+    cleans up the shards (the crawl's full results are in json_results).
+    """
+    Crawl.objects.filter(pk=crawl_pk).update(synced=timezone.now(), new_documents=sum(new_document_counts))
+    delete_document_shards(shards)
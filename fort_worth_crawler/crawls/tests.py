@@ -1,3 +1,231 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+import pytest
+
+from fort_worth_crawler.api import client
+from fort_worth_crawler.api.tests import build_fake_tree, fake_listing_data, fake_request_folder_results
+from fort_worth_crawler.crawls import incremental, tasks as crawl_tasks
+from fort_worth_crawler.crawls.checkpoints import CrawlCheckpointer, get_resumable_crawl, load_crawl_results
+from fort_worth_crawler.crawls.entries import get_entries_not_in
+from fort_worth_crawler.crawls.incremental import IncrementalCrawlPlan, get_incremental_base_crawl
+from fort_worth_crawler.crawls.models import Crawl, CrawledFolder, CrawlEntry
+from fort_worth_crawler.crawls.sinks import read_document_shard, write_crawl_json, write_crawl_ndjson
+from fort_worth_crawler.documents import tasks as document_tasks
+from fort_worth_crawler.documents.models import Document
+
+from config import celery_app
+
+from django.utils import timezone
+
+pytestmark = pytest.mark.django_db
+
+
+class CrawlInterrupted(Exception):
+    pass
+
+
+def test_interrupted_crawl_resumes_from_checkpoint(monkeypatch):
+    tree = build_fake_tree(depth=3, folders_per_folder=3, documents_per_folder=5)
+    listed_folders = []
+
+    def request_folder_results(repo: str, folder_id: int, start: int, end: int, **kwargs) -> dict:
+        if len(listed_folders) == 20:
+            raise CrawlInterrupted()
+        listed_folders.append(folder_id)
+        return fake_request_folder_results(tree)(repo, folder_id, start, end, **kwargs)
+
+    monkeypatch.setattr(client, "request_folder_results", request_folder_results)
+
+    crawl = Crawl.objects.create(frontier=[1])
+    checkpointer = CrawlCheckpointer(crawl, interval_seconds=0)
+    with pytest.raises(CrawlInterrupted):
+        for _ in client.iter_crawl(repo="City-Secretary", folder_id=1, frontier=crawl.frontier,
+                                   on_folder_complete=checkpointer.folder_completed):
+            pass
+
+    resumable_crawl = get_resumable_crawl(max_age_hours=1)
+    assert resumable_crawl == crawl
+    assert resumable_crawl.crawled_folders.count() == 20
+
+    listed_folders.clear()
+    monkeypatch.setattr(client, "request_folder_results", fake_request_folder_results(tree))
+    checkpointer = CrawlCheckpointer(resumable_crawl, interval_seconds=0)
+    for _ in client.iter_crawl(repo="City-Secretary", folder_id=1, frontier=resumable_crawl.frontier,
+                               on_folder_complete=checkpointer.folder_completed):
+        pass
+    checkpointer.flush()
+
+    results = load_crawl_results(resumable_crawl)
+    expected = client.crawl_directory(repo="City-Secretary", folder_id=1)
+    assert sorted(row['entryId'] for row in results['folders']) == \
+        sorted(row['entryId'] for row in expected['folders'])
+    assert sorted(row['entryId'] for row in results['documents']) == \
+        sorted(row['entryId'] for row in expected['documents'])
+
+
+def test_incremental_crawl_only_lists_changed_folders(monkeypatch):
+    tree = build_fake_tree(depth=3, folders_per_folder=3, documents_per_folder=5)
+    listed_folders = []
+
+    def request_folder_results(*args, **kwargs) -> dict:
+        listed_folders.append(kwargs['folder_id'])
+        return fake_request_folder_results(tree)(*args, **kwargs)
+
+    monkeypatch.setattr(client, "request_folder_results", request_folder_results)
+
+    full_crawl = Crawl.objects.create(frontier=[1])
+    checkpointer = CrawlCheckpointer(full_crawl)
+    for _ in client.iter_crawl(repo="City-Secretary", folder_id=1, frontier=full_crawl.frontier,
+                               on_folder_complete=checkpointer.folder_completed):
+        pass
+    checkpointer.flush()
+    full_crawl.end = timezone.now()
+    full_crawl.save()
+    assert get_incremental_base_crawl(full_crawl_interval_days=7) == full_crawl
+
+    # Add a document to a folder two levels down, bumping the modified date on it and its parent
+    changed_folder = tree[1][0]
+    changed_subfolder = tree[changed_folder['entryId']][0]
+    changed_folder['data'][10] = "11/13/2022 1:00:00 PM"
+    changed_subfolder['data'][10] = "11/13/2022 1:00:00 PM"
+    tree[changed_subfolder['entryId']].append({"entryId": 99999, "name": "New Document", "type": -1,
+                                               "targetType": 0,
+                                               "data": fake_listing_data("New Document", 99999,
+                                                                         modified="11/13/2022 1:00:00 PM")})
+
+    listed_folders.clear()
+    incremental_crawl = Crawl.objects.create(frontier=[1], incremental=True, previous_crawl=full_crawl)
+    checkpointer = CrawlCheckpointer(incremental_crawl)
+    plan = IncrementalCrawlPlan("City-Secretary", full_crawl, checkpointer)
+    for _ in client.iter_crawl(repo="City-Secretary", folder_id=1, frontier=incremental_crawl.frontier,
+                               on_folder_complete=checkpointer.folder_completed, should_descend=plan.should_descend,
+                               list_folder=plan.list_folder):
+        pass
+    checkpointer.flush()
+
+    assert listed_folders == [1, changed_folder['entryId'], changed_subfolder['entryId']]
+
+    results = load_crawl_results(incremental_crawl)
+    assert len(results['folders']) == 3 + 9 + 27
+    assert 99999 in {row['entryId'] for row in results['documents']}
+    assert len(results['documents']) == len(load_crawl_results(full_crawl)['documents']) + 1
+
+
+def test_incremental_fallback_listing_keeps_to_max_concurrency(monkeypatch):
+    previous_crawl = Crawl.objects.create(frontier=[])
+    # No modified dates to go on, so the plan has to list the folder in full
+    CrawledFolder.objects.create(crawl=previous_crawl, folder_id=1, entries=[
+        {"entryId": 2, "name": "Document 2", "type": -1, "targetType": 0, "data": []}
+    ])
+    listings = []
+    monkeypatch.setattr(incremental, "iter_folder_listing",
+                        lambda repo, folder_id, max_concurrency: listings.append(max_concurrency) or [])
+
+    plan = IncrementalCrawlPlan("City-Secretary", previous_crawl, CrawlCheckpointer(Crawl.objects.create()),
+                                max_concurrency=1)
+    assert list(plan.list_folder(1)) == []
+    assert listings == [1]
+
+def test_write_crawl_ndjson_writes_every_row(settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    tree = build_fake_tree(depth=1, folders_per_folder=2, documents_per_folder=3)
+    crawl = Crawl.objects.create(frontier=[])
+    for folder_id, entries in tree.items():
+        CrawledFolder.objects.create(crawl=crawl, folder_id=folder_id, entries=entries)
+
+    assert write_crawl_ndjson(crawl, batch_size=4) == 2 + 3 * 3
+
+    rows = [json.loads(line) for line in crawl.ndjson_results.open('rb').read().decode('utf-8').splitlines()]
+    assert sorted(row['entryId'] for row in rows) == \
+        sorted(row['entryId'] for entries in tree.values() for row in entries)
+
+
+def test_write_crawl_json_matches_load_crawl_results(settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    tree = build_fake_tree(depth=2, folders_per_folder=2, documents_per_folder=3)
+    crawl = Crawl.objects.create(frontier=[])
+    for folder_id, entries in tree.items():
+        CrawledFolder.objects.create(crawl=crawl, folder_id=folder_id, entries=entries)
+
+    write_crawl_json(crawl)
+
+    assert json.loads(crawl.json_results.open('rb').read()) == load_crawl_results(crawl)
+
+def test_crawl_documents_are_diffed_in_parallel_shards(monkeypatch, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.CRAWLER_DIFF_CHUNK_SIZE = 3
+    monkeypatch.setattr(celery_app.conf, "task_always_eager", True)
+    exported = []
+    monkeypatch.setattr(document_tasks.fetch_document_pdf_and_metadata, "run", exported.append)
+    # No live exports - just note which documents each batch would have exported
+    monkeypatch.setattr(document_tasks.export_document_batch, "run", exported.extend)
+    chunk_sizes = []
+    diff = document_tasks.filter_document_jsons_to_new_and_newly_modified.run
+    monkeypatch.setattr(document_tasks.filter_document_jsons_to_new_and_newly_modified, "run",
+                        lambda document_jsons: chunk_sizes.append(len(document_jsons)) or diff(document_jsons))
+
+    documents = [
+        {"entryId": entry_id, "name": f"Document {entry_id}", "type": -1, "targetType": 0,
+         "data": fake_listing_data(f"Document {entry_id}", entry_id)}
+        for entry_id in [5, 4, 3, 3, 3, 2, 1]
+    ]
+    folder = {"entryId": 6, "name": "Folder 6", "type": 0, "targetType": 0, "data": fake_listing_data("Folder 6", 6)}
+    crawl = Crawl.objects.create()
+    checkpointer = CrawlCheckpointer(crawl, interval_seconds=0)
+    checkpointer.folder_completed(1, [folder, *documents[:4]], [6])
+    checkpointer.folder_completed(6, documents[4:], [])
+
+    crawl_ref = crawl_tasks.store_crawl_results_task(crawl.pk)
+
+    crawl.refresh_from_db()
+    assert crawl.end is not None
+    assert json.loads(crawl.json_results.open('rb').read()) == {"folders": [folder], "documents": documents}
+    # Every row for entry 3 lands in the same shard, even though that makes it bigger than CRAWLER_DIFF_CHUNK_SIZE
+    shards = crawl_ref['shards']
+    assert [[row['entryId'] for row in read_document_shard(shard)] for shard in shards] == \
+        [[3, 3, 3], [4, 1], [5, 2]]
+
+    # Only the crawl's pk and the shard descriptors are passed between tasks
+    crawl_tasks.diff_crawl_documents_task(crawl_ref)
+
+    assert chunk_sizes == [3, 2, 2]
+    assert sorted(exported) == sorted(Document.objects.values_list('id', flat=True))
+    crawl.refresh_from_db()
+    assert crawl.synced is not None
+    assert crawl.new_documents == 5
+    # Shards are cleaned up once the crawl is synced
+    assert not any(path.is_file() for path in (tmp_path / "crawls" / f"crawl_{crawl.pk}").rglob("*"))
+
+
+def test_crawl_entries_are_ingested_as_the_crawl_checkpoints(monkeypatch):
+    tree = build_fake_tree(depth=2, folders_per_folder=2, documents_per_folder=3)
+    monkeypatch.setattr(client, "request_folder_results", fake_request_folder_results(tree))
+
+    def crawl_tree() -> Crawl:
+        crawl = Crawl.objects.create(frontier=[1])
+        checkpointer = CrawlCheckpointer(crawl, interval_seconds=0)
+        for _ in client.iter_crawl(repo="City-Secretary", folder_id=1, frontier=crawl.frontier,
+                                   on_folder_complete=checkpointer.folder_completed):
+            pass
+        checkpointer.flush()
+        return crawl
+
+    previous_crawl = crawl_tree()
+    # A folder listed again after a crash doesn't get its entries written twice
+    CrawlCheckpointer(previous_crawl, interval_seconds=0).folder_completed(1, tree[1], [])
+
+    rows = [(folder_id, row) for folder_id, rows in tree.items() for row in rows]
+    assert previous_crawl.entries.count() == len(rows)
+    document = previous_crawl.entries.get(entry_id=tree[1][-1]['entryId'])
+    assert (document.entry_type, document.parent_folder_id, document.name) == \
+        (CrawlEntry.DOCUMENT, 1, tree[1][-1]['name'])
+    assert document.remote_modified == timezone.make_aware(client.parse_remote_datetime("1/6/2020 3:45:52 PM"))
+
+    deleted_row = tree[2].pop()
+    tree[2].append({"entryId": 10000, "name": "New document", "type": -1, "targetType": 0,
+                    "data": fake_listing_data("New document", 10000)})
+    crawl = crawl_tree()
+
+    assert list(get_entries_not_in(crawl, previous_crawl).values_list('entry_id', flat=True)) == [10000]
+    assert list(get_entries_not_in(previous_crawl, crawl).values_list('entry_id', flat=True)) == \
+        [deleted_row['entryId']]
@@ -1,7 +1,13 @@
 from django.contrib import admin
 
-from .models import Document
+from .models import Document, ExportJob
 
 @admin.register(Document)
 class DocumentAdmin(admin.ModelAdmin):
     pass
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ['token', 'status', 'completion', 'check_count', 'next_check']
+    list_filter = ['status']
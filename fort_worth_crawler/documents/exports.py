@@ -0,0 +1,167 @@
+#  Copyright (C) 2022  John Scrudato / Gordium Knot Inc. d/b/a OpenSource.Legal
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import posixpath
+import shutil
+import typing
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from pypdf import PdfWriter
+
+from fort_worth_crawler.api.client import download_chunk_size, get_entry_page_count, new_spooled_file
+from fort_worth_crawler.documents.models import Document, ExportJob
+
+
+def get_expected_page_count(doc_obj: Document) -> int:
+    """
+    Page count from the document's metadata if we have it, otherwise from its crawl listing row (data[1]).
+    """
+    if doc_obj.page_count:
+        return doc_obj.page_count
+    return get_entry_page_count(doc_obj.source_json or {})
+
+
+def batch_documents_for_export(
+    documents: typing.Iterable[Document],
+    max_pages: int,
+    max_documents: int
+) -> list[list[Document]]:
+    """
+    Groups documents into export batches of at most max_documents documents and (roughly) max_pages pages. Page count
+    stands in for export size, which we can't know ahead of time. A single document bigger than max_pages gets a batch
+    to itself.
+    """
+    batches: list[list[Document]] = []
+    batch: list[Document] = []
+    batch_pages = 0
+
+    for doc_obj in documents:
+        page_count = get_expected_page_count(doc_obj)
+        if batch and (batch_pages + page_count > max_pages or len(batch) >= max_documents):
+            batches.append(batch)
+            batch = []
+            batch_pages = 0
+        batch.append(doc_obj)
+        batch_pages += page_count
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def get_page_ranges(page_count: int, chunk_pages: int) -> list[tuple[int, int]]:
+    """
+    Splits a document's pages into chunks of (at most) chunk_pages pages, as 1-based, inclusive (start_page, end_page)
+    ranges like GeneratePDF10's PageRange takes.
+    """
+    return [
+        (start_page, min(start_page + chunk_pages - 1, page_count))
+        for start_page in range(1, page_count + 1, chunk_pages)
+    ]
+
+
+def page_ranges_cover_document(page_ranges: list[tuple[int, int]], page_count: int) -> bool:
+    """
+    True if the (sorted) page ranges cover pages 1 through page_count exactly once each.
+    """
+    next_page = 1
+    for start_page, end_page in page_ranges:
+        if start_page != next_page or end_page < start_page:
+            return False
+        next_page = end_page + 1
+    return next_page - 1 == page_count
+
+
+def merge_pdf_chunks(chunk_files: list[typing.BinaryIO], destination: typing.BinaryIO) -> int:
+    """
+    Concatenates page range chunks (in order) into one PDF written to destination, which is left positioned at the
+    start.
+
+    :return: Number of pages in the merged PDF
+    """
+    writer = PdfWriter()
+    for chunk_file in chunk_files:
+        writer.append(chunk_file)
+    writer.write(destination)
+    destination.seek(0)
+    return len(writer.pages)
+
+
+def split_export_archive(export_file: typing.BinaryIO, documents: list[Document]) -> dict[int, typing.BinaryIO]:
+    """
+    Splits the ZIP returned by GetExportJob back into one PDF per document, matching ZIP members to documents by name
+    (PaperFiche names each PDF after its entry). Documents whose name is missing from the archive, or shared with
+    another document in the batch, are left out of the result so they can be retried on their own.
+
+    Each PDF is copied out of the archive a chunk at a time into its own spooled temp file, so large exports never have
+    to fit in memory. Callers are responsible for closing the returned files.
+
+    :param export_file: Downloaded export job (see download_bulk_pdfs)
+    :param documents: Documents that were in the export
+    :return: Document pk -> PDF file, positioned at the start
+    """
+    export_file.seek(0)
+    if not zipfile.is_zipfile(export_file):
+        # Single document exports come back as a bare PDF
+        export_file.seek(0)
+        return {documents[0].pk: export_file} if len(documents) == 1 else {}
+
+    documents_by_name = defaultdict(list)
+    for doc_obj in documents:
+        documents_by_name[(doc_obj.title or "").strip().lower()].append(doc_obj)
+
+    pdfs = {}
+    with zipfile.ZipFile(export_file) as archive:
+        pdf_members = [
+            member for member in archive.infolist()
+            if not member.is_dir() and posixpath.splitext(member.filename)[1].lower() == ".pdf"
+        ]
+        for member in pdf_members:
+            name = posixpath.splitext(posixpath.basename(member.filename))[0]
+            matches = documents_by_name.get(name.strip().lower(), [])
+            if len(documents) == 1 and len(pdf_members) == 1:
+                # Nothing to tell apart - don't make a single document export depend on the name matching
+                matches = documents
+            if len(matches) == 1:
+                pdf_file = new_spooled_file()
+                with archive.open(member) as member_file:
+                    shutil.copyfileobj(member_file, pdf_file, download_chunk_size)
+                pdf_file.seek(0)
+                pdfs[matches[0].pk] = pdf_file
+
+    return pdfs
+
+
+def get_next_export_check(
+    job: ExportJob,
+    completion: int,
+    now: datetime,
+    min_interval_seconds: float,
+    max_interval_seconds: float
+) -> datetime:
+    """
+    When to check on a running export next. Once the export reports some progress we aim for about halfway through the
+    time it looks like it needs to finish (going by how fast it's progressed so far), otherwise we back off
+    exponentially. Either way, the wait is clamped to [min_interval_seconds, max_interval_seconds].
+    """
+    if 0 < completion < 100:
+        elapsed_seconds = (now - job.created).total_seconds()
+        delay = elapsed_seconds * (100 - completion) / completion / 2
+    else:
+        delay = min_interval_seconds * 2 ** job.check_count
+
+    return now + timedelta(seconds=max(min_interval_seconds, min(max_interval_seconds, delay)))
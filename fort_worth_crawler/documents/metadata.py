@@ -0,0 +1,58 @@
+#  Copyright (C) 2022  John Scrudato / Gordium Knot Inc. d/b/a OpenSource.Legal
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from django.core.cache import cache
+
+from fort_worth_crawler.api.client import DocumentMetadataResponseDict, get_document_metadata
+from fort_worth_crawler.documents.models import Document
+
+# Metadata for a given (entryId, remote modified date) never changes, so this can be long
+metadata_cache_timeout = 7 * 24 * 60 * 60
+
+
+def get_metadata_cache_key(doc_obj: Document) -> str:
+    return f"document_metadata:{doc_obj.repository_unique_id}:{doc_obj.last_updated_on_remote.isoformat()}"
+
+
+def get_document_metadata_cached(doc_obj: Document) -> DocumentMetadataResponseDict:
+    """
+    get_document_metadata for a Document, versioned on (entryId, last modified on remote). Checks, in order:
+
+    1) Django's cache (locmem locally, redis in production)
+    2) custom_meta of any version of the document with the same remote modified date - e.g. this same row on a retry,
+       or an earlier version that was re-versioned without the remote document actually changing
+    3) The PaperFiche API
+
+    :param doc_obj: Document we want metadata for
+    :return: Metadata as returned by GetBasicDocumentInfo
+    """
+    cache_key = get_metadata_cache_key(doc_obj)
+
+    metadata = cache.get(cache_key)
+    if metadata is not None:
+        return metadata
+
+    stored_version = Document.objects.filter(
+        repository_unique_id=doc_obj.repository_unique_id,
+        last_updated_on_remote=doc_obj.last_updated_on_remote,
+        custom_meta__has_key='metadata'
+    ).only('custom_meta').first()
+
+    if stored_version is not None:
+        metadata = stored_version.custom_meta
+    else:
+        metadata = get_document_metadata(doc_obj.repository_unique_id)
+
+    cache.set(cache_key, metadata, timeout=metadata_cache_timeout)
+    return metadata
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.8 on 2026-10-18 09:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0005_document_description_document_page_count_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=255, unique=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('finished', 'Finished'), ('downloaded', 'Downloaded'), ('failed', 'Failed')], default='pending', max_length=32)),
+                ('completion', models.IntegerField(default=0)),
+                ('error_message', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('check_count', models.IntegerField(default=0)),
+                ('last_checked', models.DateTimeField(blank=True, null=True)),
+                ('next_check', models.DateTimeField(default=django.utils.timezone.now)),
+                ('documents', models.ManyToManyField(related_name='export_jobs', to='documents.document')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='exportjob',
+            index=models.Index(fields=['status', 'next_check'], name='export_job_due'),
+        ),
+    ]
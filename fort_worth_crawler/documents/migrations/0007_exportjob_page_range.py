@@ -0,0 +1,28 @@
+# Generated by Django 4.0.8 on 2026-10-18 09:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0006_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='chunk_file',
+            field=models.FileField(blank=True, max_length=1024, upload_to='export_chunks'),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='end_page',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='start_page',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
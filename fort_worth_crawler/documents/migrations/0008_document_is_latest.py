@@ -0,0 +1,37 @@
+# Generated by Django 4.0.8 on 2026-10-18 09:22
+
+from django.db import migrations, models
+
+
+def flag_older_versions(apps, schema_editor):
+    Document = apps.get_model('documents', 'Document')
+    Document.objects.filter(
+        models.Exists(Document.objects.filter(
+            repository_unique_id=models.OuterRef('repository_unique_id'),
+            local_version__gt=models.OuterRef('local_version')
+        ))
+    ).update(is_latest=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0007_exportjob_page_range'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='is_latest',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunPython(flag_older_versions, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['repository_unique_id', '-local_version'], name='document_version_desc'),
+        ),
+        migrations.AddConstraint(
+            model_name='document',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_latest', True)), fields=('repository_unique_id',), name='unique_latest_version'),
+        ),
+    ]
@@ -9,6 +9,16 @@ from fort_worth_crawler.shared.fields import jsonfield_default_value
 from fort_worth_crawler.shared.paths import calc_pdf_file_path
 
 
+class DocumentQuerySet(models.QuerySet):
+
+    def latest_versions(self):
+        """
+        Just the newest local version of each document (i.e. the current contracts), via the unique_latest_version
+        partial index.
+        """
+        return self.filter(is_latest=True)
+
+
 class Document(models.Model):
 
     class Meta:
@@ -18,9 +28,21 @@ class Document(models.Model):
             models.UniqueConstraint(
                 fields=['repository_unique_id', 'local_version'],
                 name='unique_1'
-            )
+            ),
+            # Only one version of a document can be the latest. Doubles as a partial index, so looking up the latest
+            # version of a document (or of every document) only touches the latest rows.
+            models.UniqueConstraint(
+                fields=['repository_unique_id'],
+                condition=models.Q(is_latest=True),
+                name='unique_latest_version'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['repository_unique_id', '-local_version'], name='document_version_desc'),
         ]
 
+    objects = DocumentQuerySet.as_manager()
+
     # Title for convenience
     title = models.CharField(max_length=255, null=True, blank=True)
     description = models.TextField(null=False, blank=True, default="")
@@ -32,6 +54,9 @@ class Document(models.Model):
     repository_unique_id = models.CharField(max_length=1024, null=False, blank=False)
     # If remote doc is updated... create new version, don't overwrite
     local_version = models.IntegerField(default=1, blank=False, null=False)
+    # True only for the newest local_version of the document. Kept up to date by whatever creates new versions (see
+    # filter_document_jsons_to_new_and_newly_modified), in the same transaction.
+    is_latest = models.BooleanField(default=True, blank=False, null=False)
 
     # Want to be able to get back to the source URL (if possible)
     repository_url = models.CharField(max_length=1024, null=True, blank=True)
@@ -63,3 +88,51 @@ class Document(models.Model):
         null=False,
         upload_to=functools.partial(calc_pdf_file_path, sub_folder="pdf_files"),
     )
+
+
+class ExportJob(models.Model):
+    """
+    A PaperFiche export (StartExport) we're waiting on. Rather than have a worker sleep on each export, the
+    poll_export_jobs periodic task checks every outstanding token when it comes due (next_check) and queues the
+    download once the export reports finished.
+
+    Page range exports (start_page / end_page set) are single document GeneratePDF10 exports of one chunk of a big
+    document. Each chunk is downloaded to chunk_file, and the chunks are merged into the document's PDF once they're all
+    in (see merge_document_chunks).
+    """
+
+    PENDING = "pending"
+    FINISHED = "finished"
+    DOWNLOADED = "downloaded"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (FINISHED, "Finished"),
+        (DOWNLOADED, "Downloaded"),
+        (FAILED, "Failed"),
+    ]
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_check'], name='export_job_due'),
+        ]
+
+    token = models.CharField(max_length=255, unique=True, null=False, blank=False)
+    documents = models.ManyToManyField(Document, related_name="export_jobs")
+
+    status = models.CharField(max_length=32, choices=STATUS_CHOICES, default=PENDING, null=False, blank=False)
+    completion = models.IntegerField(default=0, null=False, blank=False)
+    error_message = models.TextField(null=False, blank=True, default="")
+
+    start_page = models.IntegerField(blank=True, null=True)
+    end_page = models.IntegerField(blank=True, null=True)
+    chunk_file = models.FileField(max_length=1024, blank=True, null=False, upload_to="export_chunks")
+
+    created = models.DateTimeField(auto_now_add=True, blank=False, null=False)
+    check_count = models.IntegerField(default=0, null=False, blank=False)
+    last_checked = models.DateTimeField(blank=True, null=True)
+    next_check = models.DateTimeField(default=timezone.now, blank=False, null=False)
+
+    @property
+    def is_page_range(self) -> bool:
+        return self.start_page is not None
@@ -4,7 +4,11 @@
 #  it under the terms of the GNU Affero General Public License as
 #  published by the Free Software Foundation, either version 3 of the
 #  License, or (at your option) any later version.
+import contextlib
+import logging
 import time
+import typing
+from datetime import datetime, timedelta
 #  This program is distributed in the hope that it will be useful,
 #  but WITHOUT ANY WARRANTY; without even the implied warranty of
 #  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
@@ -12,21 +16,57 @@ import time
 
 #  You should have received a copy of the GNU Affero General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from datetime import datetime
-
-from django.core.files.base import ContentFile
+import requests
+from celery.exceptions import Retry, SoftTimeLimitExceeded
+from django.conf import settings
+from django.core.files import File
 from django.utils import timezone
 from django.db import transaction
 from django.contrib.auth import get_user_model
 
 from fort_worth_crawler.api.client import download_bulk_pdfs, get_bulk_pdf_download_progress, request_bulk_pdf_export, \
-    get_document_metadata
-from fort_worth_crawler.documents.models import Document
+    get_entry_last_modified, parse_remote_datetime, new_spooled_file, request_single_pdf_export, \
+    get_single_pdf_download_progress, download_single_pdf
+from fort_worth_crawler.documents.exports import batch_documents_for_export, get_next_export_check, \
+    split_export_archive, get_page_ranges, page_ranges_cover_document, merge_pdf_chunks, get_expected_page_count
+from fort_worth_crawler.documents.metadata import get_document_metadata_cached
+from fort_worth_crawler.documents.models import Document, ExportJob
+from fort_worth_crawler.shared.log import sampled
 
 from config import celery_app
 
 User = get_user_model()
 
+# Logging setup
+logger = logging.getLogger(__name__)
+
+# Max seconds a poll_export_jobs run spends checking exports (keeps it well inside CELERY_TASK_SOFT_TIME_LIMIT)
+export_poll_time_budget_seconds = 40
+
+
+def get_latest_document_versions(
+    repository_unique_ids: typing.Iterable[str],
+    chunk_size: int
+) -> dict[str, tuple[int, datetime]]:
+    """
+    Looks up the newest local version we have of each document (is_latest), chunk_size ids per query.
+
+    :return: repository_unique_id -> (local_version, last_updated_on_remote) of its newest version, for the ids we have
+    """
+    repository_unique_ids = list(repository_unique_ids)
+    latest_versions = {}
+
+    for chunk_start in range(0, len(repository_unique_ids), chunk_size):
+        rows = Document.objects.latest_versions().filter(
+            repository_unique_id__in=repository_unique_ids[chunk_start:chunk_start + chunk_size]
+        ).values_list('repository_unique_id', 'local_version', 'last_updated_on_remote')
+        latest_versions.update(
+            (repository_unique_id, (local_version, last_updated_on_remote))
+            for repository_unique_id, local_version, last_updated_on_remote in rows
+        )
+
+    return latest_versions
+
 
 @celery_app.task()
 def filter_document_jsons_to_new_and_newly_modified(document_jsons: list[dict]) -> list[int]:
@@ -35,104 +75,580 @@ def filter_document_jsons_to_new_and_newly_modified(document_jsons: list[dict])
     looking up the entryId) or, if they are, that the date modified on the remote server is NEWER than what we have in
     our database.
 
+    Works set-wise rather than row by row: the newest version of every incoming entry is loaded in chunked queries, the
+    diff is done in memory, and the new documents / versions are inserted with chunked bulk_creates
+    (CRAWLER_DIFF_CHUNK_SIZE rows per query).
+
     :return: List of Document model ids we need to request docs for.
     """
 
-    entry_id_set = set()
-    doc_ids_to_process = []
+    chunk_size = settings.CRAWLER_DIFF_CHUNK_SIZE
+    latest_versions = get_latest_document_versions(
+        {f"{document_json['entryId']}" for document_json in document_jsons},
+        chunk_size=chunk_size
+    )
+    new_documents = []
+    # repository_unique_id -> the newest of the versions we're about to create for it
+    new_latest_documents = {}
 
-    for index, document_json in enumerate(document_jsons):
+    for document_json in document_jsons:
 
-        print(f"{index})\t{document_json}")
-
-        existing_entries = Document.objects.filter(
-            repository_unique_id=f"{document_json['entryId']}",
-            local_version=1
-        ).order_by('-last_updated_locally')
-        print(f"\t{existing_entries.count()} docs with repo id {document_json['entryId']}")
-
-        remote_last_updated_date_string = document_json['data'][10]
-        remote_last_updated_datetime = timezone.make_aware(datetime.strptime(
-            remote_last_updated_date_string,
-            '%m/%d/%Y %I:%M:%S %p'
-        ))
-
-        entry_id_set.add(f"{document_json['entryId']}")
+        entry_id = document_json['entryId']
+        repository_unique_id = f"{entry_id}"
+        remote_last_updated_datetime = timezone.make_aware(
+            parse_remote_datetime(get_entry_last_modified(document_json))
+        )
+        latest_version = latest_versions.get(repository_unique_id)
 
         # If document doesn't exist... create it
-        if existing_entries.count() == 0:
-            print("\tExisting entry count is 0")
-            with transaction.atomic():
-                new_doc = Document.objects.create(
-                    title=document_json['name'],
-                    repository_unique_id=f"{document_json['entryId']}",
-                    local_version=1,
-                    last_updated_on_remote=remote_last_updated_datetime,
-                    source_json=document_json
-                )
-            doc_ids_to_process.append(new_doc.id)
+        if latest_version is None:
+            logger.debug("New document", extra=sampled(100, entry_id=entry_id))
+            local_version = 1
 
         # IF it does exist, check if remote is newer, and, if so, upversion
+        elif latest_version[1] < remote_last_updated_datetime:
+            logger.debug("New version of document", extra={
+                "entry_id": entry_id,
+                "local_modified": latest_version[1].isoformat(),
+                "remote_modified": remote_last_updated_datetime.isoformat(),
+            })
+            local_version = latest_version[0] + 1
+
         else:
-            latest_entry = existing_entries[0]
-            print(f"\tExisting entry count is > 0... latest entry id is {latest_entry.repository_unique_id} with last modified "
-                  f"{latest_entry.last_updated_on_remote}... compare to current json of {remote_last_updated_datetime}")
-            if latest_entry.last_updated_on_remote < remote_last_updated_datetime:
-                print(f"\tCREATE NEW VERSION...")
-                with transaction.atomic():
-                    new_doc = Document.objects.create(
-                        title=document_json['name'],
-                        repository_unique_id=f"{document_json['entryId']}",
-                        local_version=latest_entry.local_version+1,
-                        last_updated_on_remote=remote_last_updated_datetime,
-                        source_json=document_json
-                    )
-                doc_ids_to_process.append(new_doc.id)
-            else:
-                print(f"\tDocument with entryId {document_json['entryId']} already up-to-date in database")
+            logger.debug("Document already up to date", extra=sampled(1000, entry_id=entry_id))
+            continue
 
-    print(f"UNIQUE ENTRY IDS: {len(entry_id_set)}")
+        new_doc = Document(
+            title=document_json['name'],
+            repository_unique_id=repository_unique_id,
+            local_version=local_version,
+            last_updated_on_remote=remote_last_updated_datetime,
+            source_json=document_json
+        )
+        new_documents.append(new_doc)
+
+        # The same entry can be listed more than once in a crawl - later rows diff against the version we just made
+        if repository_unique_id in new_latest_documents:
+            new_latest_documents[repository_unique_id].is_latest = False
+        new_latest_documents[repository_unique_id] = new_doc
+        latest_versions[repository_unique_id] = (local_version, remote_last_updated_datetime)
+
+    # Hand the is_latest flag over to the new versions in the same transaction, so there's always exactly one latest
+    # version of each document
+    upversioned_ids = [
+        new_doc.repository_unique_id for new_doc in new_latest_documents.values() if new_doc.local_version > 1
+    ]
+    with transaction.atomic():
+        for chunk_start in range(0, len(upversioned_ids), chunk_size):
+            Document.objects.latest_versions().filter(
+                repository_unique_id__in=upversioned_ids[chunk_start:chunk_start + chunk_size]
+            ).update(is_latest=False)
+        doc_ids_to_process = [
+            new_doc.id for new_doc in Document.objects.bulk_create(new_documents, batch_size=chunk_size)
+        ]
+
+    logger.info("Checked %s documents (%s unique entry ids), %s new or changed", len(document_jsons),
+                len(latest_versions), len(doc_ids_to_process))
 
     return doc_ids_to_process
 
 
 @celery_app.task()
-def fetch_document_pdf_and_metadata(document_pk: int):
-
-    print(f"Fetching doc data for database entry {document_pk}")
+def diff_and_fetch_documents(document_jsons: list[dict]) -> int:
+    """
+    Diffs one shard of a crawl's documents (see write_document_shards) and queues exports of the new or changed
+    documents (see queue_document_exports).
 
-    doc_obj = Document.objects.get(pk=document_pk)
+    :return: Number of new or changed documents in the shard
+    """
+    doc_ids = filter_document_jsons_to_new_and_newly_modified(document_jsons)
+    if doc_ids:
+        queue_document_exports(Document.objects.filter(pk__in=doc_ids).order_by('id'))
+    return len(doc_ids)
 
-    print("Fetch metadata...")
-    metadata = get_document_metadata(doc_obj.repository_unique_id)
-    print(f"Fetched: {metadata}")
 
-    attr_array = metadata['metadata']['fInfo']
-    counterparty = list(filter(lambda x: x['name'] == 'Vendor', attr_array))[0]['values'][0]
-    description = list(filter(lambda x: x['name'] == 'Subject', attr_array))[0]['values'][0]
-    project_number = list(filter(lambda x: x['name'] == 'Project Number/ID', attr_array))[0]['values'][0]
+def get_metadata_field_value(attr_array: list[dict], name: str) -> typing.Optional[str]:
+    """
+    First value of the named template field in a document's fInfo, or None if the document doesn't have it.
+    """
+    for field in attr_array:
+        if field.get('name') == name and field.get('values'):
+            return field['values'][0]
+    return None
 
-    print(f"Initiate PDF download")
-    bulk_download_token = request_bulk_pdf_export(entry_ids=[int(doc_obj.repository_unique_id)])
-    print(f"Download token: {bulk_download_token}")
-    download_status = get_bulk_pdf_download_progress(token=bulk_download_token)
-    print(f"Download status: {download_status}")
-    bulk_download_finished = download_status['finished']
 
-    while not bulk_download_finished:
-        print(f"Document pf {document_pk} download status: {download_status}")
-        download_status = get_bulk_pdf_download_progress(token=bulk_download_token)
-        bulk_download_finished = download_status['finished']
-        time.sleep(3)
+def apply_document_metadata(doc_obj: Document, metadata: dict):
+    """
+    Copies the fields we break out of GetBasicDocumentInfo metadata onto the document (without saving it). Template
+    fields the document doesn't have are left blank.
+    """
+    attr_array = metadata['metadata'].get('fInfo') or []
 
     doc_obj.custom_meta = metadata
-    doc_obj.tagged_counterparty = counterparty
-    doc_obj.description = description
-    doc_obj.project_number = project_number
+    doc_obj.tagged_counterparty = get_metadata_field_value(attr_array, 'Vendor')
+    doc_obj.description = get_metadata_field_value(attr_array, 'Subject') or ""
+    doc_obj.project_number = get_metadata_field_value(attr_array, 'Project Number/ID')
     doc_obj.page_count = metadata['pageCount']
     doc_obj.repository_folder_path = metadata['metadata']['path']
+
+
+def start_document_export(documents: list[Document]) -> ExportJob:
+    """
+    Kicks off a PaperFiche export of documents and hands its token over to be polled - by the poll_export_jobs periodic
+    task, or its own check_export_job_status task if CRAWLER_EXPORT_POLLING is "countdown". Either way,
+    download_export_job is queued once the export is ready.
+    """
+    bulk_download_token = request_bulk_pdf_export(
+        entry_ids=[int(doc_obj.repository_unique_id) for doc_obj in documents]
+    )
+    logger.debug("Started export %s of %s documents", bulk_download_token, len(documents))
+
+    with transaction.atomic():
+        export_job = ExportJob.objects.create(
+            token=bulk_download_token,
+            next_check=timezone.now() + timedelta(seconds=settings.CRAWLER_EXPORT_POLL_MIN_SECONDS)
+        )
+        export_job.documents.set(documents)
+
+    if settings.CRAWLER_EXPORT_POLLING == "countdown":
+        check_export_job_status.apply_async((export_job.pk,), countdown=settings.CRAWLER_EXPORT_POLL_MIN_SECONDS)
+
+    return export_job
+
+
+def start_page_range_export(doc_obj: Document, page_ranges: list[tuple[int, int]]) -> list[ExportJob]:
+    """
+    Kicks off a single document (GeneratePDF10) export of doc_obj for each of page_ranges and hands them over to be
+    polled, like start_document_export. Page range exports left over from an earlier attempt are thrown away.
+    """
+    for stale_chunk in doc_obj.export_jobs.filter(start_page__isnull=False).exclude(status=ExportJob.FAILED):
+        stale_chunk.chunk_file.delete(save=False)
+        stale_chunk.status = ExportJob.FAILED
+        stale_chunk.error_message = "Superseded by a newer export"
+        stale_chunk.save()
+
+    export_jobs = []
+    for start_page, end_page in page_ranges:
+        single_download_key = request_single_pdf_export(
+            entry_id=doc_obj.repository_unique_id,
+            start_page=start_page,
+            end_page=end_page
+        )
+        logger.debug("Started export %s of document %s pages %s-%s", single_download_key, doc_obj.pk, start_page,
+                     end_page)
+
+        with transaction.atomic():
+            export_job = ExportJob.objects.create(
+                token=single_download_key,
+                start_page=start_page,
+                end_page=end_page,
+                next_check=timezone.now() + timedelta(seconds=settings.CRAWLER_EXPORT_POLL_MIN_SECONDS)
+            )
+            export_job.documents.set([doc_obj])
+        export_jobs.append(export_job)
+
+        if settings.CRAWLER_EXPORT_POLLING == "countdown":
+            check_export_job_status.apply_async((export_job.pk,), countdown=settings.CRAWLER_EXPORT_POLL_MIN_SECONDS)
+
+    return export_jobs
+
+
+def start_chunked_document_export(doc_obj: Document) -> list[ExportJob]:
+    """
+    Exports a big document as page range chunks of CRAWLER_EXPORT_CHUNK_PAGES pages, which are exported and downloaded
+    in parallel and merged back together by merge_document_chunks.
+    """
+    return start_page_range_export(doc_obj, get_page_ranges(doc_obj.page_count, settings.CRAWLER_EXPORT_CHUNK_PAGES))
+
+
+def start_single_document_export(doc_obj: Document) -> ExportJob:
+    """
+    Exports a document through the single document path (GeneratePDF10 -> PDFTransition -> PDF10), which skips the
+    ZIP packaging of the bulk export and streams the PDF straight to pdf_file.
+    """
+    return start_page_range_export(doc_obj, [(1, doc_obj.page_count)])[0]
+
+
+def should_export_in_chunks(doc_obj: Document) -> bool:
+    return get_expected_page_count(doc_obj) >= settings.CRAWLER_EXPORT_CHUNK_MIN_PAGES
+
+
+def should_export_individually(doc_obj: Document) -> bool:
+    return settings.CRAWLER_EXPORT_METHOD == "single" and get_expected_page_count(doc_obj) > 0
+
+
+def queue_document_exports(documents: typing.Iterable[Document]) -> int:
+    """
+    Groups documents into export batches (see batch_documents_for_export) and queues an export_document_batch task for
+    each. Documents big enough to be exported in page range chunks, or all of them if CRAWLER_EXPORT_METHOD is
+    "single", go through fetch_document_pdf_and_metadata on their own instead.
+
+    :return: Number of batches queued
+    """
+    batchable_documents = []
+    for doc_obj in documents:
+        if should_export_in_chunks(doc_obj) or should_export_individually(doc_obj):
+            fetch_document_pdf_and_metadata.delay(doc_obj.pk)
+        else:
+            batchable_documents.append(doc_obj)
+
+    batches = batch_documents_for_export(
+        batchable_documents,
+        max_pages=settings.CRAWLER_EXPORT_BATCH_MAX_PAGES,
+        max_documents=settings.CRAWLER_EXPORT_BATCH_MAX_DOCUMENTS
+    )
+
+    for batch in batches:
+        export_document_batch.delay([doc_obj.pk for doc_obj in batch])
+
+    return len(batches)
+
+
+def get_documents_awaiting_export():
+    """
+    Documents still missing their PDF that aren't already waiting on an export.
+    """
+    return Document.objects.filter(pdf_file="").exclude(
+        export_jobs__status__in=[ExportJob.PENDING, ExportJob.FINISHED]
+    ).distinct()
+
+
+# Single document pipeline. Each step is its own short task that queues the next, so no worker is tied up waiting on
+# PaperFiche:
+#
+#   fetch_document_pdf_and_metadata -> request_document_export -> (export polling) -> download_export_job
+#                                                                                       (-> merge_document_chunks)
+#
+# Metadata comes first because the document's PDF is stored under its repository path and name, and it's what tells
+# us whether the document is big enough to export in page range chunks.
+
+@celery_app.task()
+def fetch_document_pdf_and_metadata(document_pk: int):
+
+    logger.debug("Fetching metadata for document %s", document_pk)
+
+    doc_obj = Document.objects.get(pk=document_pk)
+    metadata = get_document_metadata_cached(doc_obj)
+
+    apply_document_metadata(doc_obj, metadata)
     doc_obj.save()
 
-    pdf_file = ContentFile(download_bulk_pdfs(bulk_download_token=bulk_download_token))
-    doc_obj.pdf_file.save(f"{metadata['name']}.pdf", pdf_file)
+    request_document_export.delay(document_pk)
+
+
+@celery_app.task()
+def request_document_export(document_pk: int):
+    doc_obj = Document.objects.get(pk=document_pk)
+    if should_export_in_chunks(doc_obj):
+        start_chunked_document_export(doc_obj)
+    elif should_export_individually(doc_obj):
+        start_single_document_export(doc_obj)
+    else:
+        start_document_export([doc_obj])
+
+
+@celery_app.task()
+def queue_pending_document_exports() -> int:
+    """
+    Periodic sweep picking up documents whose export fell through the cracks (e.g. a failed export, or a lost task) and
+    queueing them again (see queue_document_exports). Documents scraped in the last CRAWLER_EXPORT_SWEEP_GRACE_MINUTES
+    are left to the sync pipeline, which queues their exports itself.
+
+    :return: Number of batches queued
+    """
+    return queue_document_exports(get_documents_awaiting_export().filter(
+        first_scraped__lt=timezone.now() - timedelta(minutes=settings.CRAWLER_EXPORT_SWEEP_GRACE_MINUTES)
+    ).order_by('id').iterator())
+
+
+@celery_app.task(bind=True, max_retries=3)
+def export_document_batch(self, document_pks: list[int]):
+    """
+    Exports a batch of documents with a single PaperFiche export, which download_export_job splits back onto each
+    document's pdf_file once it's ready. Documents that have picked up a PDF or an export since they were queued are
+    dropped from the batch.
+
+    If a document's metadata can't be fetched, the whole batch is retried (metadata already fetched is cached). Once
+    the retries run out, its documents are left to queue_pending_document_exports.
+    """
+    documents = list(get_documents_awaiting_export().filter(pk__in=document_pks).order_by('id'))
+
+    for doc_obj in documents:
+        try:
+            metadata = get_document_metadata_cached(doc_obj)
+        except requests.RequestException as exc:
+            raise self.retry(exc=exc, countdown=settings.CRAWLER_EXPORT_POLL_MIN_SECONDS)
+        apply_document_metadata(doc_obj, metadata)
+        doc_obj.save()
+
+    if documents:
+        start_document_export(documents)
+
+
+def check_export_job(export_job: ExportJob):
+    """
+    Asks PaperFiche how export_job is getting on and records the answer, scheduling the next check if it's still
+    running and queueing the download if it's finished.
+    """
+    if export_job.is_page_range:
+        download_status = get_single_pdf_download_progress(download_token=export_job.token)
+        error_message = download_status['errMsg']
+    else:
+        download_status = get_bulk_pdf_download_progress(token=export_job.token)
+        error_message = download_status['errorMessage']
+    logger.debug("Export %s status: %s", export_job.token, download_status)
+
+    now = timezone.now()
+    export_job.check_count += 1
+    export_job.last_checked = now
+    export_job.completion = download_status['completion'] or 0
+
+    if error_message:
+        export_job.status = ExportJob.FAILED
+        export_job.error_message = str(error_message)
+    elif download_status['finished']:
+        export_job.status = ExportJob.FINISHED
+    elif now - export_job.created > timedelta(hours=settings.CRAWLER_EXPORT_TIMEOUT_HOURS):
+        export_job.status = ExportJob.FAILED
+        export_job.error_message = f"Export didn't finish within {settings.CRAWLER_EXPORT_TIMEOUT_HOURS} hours"
+    else:
+        export_job.next_check = get_next_export_check(
+            export_job,
+            completion=export_job.completion,
+            now=now,
+            min_interval_seconds=settings.CRAWLER_EXPORT_POLL_MIN_SECONDS,
+            max_interval_seconds=settings.CRAWLER_EXPORT_POLL_MAX_SECONDS
+        )
+
+    export_job.save()
+
+    if export_job.status == ExportJob.FINISHED:
+        download_export_job.delay(export_job.pk)
+    elif export_job.status == ExportJob.FAILED:
+        restart_failed_chunked_export(export_job)
+
+
+def restart_failed_chunked_export(export_job: ExportJob):
+    """
+    A document whose page range chunk failed can never be merged, so rather than leave its other chunks (and their
+    downloaded chunk files) waiting on it, the document is exported again from the start - start_page_range_export
+    throws the old chunks away. Does nothing for anything but a chunk.
+    """
+    if not export_job.is_page_range:
+        return
+
+    doc_obj = export_job.documents.get()
+    if doc_obj.pdf_file or (export_job.start_page, export_job.end_page) == (1, doc_obj.page_count):
+        return
+
+    logger.warning("Chunk %s-%s of document %s failed, exporting the document again", export_job.start_page,
+                   export_job.end_page, doc_obj.pk)
+    request_document_export.delay(doc_obj.pk)
+
+
+def claim_export_job(export_job: ExportJob) -> bool:
+    """
+    Claims export_job for a status check by pushing its next check out, so a concurrent poller run (or a duplicate
+    check_export_job_status task) skips it. Returns False if someone else got there first.
+    """
+    return ExportJob.objects.filter(
+        pk=export_job.pk,
+        status=ExportJob.PENDING,
+        next_check=export_job.next_check
+    ).update(next_check=timezone.now() + timedelta(seconds=settings.CRAWLER_EXPORT_POLL_MAX_SECONDS)) > 0
+
+
+@celery_app.task(bind=True)
+def check_export_job_status(self, export_job_pk: int):
+    """
+    Countdown polling (CRAWLER_EXPORT_POLLING = "countdown"): checks on a single export and, while it's still running,
+    reschedules itself for the export's next check (see get_next_export_check) rather than sleeping in the worker.
+    """
+    export_job = ExportJob.objects.get(pk=export_job_pk)
+    if not claim_export_job(export_job):
+        return
+
+    check_export_job(export_job)
+
+    if export_job.status == ExportJob.PENDING:
+        self.apply_async((export_job_pk,), countdown=max(0.0, (export_job.next_check - timezone.now()).total_seconds()))
+
+
+@celery_app.task()
+def poll_export_jobs() -> int:
+    """
+    Periodic task (see CELERY_BEAT_SCHEDULE). Checks on every outstanding export that's due a check, within a time
+    budget that keeps the run well inside CELERY_TASK_SOFT_TIME_LIMIT - anything left over waits for the next run.
+
+    With countdown polling, each export polls itself, so this only picks up exports whose check_export_job_status task
+    went missing (e.g. lost in a broker restart) and sets them polling again.
+
+    :return: Number of exports checked (or re-queued)
+    """
+    started = time.monotonic()
+    checked = 0
+    countdown_polling = settings.CRAWLER_EXPORT_POLLING == "countdown"
+
+    due_before = timezone.now()
+    if countdown_polling:
+        due_before -= timedelta(seconds=settings.CRAWLER_EXPORT_POLL_MAX_SECONDS)
+
+    due_export_jobs = ExportJob.objects.filter(
+        status=ExportJob.PENDING,
+        next_check__lte=due_before
+    ).order_by('next_check')
+
+    for export_job in due_export_jobs.iterator():
+        if time.monotonic() - started > export_poll_time_budget_seconds:
+            break
+
+        if countdown_polling:
+            check_export_job_status.delay(export_job.pk)
+            checked += 1
+        elif claim_export_job(export_job):
+            check_export_job(export_job)
+            checked += 1
+
+    return checked
+
+
+@celery_app.task(
+    bind=True,
+    soft_time_limit=settings.CRAWLER_EXPORT_DOWNLOAD_SOFT_TIME_LIMIT,
+    time_limit=settings.CRAWLER_EXPORT_DOWNLOAD_TIME_LIMIT,
+    max_retries=3
+)
+def download_export_job(self, export_job_pk: int):
+    """
+    Streams a finished export down and saves each document's PDF out of it. Documents we can't find in a multi-document
+    export fall back to their own fetch_document_pdf_and_metadata export.
+
+    Big exports can take a while to download, so this task gets its own (longer) time limits. If it still runs out of
+    time it retries the download from the same finished export, rather than starting the export over, and skips any
+    documents that were already saved.
+
+    If the download fails any other way, or runs out of retries, the export is marked failed, so its documents are
+    picked up again by queue_pending_document_exports rather than left waiting on it forever.
+    """
+    export_job = ExportJob.objects.get(pk=export_job_pk)
+
+    try:
+        if export_job.is_page_range:
+            download_page_range_export(self, export_job)
+        else:
+            download_document_export(self, export_job)
+    except Retry:
+        raise
+    except Exception as exc:
+        ExportJob.objects.filter(pk=export_job.pk).update(status=ExportJob.FAILED,
+                                                          error_message=f"Download failed: {exc!r}")
+        restart_failed_chunked_export(export_job)
+        raise
+
+
+def download_document_export(task, export_job: ExportJob):
+    """
+    download_export_job for (multi-)document exports.
+    """
+    documents = list(export_job.documents.filter(pdf_file="").order_by('id'))
+    pdfs = {}
+
+    try:
+        # Stream the export through a spooled temp file, so it's never held in memory in full
+        with new_spooled_file() as export_file:
+            if documents:
+                download_bulk_pdfs(bulk_download_token=export_job.token, destination=export_file)
+                pdfs = split_export_archive(export_file, documents)
+
+            for doc_obj in documents:
+                if doc_obj.pk in pdfs:
+                    with pdfs[doc_obj.pk] as pdf_file:
+                        doc_obj.pdf_file.save(f"{doc_obj.custom_meta['name']}.pdf", File(pdf_file))
+                elif len(documents) > 1:
+                    logger.info("Document %s not found in batch export, fetching it on its own", doc_obj.pk)
+                    fetch_document_pdf_and_metadata.delay(doc_obj.pk)
+                else:
+                    logger.warning("Document %s not found in its export", doc_obj.pk)
+    except SoftTimeLimitExceeded:
+        raise task.retry(countdown=settings.CRAWLER_EXPORT_POLL_MIN_SECONDS)
+
+    export_job.status = ExportJob.DOWNLOADED if pdfs or not documents else ExportJob.FAILED
+    export_job.save(update_fields=['status'])
+
+
+def download_page_range_export(task, export_job: ExportJob):
+    """
+    download_export_job for page range exports. An export of the whole document is streamed straight to its pdf_file.
+    A chunk is streamed to export_job.chunk_file and, if it was the document's last chunk outstanding,
+    merge_document_chunks is queued.
+    """
+    doc_obj = export_job.documents.get()
+    whole_document = (export_job.start_page, export_job.end_page) == (1, doc_obj.page_count)
+
+    try:
+        with new_spooled_file() as pdf_file:
+            download_single_pdf(single_download_key=export_job.token, entry_id=doc_obj.repository_unique_id,
+                                destination=pdf_file)
+            if whole_document:
+                doc_obj.pdf_file.save(f"{doc_obj.custom_meta['name']}.pdf", File(pdf_file))
+            else:
+                export_job.chunk_file.save(f"{export_job.token}.pdf", File(pdf_file), save=False)
+    except SoftTimeLimitExceeded:
+        raise task.retry(countdown=settings.CRAWLER_EXPORT_POLL_MIN_SECONDS)
+
+    export_job.status = ExportJob.DOWNLOADED
+    export_job.save(update_fields=['chunk_file', 'status'])
+
+    # Whichever chunk finishes last sees nothing outstanding (two finishing together may both queue the merge, which
+    # merge_document_chunks is fine with)
+    if not whole_document and not doc_obj.export_jobs.filter(
+        start_page__isnull=False,
+        status__in=[ExportJob.PENDING, ExportJob.FINISHED]
+    ).exists():
+        merge_document_chunks.delay(doc_obj.pk)
+
+
+@celery_app.task(
+    soft_time_limit=settings.CRAWLER_EXPORT_DOWNLOAD_SOFT_TIME_LIMIT,
+    time_limit=settings.CRAWLER_EXPORT_DOWNLOAD_TIME_LIMIT
+)
+def merge_document_chunks(document_pk: int):
+    """
+    Merges a document's downloaded page range chunks into its pdf_file, checking the result has the page count
+    PaperFiche gave us for it. If the chunks don't add up, they're marked failed so queue_pending_document_exports
+    picks the document up again.
+    """
+    with transaction.atomic():
+        # Lock the document, so a second merge queued for it waits and then finds the PDF already saved
+        doc_obj = Document.objects.select_for_update().get(pk=document_pk)
+        if doc_obj.pdf_file:
+            return
+
+        chunk_jobs = list(doc_obj.export_jobs.filter(
+            start_page__isnull=False,
+            status=ExportJob.DOWNLOADED
+        ).exclude(chunk_file="").order_by('start_page'))
+
+        if not page_ranges_cover_document([(job.start_page, job.end_page) for job in chunk_jobs], doc_obj.page_count):
+            logger.warning("Chunks for document %s don't cover its %s pages, not merging", document_pk,
+                           doc_obj.page_count)
+            return
+
+        with contextlib.ExitStack() as stack, new_spooled_file() as pdf_file:
+            merged_page_count = merge_pdf_chunks(
+                [stack.enter_context(job.chunk_file.open('rb')) for job in chunk_jobs],
+                pdf_file
+            )
+            if merged_page_count == doc_obj.page_count:
+                doc_obj.pdf_file.save(f"{doc_obj.custom_meta['name']}.pdf", File(pdf_file))
+
+    if merged_page_count != doc_obj.page_count:
+        logger.warning("Merged PDF for document %s has %s pages, expected %s", document_pk, merged_page_count,
+                       doc_obj.page_count)
 
+    for job in chunk_jobs:
+        job.chunk_file.delete(save=False)
+        if merged_page_count != doc_obj.page_count:
+            job.status = ExportJob.FAILED
+            job.error_message = f"Merged chunks had {merged_page_count} pages, expected {doc_obj.page_count}"
+        job.save()
@@ -1,3 +1,399 @@
-from django.test import TestCase
+import io
+import zipfile
+from datetime import timedelta
 
-# Create your tests here.
+import pytest
+import requests
+from django.core.cache import cache
+from django.utils import timezone
+from pypdf import PdfReader, PdfWriter
+
+from fort_worth_crawler.api.client import parse_remote_datetime
+from fort_worth_crawler.documents import metadata as document_metadata
+from fort_worth_crawler.documents import tasks as document_tasks
+from fort_worth_crawler.documents.exports import batch_documents_for_export, get_next_export_check, \
+    split_export_archive
+from fort_worth_crawler.documents.models import Document, ExportJob
+
+from config import celery_app
+
+pytestmark = pytest.mark.django_db
+
+sample_metadata = {
+    "name": "Contract 36651 Volume 1",
+    "id": 188176,
+    "metadata": {"path": "\\0 CS Records Management\\Contract 36651 Volume 1", "fInfo": []},
+    "pageCount": 576,
+}
+
+
+def test_metadata_reused_across_versions_with_same_remote_date(monkeypatch):
+    cache.clear()
+    remote_modified = timezone.now().replace(microsecond=0)
+    requested_entry_ids = []
+
+    def get_document_metadata(entry_id: str) -> dict:
+        requested_entry_ids.append(entry_id)
+        return sample_metadata
+
+    monkeypatch.setattr(document_metadata, "get_document_metadata", get_document_metadata)
+
+    Document.objects.create(repository_unique_id="188176", local_version=1, last_updated_on_remote=remote_modified,
+                            custom_meta=sample_metadata, is_latest=False)
+    second_version = Document.objects.create(repository_unique_id="188176", local_version=2, is_latest=False,
+                                             last_updated_on_remote=remote_modified)
+    assert document_metadata.get_document_metadata_cached(second_version) == sample_metadata
+    assert requested_entry_ids == []
+
+    changed_version = Document.objects.create(repository_unique_id="188176", local_version=3,
+                                              last_updated_on_remote=remote_modified + timedelta(days=1))
+    assert document_metadata.get_document_metadata_cached(changed_version) == sample_metadata
+    assert document_metadata.get_document_metadata_cached(changed_version) == sample_metadata
+    assert requested_entry_ids == ["188176"]
+
+
+def test_batch_documents_for_export_respects_page_and_document_limits():
+    documents = [
+        Document(pk=index, title=f"Document {index}", page_count=page_count, last_updated_on_remote=timezone.now())
+        for index, page_count in enumerate([100, 100, 900, 50, 5000, 10, 10, 10], start=1)
+    ]
+
+    batches = batch_documents_for_export(documents, max_pages=1000, max_documents=3)
+
+    assert [[doc_obj.pk for doc_obj in batch] for batch in batches] == [[1, 2], [3, 4], [5], [6, 7, 8]]
+
+
+def test_split_export_archive_matches_members_by_name():
+    documents = [
+        Document(pk=1, title="Contract 1", last_updated_on_remote=timezone.now()),
+        Document(pk=2, title="Contract 2", last_updated_on_remote=timezone.now()),
+        Document(pk=3, title="Duplicate", last_updated_on_remote=timezone.now()),
+        Document(pk=4, title="Duplicate", last_updated_on_remote=timezone.now()),
+        Document(pk=5, title="Missing", last_updated_on_remote=timezone.now()),
+    ]
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr("Contract 1.pdf", b"%PDF-1")
+        zip_file.writestr("export/Contract 2.PDF", b"%PDF-2")
+        zip_file.writestr("Duplicate.pdf", b"%PDF-3")
+
+    pdfs = split_export_archive(archive, documents)
+    assert {pk: pdf_file.read() for pk, pdf_file in pdfs.items()} == {1: b"%PDF-1", 2: b"%PDF-2"}
+    assert split_export_archive(io.BytesIO(b"%PDF-1"), documents[:1])[1].read() == b"%PDF-1"
+    assert split_export_archive(io.BytesIO(b"%PDF-1"), documents[:2]) == {}
+
+
+def test_next_export_check_follows_progress_then_backs_off():
+    now = timezone.now()
+    export_job = ExportJob(token="token", created=now - timedelta(seconds=60), check_count=3)
+
+    # 25% done after a minute -> about three minutes to go, so check again in about a minute and a half
+    assert get_next_export_check(export_job, completion=25, now=now, min_interval_seconds=5,
+                                 max_interval_seconds=120) == now + timedelta(seconds=90)
+    # No progress yet -> exponential backoff, clamped
+    assert get_next_export_check(export_job, completion=0, now=now, min_interval_seconds=5,
+                                 max_interval_seconds=120) == now + timedelta(seconds=40)
+    assert get_next_export_check(export_job, completion=1, now=now, min_interval_seconds=5,
+                                 max_interval_seconds=120) == now + timedelta(seconds=120)
+
+
+def test_poll_export_jobs_dispatches_finished_exports(monkeypatch, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    doc_obj = Document.objects.create(repository_unique_id="188176", last_updated_on_remote=timezone.now(),
+                                      title=sample_metadata['name'], custom_meta=sample_metadata,
+                                      repository_folder_path=sample_metadata['metadata']['path'])
+    running = ExportJob.objects.create(token="running", next_check=timezone.now())
+    finished = ExportJob.objects.create(token="finished", next_check=timezone.now())
+    not_due = ExportJob.objects.create(token="not-due", next_check=timezone.now() + timedelta(minutes=5))
+    finished.documents.set([doc_obj])
+    checked_tokens = []
+
+    def get_bulk_pdf_download_progress(token: str) -> dict:
+        checked_tokens.append(token)
+        return {"finished": token == "finished", "errorMessage": None, "token": token,
+                "completion": 100 if token == "finished" else 0}
+
+    def download_bulk_pdfs(bulk_download_token: str, destination) -> int:
+        destination.write(b"%PDF-1")
+        destination.seek(0)
+        return 6
+
+    monkeypatch.setattr(document_tasks, "get_bulk_pdf_download_progress", get_bulk_pdf_download_progress)
+    monkeypatch.setattr(document_tasks, "download_bulk_pdfs", download_bulk_pdfs)
+    monkeypatch.setattr(document_tasks.download_export_job, "delay", document_tasks.download_export_job)
+
+    assert document_tasks.poll_export_jobs() == 2
+    assert sorted(checked_tokens) == ["finished", "running"]
+
+    running.refresh_from_db()
+    assert running.status == ExportJob.PENDING
+    assert running.next_check > timezone.now()
+    not_due.refresh_from_db()
+    assert not_due.check_count == 0
+
+    finished.refresh_from_db()
+    doc_obj.refresh_from_db()
+    assert finished.status == ExportJob.DOWNLOADED
+    assert doc_obj.pdf_file.read() == b"%PDF-1"
+
+
+def test_failed_download_marks_export_job_failed(monkeypatch):
+    doc_obj = Document.objects.create(repository_unique_id="188176", last_updated_on_remote=timezone.now(),
+                                      title=sample_metadata['name'], custom_meta=sample_metadata,
+                                      repository_folder_path=sample_metadata['metadata']['path'])
+    export_job = ExportJob.objects.create(token="finished", next_check=timezone.now(), status=ExportJob.FINISHED)
+    export_job.documents.set([doc_obj])
+
+    def download_bulk_pdfs(bulk_download_token: str, destination) -> int:
+        raise requests.exceptions.ChunkedEncodingError()
+
+    monkeypatch.setattr(document_tasks, "download_bulk_pdfs", download_bulk_pdfs)
+
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        document_tasks.download_export_job(export_job.pk)
+
+    export_job.refresh_from_db()
+    assert export_job.status == ExportJob.FAILED
+    assert "ChunkedEncodingError" in export_job.error_message
+    # So the document is no longer stuck waiting on it
+    assert list(document_tasks.get_documents_awaiting_export()) == [doc_obj]
+
+def test_countdown_polling_reschedules_until_export_finishes(monkeypatch, settings):
+    settings.CRAWLER_EXPORT_POLLING = "countdown"
+    doc_obj = Document.objects.create(repository_unique_id="188176", last_updated_on_remote=timezone.now())
+    completions = iter([0, 40, 100])
+    rescheduled = []
+    downloaded = []
+
+    monkeypatch.setattr(document_tasks, "request_bulk_pdf_export", lambda entry_ids: "token")
+    monkeypatch.setattr(document_tasks, "get_bulk_pdf_download_progress", lambda token: (
+        lambda completion: {"finished": completion == 100, "errorMessage": None, "token": token,
+                            "completion": completion}
+    )(next(completions)))
+    monkeypatch.setattr(document_tasks.check_export_job_status, "apply_async",
+                        lambda args, countdown: rescheduled.append(countdown))
+    monkeypatch.setattr(document_tasks.download_export_job, "delay", downloaded.append)
+
+    export_job = document_tasks.start_document_export([doc_obj])
+    assert rescheduled == [settings.CRAWLER_EXPORT_POLL_MIN_SECONDS]
+
+    for _ in range(3):
+        ExportJob.objects.filter(pk=export_job.pk).update(next_check=timezone.now())
+        document_tasks.check_export_job_status(export_job.pk)
+
+    export_job.refresh_from_db()
+    assert export_job.status == ExportJob.FINISHED
+    assert export_job.check_count == 3
+    assert len(rescheduled) == 3 and all(countdown > 0 for countdown in rescheduled)
+    assert downloaded == [export_job.pk]
+
+    # Nothing left for the sweeper to pick up
+    assert document_tasks.poll_export_jobs() == 0
+
+
+def blank_pdf(page_count: int) -> bytes:
+    writer = PdfWriter()
+    for _ in range(page_count):
+        writer.add_blank_page(width=612, height=792)
+    pdf_file = io.BytesIO()
+    writer.write(pdf_file)
+    return pdf_file.getvalue()
+
+
+def test_big_documents_are_exported_in_page_range_chunks_and_merged(monkeypatch, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.CRAWLER_EXPORT_CHUNK_MIN_PAGES = 3
+    settings.CRAWLER_EXPORT_CHUNK_PAGES = 2
+    doc_obj = Document.objects.create(repository_unique_id="188176", last_updated_on_remote=timezone.now(),
+                                      title=sample_metadata['name'], custom_meta=sample_metadata, page_count=5,
+                                      repository_folder_path=sample_metadata['metadata']['path'])
+    page_ranges = {}
+
+    def request_single_pdf_export(entry_id: str, start_page: int, end_page: int) -> str:
+        page_ranges[f"key-{start_page}"] = (start_page, end_page)
+        return f"key-{start_page}"
+
+    def download_single_pdf(single_download_key: str, entry_id: str, destination) -> int:
+        start_page, end_page = page_ranges[single_download_key]
+        destination.write(blank_pdf(end_page - start_page + 1))
+        destination.seek(0)
+        return destination.tell()
+
+    monkeypatch.setattr(document_tasks, "request_single_pdf_export", request_single_pdf_export)
+    monkeypatch.setattr(document_tasks, "download_single_pdf", download_single_pdf)
+    monkeypatch.setattr(document_tasks, "get_single_pdf_download_progress", lambda download_token: {
+        "errMsg": None, "success": True, "finished": True, "completion": 100
+    })
+    monkeypatch.setattr(document_tasks.download_export_job, "delay", document_tasks.download_export_job)
+    monkeypatch.setattr(document_tasks.merge_document_chunks, "delay", document_tasks.merge_document_chunks)
+
+    document_tasks.request_document_export(doc_obj.pk)
+    assert sorted(page_ranges.values()) == [(1, 2), (3, 4), (5, 5)]
+
+    ExportJob.objects.update(next_check=timezone.now())
+    assert document_tasks.poll_export_jobs() == 3
+
+    doc_obj.refresh_from_db()
+    assert len(PdfReader(doc_obj.pdf_file.open('rb')).pages) == 5
+    assert not ExportJob.objects.exclude(chunk_file="").exists()
+    assert set(ExportJob.objects.values_list('status', flat=True)) == {ExportJob.DOWNLOADED}
+
+
+def test_failed_chunk_restarts_the_document_export(monkeypatch, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.CRAWLER_EXPORT_CHUNK_MIN_PAGES = 3
+    settings.CRAWLER_EXPORT_CHUNK_PAGES = 2
+    doc_obj = Document.objects.create(repository_unique_id="188176", last_updated_on_remote=timezone.now(),
+                                      title=sample_metadata['name'], custom_meta=sample_metadata, page_count=5,
+                                      repository_folder_path=sample_metadata['metadata']['path'])
+    page_ranges = {}
+
+    def request_single_pdf_export(entry_id: str, start_page: int, end_page: int) -> str:
+        single_download_key = f"key-{len(page_ranges)}"
+        page_ranges[single_download_key] = (start_page, end_page)
+        return single_download_key
+
+    def download_single_pdf(single_download_key: str, entry_id: str, destination) -> int:
+        start_page, end_page = page_ranges[single_download_key]
+        destination.write(blank_pdf(end_page - start_page + 1))
+        destination.seek(0)
+        return destination.tell()
+
+    # The first export of pages 3-4 fails
+    monkeypatch.setattr(document_tasks, "get_single_pdf_download_progress", lambda download_token: {
+        "errMsg": "Export failed" if download_token == "key-1" else None, "success": True, "finished": True,
+        "completion": 100
+    })
+    monkeypatch.setattr(document_tasks, "request_single_pdf_export", request_single_pdf_export)
+    monkeypatch.setattr(document_tasks, "download_single_pdf", download_single_pdf)
+    monkeypatch.setattr(document_tasks.download_export_job, "delay", document_tasks.download_export_job)
+    monkeypatch.setattr(document_tasks.merge_document_chunks, "delay", document_tasks.merge_document_chunks)
+    monkeypatch.setattr(document_tasks.request_document_export, "delay", document_tasks.request_document_export)
+
+    document_tasks.request_document_export(doc_obj.pk)
+    # Pages 1-2 are downloaded before pages 3-4 fail
+    for minutes, token in enumerate(["key-0", "key-1", "key-2"]):
+        ExportJob.objects.filter(token=token).update(next_check=timezone.now() - timedelta(minutes=3 - minutes))
+    document_tasks.poll_export_jobs()
+
+    # The whole chunk set is thrown away, downloaded chunk files and all, and the document exported again
+    assert not ExportJob.objects.exclude(chunk_file="").exists()
+    assert sorted(ExportJob.objects.filter(status=ExportJob.PENDING).values_list('start_page', 'end_page')) == \
+        [(1, 2), (3, 4), (5, 5)]
+
+    ExportJob.objects.filter(status=ExportJob.PENDING).update(next_check=timezone.now())
+    assert document_tasks.poll_export_jobs() == 3
+
+    doc_obj.refresh_from_db()
+    assert len(PdfReader(doc_obj.pdf_file.open('rb')).pages) == 5
+    assert not ExportJob.objects.exclude(chunk_file="").exists()
+
+def test_single_export_method_streams_straight_to_pdf_file(monkeypatch, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.CRAWLER_EXPORT_METHOD = "single"
+    doc_obj = Document.objects.create(repository_unique_id="188176", last_updated_on_remote=timezone.now(),
+                                      title=sample_metadata['name'], custom_meta=sample_metadata, page_count=3,
+                                      repository_folder_path=sample_metadata['metadata']['path'])
+    requested_ranges = []
+
+    def request_single_pdf_export(entry_id: str, start_page: int, end_page: int) -> str:
+        requested_ranges.append((start_page, end_page))
+        return "key"
+
+    def download_single_pdf(single_download_key: str, entry_id: str, destination) -> int:
+        destination.write(blank_pdf(3))
+        destination.seek(0)
+        return destination.tell()
+
+    monkeypatch.setattr(document_tasks, "request_single_pdf_export", request_single_pdf_export)
+    monkeypatch.setattr(document_tasks, "download_single_pdf", download_single_pdf)
+    monkeypatch.setattr(document_tasks, "get_single_pdf_download_progress", lambda download_token: {
+        "errMsg": None, "success": True, "finished": True, "completion": 100
+    })
+    monkeypatch.setattr(document_tasks.download_export_job, "delay", document_tasks.download_export_job)
+    monkeypatch.setattr(document_tasks.merge_document_chunks, "delay", lambda document_pk: pytest.fail("merged"))
+    # Metadata's already in place
+    monkeypatch.setattr(document_tasks.fetch_document_pdf_and_metadata, "delay", document_tasks.request_document_export)
+    settings.CRAWLER_EXPORT_SWEEP_GRACE_MINUTES = 0
+
+    assert document_tasks.queue_pending_document_exports() == 0
+    ExportJob.objects.update(next_check=timezone.now())
+    assert document_tasks.poll_export_jobs() == 1
+
+    doc_obj.refresh_from_db()
+    assert requested_ranges == [(1, 3)]
+    assert len(PdfReader(doc_obj.pdf_file.open('rb')).pages) == 3
+    assert not ExportJob.objects.exclude(chunk_file="").exists()
+
+
+def test_diff_against_latest_versions_in_bulk(settings, django_assert_max_num_queries):
+    settings.CRAWLER_DIFF_CHUNK_SIZE = 2
+    unchanged_date = "1/6/2020 3:45:52 PM"
+    changed_date = "11/13/2022 1:00:00 PM"
+    old_remote_modified = timezone.make_aware(parse_remote_datetime(unchanged_date))
+
+    Document.objects.create(repository_unique_id="1", local_version=1, is_latest=False,
+                            last_updated_on_remote=old_remote_modified - timedelta(days=30))
+    Document.objects.create(repository_unique_id="1", local_version=2, last_updated_on_remote=old_remote_modified)
+    Document.objects.create(repository_unique_id="2", local_version=1, last_updated_on_remote=old_remote_modified)
+
+    def listing_row(entry_id: int, modified: str) -> dict:
+        return {"entryId": entry_id, "name": f"Contract {entry_id}", "type": -1, "targetType": 0,
+                "data": [f"Contract {entry_id}", 1, None, None, None, None, entry_id, None, None, None, modified,
+                         modified]}
+
+    document_jsons = [
+        listing_row(1, unchanged_date),
+        listing_row(2, changed_date),
+        listing_row(3, unchanged_date),
+        listing_row(3, unchanged_date),  # Listed twice in the same crawl
+        listing_row(4, changed_date),
+    ]
+
+    # 2 lookup chunks, 1 is_latest handover and 2 insert batches (plus a savepoint), not a handful of queries per row
+    with django_assert_max_num_queries(7):
+        new_ids = document_tasks.filter_document_jsons_to_new_and_newly_modified(document_jsons)
+
+    assert sorted(Document.objects.filter(id__in=new_ids).values_list('repository_unique_id', 'local_version')) == \
+        [("2", 2), ("3", 1), ("4", 1)]
+    assert Document.objects.get(id__in=new_ids, repository_unique_id="3").source_json == document_jsons[2]
+    # Compared against the latest version (2) of entry 1, not version 1, so it isn't re-versioned
+    assert sorted(Document.objects.latest_versions().values_list('repository_unique_id', 'local_version')) == \
+        [("1", 2), ("2", 2), ("3", 1), ("4", 1)]
+
+    assert document_tasks.filter_document_jsons_to_new_and_newly_modified(document_jsons) == []
+
+
+def test_new_documents_are_exported_in_batches(monkeypatch, settings):
+    settings.CRAWLER_EXPORT_BATCH_MAX_DOCUMENTS = 2
+    cache.clear()
+    exports = []
+    monkeypatch.setattr(document_tasks, "start_document_export", exports.append)
+    monkeypatch.setattr(document_tasks.fetch_document_pdf_and_metadata, "delay",
+                        lambda document_pk: pytest.fail("exported on its own"))
+    monkeypatch.setattr(celery_app.conf, "task_always_eager", True)
+    failed_metadata_fetches = []
+
+    def get_document_metadata(entry_id: str) -> dict:
+        if entry_id == "2" and not failed_metadata_fetches:
+            failed_metadata_fetches.append(entry_id)
+            raise requests.exceptions.ConnectionError()
+        # No Vendor / Subject / Project Number/ID fields
+        return {**sample_metadata, "id": int(entry_id), "pageCount": 1}
+
+    monkeypatch.setattr(document_metadata, "get_document_metadata", get_document_metadata)
+
+    document_jsons = [
+        {"entryId": entry_id, "name": f"Contract {entry_id}", "type": -1, "targetType": 0,
+         "data": [f"Contract {entry_id}", 1, None, None, None, None, entry_id, None, None, None,
+                  "1/6/2020 3:45:52 PM", "1/6/2020 3:45:52 PM"]}
+        for entry_id in range(1, 6)
+    ]
+
+    assert document_tasks.diff_and_fetch_documents(document_jsons) == 5
+
+    # 3 batches of up to 2, the first one retried after entry 2's metadata fetch fails, and only exported once
+    assert failed_metadata_fetches == ["2"]
+    assert [[doc_obj.repository_unique_id for doc_obj in batch] for batch in exports] == \
+        [["1", "2"], ["3", "4"], ["5"]]
+    assert exports[0][0].tagged_counterparty is None and exports[0][0].description == ""
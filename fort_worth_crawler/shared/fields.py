@@ -15,3 +15,7 @@
 
 def jsonfield_default_value():  # This is a callable
     return {}
+
+
+def jsonfield_default_list_value():  # This is a callable
+    return []
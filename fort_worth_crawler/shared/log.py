@@ -0,0 +1,73 @@
+#  Copyright (C) 2022  John Scrudato / Gordium Knot Inc. d/b/a OpenSource.Legal
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import itertools
+import logging
+import threading
+
+# Attributes every LogRecord has. Anything else on a record came in through extra={...} and is treated as a structured
+# field.
+standard_record_attributes = frozenset(vars(logging.LogRecord("", logging.INFO, "", 0, "", None, None))) | {
+    "message", "asctime", "sample_rate",
+}
+
+
+def sampled(rate: int, **fields) -> dict:
+    """
+    extra={...} for per-row events that would flood the logs if every one was written: only 1 in rate of them (per
+    message) gets through SamplingFilter. Any other fields are passed through as structured fields, e.g.
+
+        logger.debug("Document up to date", extra=sampled(100, entry_id=entry_id))
+    """
+    return {"sample_rate": rate, **fields}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through 1 in sample_rate records for records logged with extra=sampled(...), counted per message template
+    (so lazily formatted messages with different arguments share a counter). Records without a sample_rate always pass.
+    """
+
+    def __init__(self, name: str = ""):
+        super().__init__(name)
+        self._lock = threading.Lock()
+        self._counters: dict[tuple[str, str], itertools.count] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = getattr(record, "sample_rate", None)
+        if not rate or rate <= 1:
+            return True
+
+        key = (record.name, str(record.msg))
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = itertools.count()
+        return next(counter) % rate == 0
+
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    Formats records as usual, then appends any structured fields (passed with extra={...}) as key=value pairs, so log
+    lines stay readable but can still be filtered / parsed by field.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        fields = [
+            f"{key}={value!r}" if isinstance(value, str) and " " in value else f"{key}={value}"
+            for key, value in vars(record).items()
+            if key not in standard_record_attributes and not key.startswith("_")
+        ]
+        return f"{message} {' '.join(fields)}" if fields else message